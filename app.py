@@ -3,6 +3,7 @@ from flask_restx import Api
 
 import os
 os.environ['DATABASE_URL'] = 'sqlite:///tv-maze-actors.db'
+os.environ['TVMAZE_CACHE_PATH'] = 'tvmaze-cache.db'
 
 from tv_maze_db_api import app
 
@@ -0,0 +1,248 @@
+# Latency of every endpoint against a seeded database and a local TV Maze stub.
+#
+#   python benchmarks/bench_endpoints.py --actors 1000 --output benchmarks/baseline.json
+#   python benchmarks/bench_endpoints.py --actors 100000 --baseline benchmarks/baseline.json   # exits 1 on a regression
+#
+# The measurement runs in a fresh process, so peak RSS is the app's own. Seeding 1M actors takes a few minutes,
+# pass --database to keep the seeded file and reuse it on the next run.
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+               'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Emilia', 'Kit']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Clarke', 'Harington']
+# roughly the mix of countries among TV Maze people, most actors have one
+COUNTRIES = [('United States', 40), ('United Kingdom', 15), ('Canada', 6), ('Japan', 6), ('Australia', 4),
+             ('France', 4), ('Germany', 4), ('Korea, Republic of', 3), ('India', 3), ('Spain', 2), (None, 13)]
+GENDERS = [('Male', 50), ('Female', 42), (None, 8)]
+SEED_CHUNK_SIZE = 10000
+# actors changed or deleted by each bulk request
+BULK_PATCH_SIZE = 100
+BULK_DELETE_SIZE = 10
+
+
+def weighted(rng, choices):
+    return rng.choices([c for c, _ in choices], [w for _, w in choices])[0]
+
+
+def seed_rows(actors, rng):
+    # actors with 1 to 12 shows each, a few shows shared by many actors like real long running series
+    show_count = max(50, actors // 5)
+    now = dt.datetime.now()
+    yield None, set(range(1, show_count + 1))
+    for i in range(1, actors + 1):
+        birthday = dt.date(1930, 1, 1) + dt.timedelta(days=rng.randint(0, 27000))
+        deathday = None if rng.random() > 0.1 else birthday + dt.timedelta(days=rng.randint(10000, 30000))
+        actor = {
+            'id': i,
+            'actor_id': i,
+            'name': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+            'country': weighted(rng, COUNTRIES),
+            'gender': weighted(rng, GENDERS),
+            'last_update': now - dt.timedelta(seconds=rng.randint(0, 60 * 24 * 3600)),
+            'birthday': birthday,
+            'deathday': deathday,
+        }
+        shows = {min(show_count, int(rng.paretovariate(1.2))) for _ in range(rng.randint(1, 12))}
+        yield actor, shows
+
+
+def seed(actors, rng_seed=1):
+    from tv_maze_db_api import db
+    from tv_maze_db_api.model import Actor, ActorStatistic, Show, show_actor_association_table
+    rng = random.Random(rng_seed)
+    actor_rows, association_rows = [], []
+
+    def flush():
+        # associations first, the search index trigger then reads each actor's show names once on insert
+        if association_rows:
+            db.session.execute(show_actor_association_table.insert(), association_rows)
+        db.session.execute(Actor.__table__.insert(), actor_rows)
+        db.session.commit()
+        del actor_rows[:], association_rows[:]
+
+    for actor, shows in seed_rows(actors, rng):
+        if actor is None:
+            # the first item carries every show id
+            db.session.execute(Show.__table__.insert(), [{'id': s, 'name': 'Show {}'.format(s)} for s in sorted(shows)])
+            continue
+        actor_rows.append(actor)
+        association_rows += [{'actor_id': actor['id'], 'show_id': s} for s in shows]
+        if len(actor_rows) >= SEED_CHUNK_SIZE:
+            flush()
+    if actor_rows:
+        flush()
+    db.session.commit()
+    ActorStatistic.rebuild()
+
+
+def percentiles(samples):
+    cuts = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {'p50_ms': cuts[49] * 1000, 'p95_ms': cuts[94] * 1000, 'p99_ms': cuts[98] * 1000}
+
+
+def time_requests(client, name, requests):
+    # requests is a list of (method, path), (method, path, setup) or (method, path, setup, json body) tuples,
+    # setup runs outside the clock
+    samples, errors = [], 0
+    for request in requests:
+        method, path = request[:2]
+        if len(request) > 2 and request[2] is not None:
+            request[2]()
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=request[3] if len(request) > 3 else None)
+        samples.append(time.perf_counter() - start)
+        errors += response.status_code >= 400
+    result = {'endpoint': name, 'requests': len(samples), 'errors': errors,
+              'throughput_rps': len(samples) / sum(samples)}
+    result.update(percentiles(samples))
+    return result
+
+
+def run(actors, requests, latency, reuse):
+    import resource
+    from tests.tvmaze_stub import TVMaze_Stub
+    from tv_maze_db_api import app, prewarm
+    from tv_maze_db_api.helper import Statistics_Helper
+    from tv_maze_db_api.model import Actor
+
+    rng = random.Random(2)
+    with app.app_context():
+        seed_seconds = None
+        if not (reuse and Actor.count() >= actors):
+            start = time.perf_counter()
+            seed(actors)
+            seed_seconds = time.perf_counter() - start
+        seeded_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # time rendering, not the render pool start up, which also competes with the first requests for CPU
+        prewarm()
+        client = app.test_client()
+        client.get('/actors/statistics?format=image&by=birth_year')
+        size = 20
+        pages = max(1, actors // size)
+        ids = list(range(1, actors + 1))
+        rng.shuffle(ids)
+        deleted, ids = ids[:requests], ids[requests:]
+        # leave at least half of the rest for the read and patch requests on small seeds
+        bulk_count = min(requests * BULK_DELETE_SIZE, len(ids) // 2)
+        bulk_deleted, ids = ids[:bulk_count], ids[bulk_count:]
+        middle = json.loads(client.get('/actors/?size={}&page={}&count=false'.format(size, max(1, pages // 2))).get_data(as_text=True))
+        cursor_path = middle['_links']['next']['href'].split('localhost', 1)[1]
+
+        results = []
+        for name, page in (('list first page', 1), ('list page at 10%', max(1, pages // 10)),
+                           ('list page at 50%', max(1, pages // 2)), ('list last page', pages)):
+            results.append(time_requests(client, name, [('GET', '/actors/?size={}&page={}'.format(size, page))] * requests))
+        results.append(time_requests(client, 'list page by cursor', [('GET', cursor_path)] * requests))
+        results.append(time_requests(client, 'search typeahead', [
+            ('GET', '/actors/search?q=' + rng.choice(FIRST_NAMES)[:rng.randint(2, 5)]) for _ in range(requests)]))
+        # the first co-star query builds the graph, time the queries and not the build
+        client.get('/actors/{}/costars'.format(ids[0]))
+        results.append(time_requests(client, 'costars', [('GET', '/actors/{}/costars'.format(rng.choice(ids))) for _ in range(requests)]))
+        results.append(time_requests(client, 'path', [
+            ('GET', '/actors/{}/path/{}'.format(rng.choice(ids), rng.choice(ids))) for _ in range(requests)]))
+        results.append(time_requests(client, 'detail', [('GET', '/actors/{}'.format(rng.choice(ids))) for _ in range(requests)]))
+        results.append(time_requests(client, 'patch', [
+            ('PATCH', '/actors/{}?country={}'.format(rng.choice(ids), rng.choice(COUNTRIES[:-1])[0])) for _ in range(requests)]))
+        results.append(time_requests(client, 'delete', [('DELETE', '/actors/{}'.format(i)) for i in deleted]))
+        results.append(time_requests(client, 'bulk patch', [
+            ('PATCH', '/actors/bulk', None, [{'id': i, 'country': rng.choice(COUNTRIES[:-1])[0]} for i in rng.sample(ids, min(len(ids), BULK_PATCH_SIZE))])
+            for _ in range(requests)]))
+        results.append(time_requests(client, 'bulk delete', [
+            ('DELETE', '/actors/bulk', None, bulk_deleted[i:i + BULK_DELETE_SIZE]) for i in range(0, len(bulk_deleted), BULK_DELETE_SIZE)]))
+        results.append(time_requests(client, 'statistics json', [('GET', '/actors/statistics?format=json&by=country')] * requests))
+        results.append(time_requests(client, 'statistics image', [('GET', '/actors/statistics?format=image&by=gender')] * requests))
+        results.append(time_requests(client, 'statistics image uncached',
+            [('GET', '/actors/statistics?format=image&by=country', Statistics_Helper.image_cache.clear)] * max(1, requests // 10)))
+
+        with TVMaze_Stub(latency=latency) as stub:
+            app.config['TVMAZE_API_URL'] = stub.url
+            names = []
+            for i in range(requests):
+                names.append('Bench Person {}'.format(i))
+                stub.add_person(actors + 1000 + i, names[-1], ['Show {}'.format(s) for s in range(1, 6)])
+            results.append(time_requests(client, 'post', [('POST', '/actors/?name=' + name) for name in names]))
+
+    return {
+        'actors': actors,
+        'requests': requests,
+        'tvmaze_latency_ms': latency * 1000,
+        'seed_seconds': seed_seconds,
+        'seeded_rss_kb': seeded_rss_kb,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'endpoints': results,
+    }
+
+
+def measure(actors, requests, latency=0.05, database=None):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.abspath(database) if database else os.path.join(tmpdir, 'bench.db')
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + path, PYTHONPATH=ROOT, TVMAZE_RATE_LIMIT='0')
+        for name in ('PREWARM_STATS', 'TVMAZE_SYNC_INTERVAL', 'TVMAZE_CACHE_PATH'):
+            env.pop(name, None)
+        command = [sys.executable, os.path.abspath(__file__), '--child', '--actors', str(actors),
+                   '--requests', str(requests), '--latency', str(latency)] + (['--reuse'] if database else [])
+        output = subprocess.run(command, env=env, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    before = {e['endpoint']: e for e in baseline['endpoints']}
+    # an endpoint the baseline does not know is never compared, record a new baseline when adding one
+    for name in [e['endpoint'] for e in result['endpoints'] if e['endpoint'] not in before]:
+        regressions.append('{} has no baseline entry'.format(name))
+    for name in sorted(set(before) - {e['endpoint'] for e in result['endpoints']}):
+        regressions.append('{} was not measured'.format(name))
+    for endpoint in result['endpoints']:
+        old = before.get(endpoint['endpoint'])
+        if old is not None and endpoint['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            regressions.append('{} p95 {:.2f}ms > baseline {:.2f}ms'.format(endpoint['endpoint'], endpoint['p95_ms'], old['p95_ms']))
+        if endpoint['errors'] > (0 if old is None else old['errors']):
+            regressions.append('{} has {} errors'.format(endpoint['endpoint'], endpoint['errors']))
+    if result['peak_rss_kb'] > baseline['peak_rss_kb'] * (1 + tolerance):
+        regressions.append('peak_rss_kb {} > baseline {}'.format(result['peak_rss_kb'], baseline['peak_rss_kb']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--actors', type=int, default=1000, help='actors to seed, e.g. 1000, 100000 or 1000000')
+    parser.add_argument('--requests', type=int, default=100, help='requests timed per endpoint')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the TV Maze stub waits per call')
+    parser.add_argument('--database', help='keep the seeded database at this path and reuse it')
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='JSON result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--reuse', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.actors, args.requests, args.latency, args.reuse)))
+        sys.exit(0)
+
+    result = measure(args.actors, args.requests, args.latency, args.database)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
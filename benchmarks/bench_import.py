@@ -0,0 +1,79 @@
+# Cold import cost of tv_maze_db_api: wall time, peak RSS and which heavy modules got loaded.
+#
+#   python benchmarks/bench_import.py --output import.json
+#   python benchmarks/bench_import.py --baseline import.json   # exits 1 on a regression
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib']
+
+PROBE = '''
+import json, resource, sys, time
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import tv_maze_db_api
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'import_seconds': elapsed,
+    'peak_rss_kb': after,
+    'import_rss_kb': after - before,
+    'heavy_modules': sorted(m for m in %r if m in sys.modules),
+}))
+''' % (HEAVY_MODULES,)
+
+
+def probe(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=ROOT)
+    env.pop('PREWARM_STATS', None)
+    output = subprocess.run([sys.executable, '-c', PROBE], env=env, cwd=ROOT,
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(runs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        samples = [probe('sqlite:///' + os.path.join(tmpdir, 'bench.db')) for _ in range(runs)]
+    return {
+        'runs': runs,
+        'import_seconds_median': statistics.median(s['import_seconds'] for s in samples),
+        'peak_rss_kb_median': statistics.median(s['peak_rss_kb'] for s in samples),
+        'heavy_modules': samples[-1]['heavy_modules'],
+    }
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for key in ('import_seconds_median', 'peak_rss_kb_median'):
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('{} {:.3f} > baseline {:.3f}'.format(key, result[key], baseline[key]))
+    for module in set(result['heavy_modules']) - set(baseline['heavy_modules']):
+        regressions.append('{} is now imported eagerly'.format(module))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='JSON result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    result = measure(args.runs)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
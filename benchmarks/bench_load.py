@@ -0,0 +1,110 @@
+# Read throughput against one SQLite file with 1, 2, 4... reader processes and a writer process running alongside.
+#
+#   python benchmarks/bench_load.py --workers 1,2,4 --duration 10 --output load.json
+#
+# Every process imports the app on its own, like gunicorn workers, with DB_READ_SPLIT on. Reads should scale
+# with the worker count up to the number of cores, and neither side should see "database is locked".
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+WORKER = '''
+import json, random, sys, time
+mode, actors, start_at, duration = sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4])
+from sqlalchemy.exc import OperationalError
+from tv_maze_db_api import app, db
+from tv_maze_db_api.model import Actor
+
+result = {'requests': 0, 'errors': 0, 'locked': 0}
+with app.app_context():
+    if mode == 'seed':
+        for start in range(0, actors, 1000):
+            Actor.save_all_to_db([Actor(i, 'Actor {}'.format(i), 'Country {}'.format(i % 50), 'Female' if i % 2 else 'Male', None, None)
+                                  for i in range(start + 1, min(actors, start + 1000) + 1)])
+        print(json.dumps(result))
+        sys.exit(0)
+    client = app.test_client()
+    time.sleep(max(0.0, start_at - time.time()))
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            if mode == 'write':
+                actor = Actor.find_by_id(random.randint(1, actors))
+                actor.country = 'Country {}'.format(random.randint(0, 49))
+                db.session.commit()
+            elif random.random() < 0.8:
+                status = client.get('/actors/{}'.format(random.randint(1, actors))).status_code
+                result['errors'] += status != 200
+            else:
+                page = random.randint(1, max(1, actors // 20))
+                status = client.get('/actors/?size=20&count=false&page={}'.format(page)).status_code
+                result['errors'] += status != 200
+        except OperationalError as msg:
+            db.session.rollback()
+            result['errors'] += 1
+            result['locked'] += 'locked' in str(msg)
+        result['requests'] += 1
+print(json.dumps(result))
+'''
+
+
+def run(database_url, mode, actors, start_at=0.0, duration=0.0):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=ROOT, DB_READ_SPLIT='1', ACTOR_CACHE_SIZE='0')
+    env.pop('PREWARM_STATS', None)
+    env.pop('TVMAZE_SYNC_INTERVAL', None)
+    return subprocess.Popen([sys.executable, '-c', WORKER, mode, str(actors), str(start_at), str(duration)],
+        env=env, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+
+
+def collect(process):
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('load worker exited with {}'.format(process.returncode))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(worker_counts, duration, actors):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database_url = 'sqlite:///' + os.path.join(tmpdir, 'load.db')
+        collect(run(database_url, 'seed', actors))
+        for workers in worker_counts:
+            # leave time for every process to import the app before the clock starts
+            start_at = time.time() + 3
+            readers = [run(database_url, 'read', actors, start_at, duration) for _ in range(workers)]
+            writer = run(database_url, 'write', actors, start_at, duration)
+            reads = [collect(process) for process in readers]
+            writes = collect(writer)
+            results.append({
+                'workers': workers,
+                'reads_per_second': sum(r['requests'] for r in reads) / duration,
+                'writes_per_second': writes['requests'] / duration,
+                'errors': sum(r['errors'] for r in reads) + writes['errors'],
+                'locked': sum(r['locked'] for r in reads) + writes['locked'],
+            })
+    base = results[0]['reads_per_second'] or 1
+    for result in results:
+        result['read_scaling'] = result['reads_per_second'] / base
+    return {'cpus': os.cpu_count(), 'actors': actors, 'duration': duration, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4', help='comma separated reader process counts')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--output', help='write the result as JSON')
+    args = parser.parse_args()
+
+    result = measure([int(w) for w in args.workers.split(',')], args.duration, args.actors)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    sys.exit(1 if any(r['locked'] for r in result['results']) else 0)
@@ -0,0 +1,721 @@
+import os
+import datetime as dt
+import time
+import json
+import unittest
+from unittest import mock
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from tv_maze_db_api import actor_job_pool, app, db
+from tv_maze_db_api.graph import GRAPH_VERSION_NAME, costar_graph
+from tv_maze_db_api.render import render_pool
+from tv_maze_db_api.helper import TVMaze_API_Access
+from tv_maze_db_api.model import Actor, ActorStatistic, Show, TableVersion, show_actor_association_table
+from tv_maze_db_api.rate_limit import Token_Bucket
+from tests.tvmaze_stub import TVMaze_Stub
+
+app_ctxt = app.app_context()
+rate_limiter = TVMaze_API_Access.rate_limiter
+
+
+def setUpModule():
+    app_ctxt.push()
+    # the stub has no upstream limit to respect
+    TVMaze_API_Access.rate_limiter = Token_Bucket(0, 1, 1)
+
+
+def tearDownModule():
+    TVMaze_API_Access.rate_limiter = rate_limiter
+    app_ctxt.pop()
+
+
+class EndpointTestCase(unittest.TestCase):
+    def setUp(self):
+        db.create_all()
+        Actor.detail_cache.clear()
+        costar_graph.clear()
+        self.client = app.test_client()
+        self.stub = TVMaze_Stub().__enter__()
+        self.api_url = app.config['TVMAZE_API_URL']
+        app.config['TVMAZE_API_URL'] = self.stub.url
+
+    def count_queries(self, func):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, statements
+
+    def tearDown(self):
+        app.config['TVMAZE_API_URL'] = self.api_url
+        self.stub.__exit__(None, None, None)
+        db.session.remove()
+        db.drop_all()
+
+
+class TestBulkImport(EndpointTestCase):
+    def test_should_import_list_of_actors(self):
+        self.stub.add_person(1, 'Brad Pitt', ['Friends', 'Glee'])
+        self.stub.add_person(2, 'Jennifer Aniston', ['Friends', 'The Morning Show'], gender='Female', first_show_id=1000)
+        response = self.client.post('/actors/bulk', json=['Brad Pitt', 'Jennifer Aniston', 'Bard Pitt'])
+        assert response.status_code == 200
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert jsonresp['total'] == 3
+        assert jsonresp['summary'] == {'created': 2, 'not-found': 1}
+        assert [a['status'] for a in jsonresp['actors']] == ['created', 'created', 'not-found']
+        assert jsonresp['actors'][0]['_links']['self']['href'] == 'http://localhost/actors/{}'.format(jsonresp['actors'][0]['id'])
+
+        # the shared show is fetched and stored once
+        assert self.stub.requests.count('/shows/1000') == 1
+        assert Show.query.filter_by(name='Friends').count() == 1
+        assert sorted(s.name for s in Actor.find_by_actorid(2).shows) == ['Friends', 'The Morning Show']
+
+    def test_should_import_ndjson_stream(self):
+        self.stub.add_person(1, 'Brad Pitt', ['Friends'])
+        body = '"Brad Pitt"\n{"name": "Brad Pitt"}\n\n'
+        response = self.client.post('/actors/bulk', data=body, content_type='application/x-ndjson')
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert [a['status'] for a in jsonresp['actors']] == ['created', 'duplicate']
+        assert jsonresp['actors'][0]['id'] == jsonresp['actors'][1]['id']
+
+        response = self.client.post('/actors/bulk', json={'names': ['Brad Pitt']})
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert jsonresp['actors'][0]['status'] == 'exists'
+        assert Actor.query.count() == 1
+
+
+class TestBulkChanges(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        for i, (name, country, shows) in enumerate([('Ann', 'Canada', ['Friends']), ('Bob', 'Canada', ['Friends', 'Glee']),
+                                                    ('Cat', None, ['Glee', 'Lost']), ('Dan', 'Peru', ['Lost']),
+                                                    ('Eve', None, ['Fargo'])], start=1):
+            actor = Actor(i, name, country, 'Female', None, None)
+            actor.shows = Show.resolve_shownames(shows)
+            db.session.add(actor)
+        db.session.commit()
+
+    def statuses(self, response):
+        assert response.status_code == 200
+        return [(actor['id'], actor['status']) for actor in response.json['actors']]
+
+    def costars(self, id):
+        return [c['name'] for c in self.client.get('/actors/{}/costars'.format(id)).json['costars']]
+
+    def test_should_update_many_actors_in_one_transaction(self):
+        assert self.client.get('/actors/2').json['name'] == 'Bob'
+        assert self.costars(1) == ['Bob']
+        builds = costar_graph.builds
+        changes = [{'id': 1, 'country': 'Peru', 'birthday': '18-12-1963'}, {'id': 2, 'name': 'Robert', 'shows': ['Glee', 'Fargo']},
+                   {'id': 99, 'name': 'Nobody'}, {'id': 3, 'birthday': '1963-12-18'}, {'id': 1, 'name': 'Twice'}, {'id': 4, 'age': 3}]
+        (response, statements) = self.count_queries(lambda: self.client.patch('/actors/bulk', json={'actors': changes}))
+        assert self.statuses(response) == [(1, 'updated'), (2, 'updated'), (99, 'not-found'), (3, 'invalid'), (1, 'invalid'), (4, 'invalid')]
+        assert response.json['summary'] == {'updated': 2, 'not-found': 1, 'invalid': 3}
+        assert response.json['actors'][1]['_links']['self']['href'] == 'http://localhost/actors/2'
+        assert len([statement for statement in statements if statement.startswith('UPDATE actors')]) == 2
+
+        ann = Actor.find_by_id(1)
+        assert (ann.name, ann.country, ann.birthday) == ('Ann', 'Peru', dt.date(1963, 12, 18))
+        assert self.client.get('/actors/2').json['name'] == 'Robert'
+        assert ActorStatistic.check() == []
+        assert [a['id'] for a in self.client.get('/actors/search?q=robert').json['actors']] == [2]
+        assert self.costars(1) == []
+        assert sorted(self.costars(2)) == ['Cat', 'Eve']
+        assert costar_graph.builds == builds
+
+    def test_should_delete_many_actors_in_one_transaction(self):
+        assert self.costars(2) == ['Ann', 'Cat']
+        builds = costar_graph.builds
+        version = TableVersion.get(Show.__tablename__)[0]
+        response = self.client.delete('/actors/bulk', json={'ids': [3, 99, 3, 'x', 5]})
+        assert self.statuses(response) == [(3, 'deleted'), (99, 'not-found'), (None, 'invalid'), (5, 'deleted')]
+
+        # Cat's and Eve's shows go with them, and so do the other actors' links to those shows
+        assert sorted(actor.name for actor in Actor.get_all()) == ['Ann', 'Bob', 'Dan']
+        assert sorted(show.name for show in Show.query.all()) == ['Friends']
+        assert db.session.query(show_actor_association_table).count() == 2
+        assert TableVersion.get(Show.__tablename__)[0] == version + 1
+        assert ActorStatistic.check() == []
+        assert self.client.get('/actors/search?q=glee').json['actors'] == []
+        assert self.costars(2) == ['Ann']
+        assert self.costars(4) == []
+        assert costar_graph.builds == builds
+        assert self.client.get('/actors/3').status_code == 404
+
+    def test_should_reject_malformed_bodies(self):
+        assert self.client.patch('/actors/bulk', json={'actors': 5}).status_code == 400
+        assert self.client.delete('/actors/bulk', data='[1,', content_type='application/json').status_code == 400
+        assert sorted(actor.name for actor in Actor.get_all()) == ['Ann', 'Bob', 'Cat', 'Dan', 'Eve']
+
+
+class TestActorJobs(EndpointTestCase):
+    def tearDown(self):
+        actor_job_pool.stop()
+        super().tearDown()
+
+    def wait_for_job(self, href):
+        for _ in range(100):
+            jsonresp = json.loads(self.client.get(href).get_data(as_text=True))
+            if jsonresp['status'] not in ('queued', 'running'):
+                return jsonresp
+            time.sleep(0.05)
+        raise AssertionError('job did not finish')
+
+    def test_should_create_actor_in_background(self):
+        self.stub.add_person(1, 'Brad Pitt', ['Friends'])
+        response = self.client.post('/actors/?name=Brad Pitt&async=true', follow_redirects=True)
+        assert response.status_code == 202
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert jsonresp['status'] in ('queued', 'running', 'done')
+        assert response.headers['Location'] == jsonresp['_links']['self']['href']
+
+        jsonresp = self.wait_for_job(response.headers['Location'])
+        assert jsonresp['status'] == 'done'
+        actor_href = jsonresp['_links']['actor']['href']
+        assert actor_href == 'http://localhost/actors/1'
+        assert json.loads(self.client.get(actor_href).get_data(as_text=True))['name'] == 'Brad Pitt'
+
+    def test_should_report_unknown_actor(self):
+        response = self.client.post('/actors/?name=Bard Pitt&async=true', follow_redirects=True)
+        jsonresp = self.wait_for_job(response.headers['Location'])
+        assert jsonresp['status'] == 'not-found'
+        assert jsonresp['_links']['actor']['href'] is None
+        assert self.client.get('/jobs/999').status_code == 404
+
+
+class TestActorsPagination(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        countries = ['Australia', None, 'United States', 'Canada', None]
+        for i in range(23):
+            db.session.add(Actor(i + 1, 'Actor {:02d}'.format(i % 7), countries[i % 5], 'Male', None, None))
+        db.session.commit()
+
+    def walk(self, url):
+        rows = []
+        while url is not None:
+            response = self.client.get(url.replace('http://localhost', ''), follow_redirects=True)
+            assert response.status_code == 200
+            jsonresp = json.loads(response.get_data(as_text=True))
+            rows += jsonresp['actors']
+            url = jsonresp['_links']['next']['href']
+        return rows, jsonresp
+
+    def test_should_follow_cursor_links_through_every_actor(self):
+        rows, last = self.walk('/actors?order=-country,%2Bname&size=4&filter=id,name,country')
+        expected = sorted(Actor.query.all(), key=lambda a: a.id)
+        expected = sorted(expected, key=lambda a: a.name)
+        expected = sorted(expected, key=lambda a: a.country or '', reverse=True)
+        assert [row['id'] for row in rows] == [a.id for a in expected]
+        assert last['page'] == 6
+        assert last['total'] == 23
+
+    def test_should_skip_count_on_request(self):
+        rows, last = self.walk('/actors?order=+id&size=10&filter=id&count=false')
+        assert [row['id'] for row in rows] == list(range(1, 24))
+        assert last['total'] is None
+
+    def test_should_return_only_filter_columns(self):
+        response = self.client.get('/actors?order=-last_update&size=2&filter=name,country', follow_redirects=True)
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert [sorted(row) for row in jsonresp['actors']] == [['country', 'name'], ['country', 'name']]
+        rows, _ = self.walk('/actors?order=%2Bcountry&size=5&filter=id,birthday')
+        assert sorted(row['id'] for row in rows) == list(range(1, 24))
+        assert self.client.get('/actors?filter=id,password', follow_redirects=True).status_code == 400
+
+    def test_should_reject_pages_and_sizes_below_one(self):
+        for query in ('size=0', 'size=-1', 'size=-5', 'page=0', 'page=-2'):
+            response = self.client.get('/actors?order=%2Bid&filter=id&' + query, follow_redirects=True)
+            assert response.status_code == 400, query
+            assert 'page and size start at 1' in response.get_data(as_text=True)
+
+    def test_should_reject_cursor_of_another_order(self):
+        response = self.client.get('/actors?order=+id&size=10&filter=id', follow_redirects=True)
+        cursor = json.loads(response.get_data(as_text=True))['_links']['next']['href'].split('cursor=')[1]
+        response = self.client.get('/actors?order=-name&size=10&filter=id&cursor=' + cursor, follow_redirects=True)
+        assert response.status_code == 400
+
+
+class TestActorsStatistics(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(Actor(1, 'Brad Pitt', 'United States', 'Male', dt.date(1963, 12, 18), None))
+        db.session.add(Actor(2, 'Emilia Clarke', 'United Kingdom', 'Female', dt.date(1986, 10, 23), None))
+        db.session.add(Actor(3, 'Alan Rickman', 'United Kingdom', 'Male', dt.date(1946, 2, 21), dt.date(2016, 1, 14)))
+        db.session.add(Actor(4, 'Unknown', None, None, None, None))
+        db.session.commit()
+
+    def test_should_group_actors_in_sql(self):
+        response = self.client.get('/actors/statistics?format=json&by=country,gender,life_status,birthday', follow_redirects=True)
+        assert response.status_code == 200
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert jsonresp['total'] == 4
+        assert jsonresp['total-updated'] == 4
+        assert jsonresp['by-country'] == {'United Kingdom': 50, 'United States': 25}
+        assert list(jsonresp['by-country'].keys()) == ['United Kingdom', 'United States']
+        assert jsonresp['by-gender'] == {'Male': 50, 'Female': 25}
+        assert jsonresp['by-life_status'] == {'Alive': 75, 'Dead': 25}
+        assert jsonresp['by-birthday_month'] == {'December': 25, 'October': 25, 'February': 25}
+        assert jsonresp['by-birthday_year'] == {'1963': 25, '1986': 25, '1946': 25}
+
+    def test_should_render_statistics_image(self):
+        response = self.client.get('/actors/statistics?format=image&by=country,gender', follow_redirects=True)
+        assert response.status_code == 200
+        assert response.headers.get('Content-Type') == 'image/png'
+
+    def test_should_cache_and_revalidate_statistics_image(self):
+        url = '/actors/statistics?format=image&by=gender'
+        with mock.patch.object(render_pool, 'render', wraps=render_pool.render) as render:
+            first = self.client.get(url, follow_redirects=True)
+            etag = first.headers.get('ETag')
+            assert first.status_code == 200
+            assert etag is not None
+
+            again = self.client.get(url, follow_redirects=True)
+            assert again.get_data() == first.get_data()
+            assert render.call_count == 1
+
+            response = self.client.get(url, headers={'If-None-Match': etag}, follow_redirects=True)
+            assert response.status_code == 304
+            assert response.get_data() == b''
+
+            Actor(5, 'Jennifer Aniston', 'United States', 'Female', None, None).save_to_db()
+            response = self.client.get(url, headers={'If-None-Match': etag}, follow_redirects=True)
+            assert response.status_code == 200
+            assert response.headers.get('ETag') != etag
+            assert render.call_count == 2
+
+    def test_should_answer_503_when_render_pool_is_saturated(self):
+        with mock.patch.object(render_pool, 'max_queue', 0):
+            response = self.client.get('/actors/statistics?format=image&by=country', follow_redirects=True)
+        assert response.status_code == 503
+        assert response.headers.get('Retry-After') == '1'
+
+    def test_should_reject_unknown_dimension(self):
+        response = self.client.get('/actors/statistics?format=json&by=shoe_size', follow_redirects=True)
+        assert response.status_code == 400
+
+
+class TestActorDetail(EndpointTestCase):
+    def test_should_serve_detail_in_one_query(self):
+        for i in range(3):
+            actor = Actor(i + 1, 'Actor {}'.format(i), 'Canada', 'Female', dt.date(1980, 1, i + 1), None)
+            actor.shows = Show.resolve_shownames(['Show {}'.format(i), 'Shared'])
+            actor.save_to_db()
+
+        response, statements = self.count_queries(lambda: self.client.get('/actors/2', follow_redirects=True))
+
+        assert response.status_code == 200
+        assert len(statements) == 1
+        jsonresp = json.loads(response.get_data(as_text=True))
+        assert jsonresp['name'] == 'Actor 1'
+        assert jsonresp['birthday'] == '02-01-1980'
+        assert sorted(jsonresp['shows']) == ['Shared', 'Show 1']
+        assert jsonresp['_links']['previous']['href'] == 'http://localhost/actors/1'
+        assert jsonresp['_links']['next']['href'] == 'http://localhost/actors/3'
+
+        jsonresp = json.loads(self.client.get('/actors/1', follow_redirects=True).get_data(as_text=True))
+        assert jsonresp['_links']['previous']['href'] is None
+
+        response = self.client.get('/actors/4', follow_redirects=True)
+        assert response.status_code == 404
+
+    def test_should_serve_popular_actors_from_cache(self):
+        for i in range(4):
+            Actor(i + 1, 'Actor {}'.format(i), 'Canada', 'Female', None, None).save_to_db()
+        self.client.get('/actors/2', follow_redirects=True)
+        self.client.get('/actors/4', follow_redirects=True)
+
+        response, statements = self.count_queries(lambda: self.client.get('/actors/2', follow_redirects=True))
+        assert response.status_code == 200
+        assert statements == []
+        assert Actor.detail_cache.stats()['hits'] >= 1
+
+        # patching an actor drops its entry
+        self.client.patch('/actors/2?name=Someone Else', follow_redirects=True)
+        jsonresp = json.loads(self.client.get('/actors/2', follow_redirects=True).get_data(as_text=True))
+        assert jsonresp['name'] == 'Someone Else'
+
+        # deleting actor 3 relinks both of its cached neighbours
+        self.client.delete('/actors/3', follow_redirects=True)
+        jsonresp = json.loads(self.client.get('/actors/2', follow_redirects=True).get_data(as_text=True))
+        assert jsonresp['_links']['next']['href'] == 'http://localhost/actors/4'
+        jsonresp = json.loads(self.client.get('/actors/4', follow_redirects=True).get_data(as_text=True))
+        assert jsonresp['_links']['previous']['href'] == 'http://localhost/actors/2'
+
+        # a new last actor becomes the next link of the old last one
+        Actor(5, 'Actor 5', None, None, None, None).save_to_db()
+        jsonresp = json.loads(self.client.get('/actors/4', follow_redirects=True).get_data(as_text=True))
+        assert jsonresp['_links']['next']['href'] == 'http://localhost/actors/5'
+
+    def test_should_not_cache_rows_read_before_an_invalidation(self):
+        Actor(1, 'Brad Pitt', None, None, None, None).save_to_db()
+        find_detail = Actor.find_detail
+        def read_then_commit(id):
+            detail = find_detail(id)
+            # another request's patch commits after this read and before it is cached
+            actor = Actor.find_by_id(id)
+            actor.name = 'William Bradley Pitt'
+            db.session.commit()
+            return detail
+        with mock.patch.object(Actor, 'find_detail', side_effect=read_then_commit):
+            assert self.client.get('/actors/1', follow_redirects=True).json['name'] == 'Brad Pitt'
+        assert Actor.detail_cache.get(1) is None
+        assert self.client.get('/actors/1', follow_redirects=True).json['name'] == 'William Bradley Pitt'
+
+
+class TestConditionalGet(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            actor = Actor(i + 1, 'Actor {}'.format(i), 'Canada', 'Female', None, None)
+            actor.shows = Show.resolve_shownames(['Show {}'.format(i)])
+            actor.save_to_db()
+        self.age_writes()
+
+    def age_writes(self):
+        # Last-Modified is only sent once its second has passed, move the writes so far into the past
+        db.session.execute(db.text("UPDATE actors SET last_update = datetime(last_update, '-5 seconds')"))
+        db.session.execute(db.text("UPDATE table_versions SET updated_at = datetime(updated_at, '-5 seconds')"))
+        db.session.commit()
+        Actor.detail_cache.clear()
+
+    def test_should_revalidate_actor_detail_without_loading_it(self):
+        response = self.client.get('/actors/2', follow_redirects=True)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        assert etag is not None and last_modified is not None
+
+        Actor.detail_cache.clear()
+        response, statements = self.count_queries(
+            lambda: self.client.get('/actors/2', headers={'If-None-Match': etag}, follow_redirects=True))
+        assert response.status_code == 304
+        assert len(statements) == 1
+        assert 'json_group_array' not in statements[0]
+
+        response = self.client.get('/actors/2', headers={'If-Modified-Since': last_modified}, follow_redirects=True)
+        assert response.status_code == 304
+
+        # a deleted neighbour changes the links, so the etag no longer matches
+        self.client.delete('/actors/3', follow_redirects=True)
+        response = self.client.get('/actors/2', headers={'If-None-Match': etag}, follow_redirects=True)
+        assert response.status_code == 200
+        assert response.headers.get('ETag') != etag
+
+    def test_should_modify_actor_detail_with_its_neighbours(self):
+        last_modified = self.client.get('/actors/3').headers['Last-Modified']
+        Actor(4, 'Actor 3', None, None, None, None).save_to_db()
+        response = self.client.get('/actors/3', headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 200
+        assert response.json['_links']['next']['href'] == 'http://localhost/actors/4'
+
+    def test_should_not_send_last_modified_of_current_second(self):
+        url = '/actors?order=%2Bid&size=2&filter=id,name'
+        last_modified = self.client.get(url, follow_redirects=True).headers['Last-Modified']
+        self.client.patch('/actors/1?country=Australia')
+        # the write may be followed by others in the same second, only the ETag can revalidate it
+        response = self.client.get(url, headers={'If-Modified-Since': last_modified}, follow_redirects=True)
+        assert response.status_code == 200
+        assert 'Last-Modified' not in response.headers and 'Last-Modified' not in self.client.get('/actors/1').headers
+        self.client.patch('/actors/2?country=Australia')
+        assert self.client.get(url, headers={'If-None-Match': response.headers['ETag']}, follow_redirects=True).status_code == 200
+
+    def test_should_revalidate_actor_list_pages(self):
+        url = '/actors?order=%2Bid&size=2&filter=id,name'
+        response = self.client.get(url, follow_redirects=True)
+        etag = response.headers.get('ETag')
+        assert response.status_code == 200
+
+        response = self.client.get(url, headers={'If-None-Match': etag}, follow_redirects=True)
+        assert response.status_code == 304
+        response = self.client.get(url + '&page=2', headers={'If-None-Match': etag}, follow_redirects=True)
+        assert response.status_code == 200
+
+        self.client.patch('/actors/1?country=Australia', follow_redirects=True)
+        response = self.client.get(url, headers={'If-None-Match': etag}, follow_redirects=True)
+        assert response.status_code == 200
+
+
+class TestReadSplit(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        Actor(1, 'Brad Pitt', 'United States', 'Male', None, None).save_to_db()
+        app.config['DB_READ_SPLIT'] = True
+
+    def tearDown(self):
+        app.config['DB_READ_SPLIT'] = False
+        super().tearDown()
+
+    def test_should_tune_sqlite_connections(self):
+        assert db.session.execute(db.text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db.session.execute(db.text('PRAGMA synchronous')).scalar() == 1
+        assert db.session.execute(db.text('PRAGMA busy_timeout')).scalar() == 5000
+
+    def test_should_read_through_query_only_engine(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engines['read'], 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get('/actors/1', follow_redirects=True)
+            assert response.status_code == 200
+            assert statements
+            del statements[:]
+            response = self.client.patch('/actors/1?country=Canada', follow_redirects=True)
+            assert response.status_code == 200
+            assert statements == []
+        finally:
+            event.remove(db.engines['read'], 'before_cursor_execute', before_cursor_execute)
+        assert json.loads(self.client.get('/actors/1', follow_redirects=True).get_data(as_text=True))['country'] == 'Canada'
+
+        with db.engines['read'].connect() as connection:
+            with self.assertRaises(OperationalError):
+                connection.exec_driver_sql('DELETE FROM actors')
+
+
+class TestExport(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(1, 8):
+            actor = Actor(i, 'Actor {}'.format(8 - i), 'Canada', 'Female', dt.date(1980, 1, i), None)
+            actor.shows = Show.resolve_shownames(['Show {}'.format(i % 2), 'Shared'])
+            db.session.add(actor)
+        db.session.commit()
+
+    def test_should_stream_ndjson_in_list_order(self):
+        with mock.patch('tv_maze_db_api.model.EXPORT_CHUNK_SIZE', 3):
+            response = self.client.get('/actors/export?filter=id,name,birthday,shows&order=+name')
+            body, statements = self.count_queries(lambda: response.get_data(as_text=True))
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        rows = [json.loads(line) for line in body.splitlines()]
+        assert [row['name'] for row in rows] == ['Actor {}'.format(i) for i in range(1, 8)]
+        assert rows[0] == {'id': 7, 'name': 'Actor 1', 'birthday': '1980-01-07', 'shows': ['Show 1', 'Shared']}
+        # the rest of the stream is the remaining show lookups, one per chunk of 3
+        assert len(statements) == 2
+        assert all('tv_shows' in statement for statement in statements)
+
+    def test_should_stream_csv(self):
+        response = self.client.get('/actors/export?format=csv&filter=name,country,shows&order=-id')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines[0] == 'name,country,shows'
+        assert lines[1] == 'Actor 1,Canada,Show 1|Shared'
+        assert len(lines) == 8
+
+    def test_should_export_each_filter_column_once(self):
+        lines = self.client.get('/actors/export?format=csv&filter=id,id,name, id,shows,shows&order=-id').get_data(as_text=True).splitlines()
+        assert lines[0] == 'id,name,shows'
+        assert lines[1].split(',')[:2] == ['7', 'Actor 1']
+        assert sorted(lines[1].split(',')[2].split('|')) == ['Shared', 'Show 1']
+
+    def test_should_reject_unknown_columns_before_streaming(self):
+        assert self.client.get('/actors/export?filter=id,password').status_code == 400
+        assert self.client.get('/actors/export?order=-password').status_code == 400
+        assert self.client.get('/actors/export?format=xml').status_code == 400
+
+
+class TestSearch(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        for i, (name, country, shows) in enumerate([
+                ('Emilia Clarke', 'United Kingdom', ['Game of Thrones']),
+                ('Kit Harington', 'United Kingdom', ['Game of Thrones']),
+                ('Brad Pitt', 'United States', ['Friends']),
+                ('Jennifer Aniston', 'United States', ['Friends', 'The Morning Show']),
+                ('Emily Watson', 'United Kingdom', [])], start=1):
+            actor = Actor(i, name, country, None, None, None)
+            actor.shows = Show.resolve_shownames(shows)
+            db.session.add(actor)
+        db.session.commit()
+
+    def search(self, query):
+        response = self.client.get('/actors/search?' + query)
+        assert response.status_code == 200
+        return response.json
+
+    def names(self, query):
+        return [actor['name'] for actor in self.search(query)['actors']]
+
+    def test_should_match_word_prefixes_of_names_countries_and_shows(self):
+        assert sorted(self.names('q=emil')) == ['Emilia Clarke', 'Emily Watson']
+        assert self.names('q=kit har') == ['Kit Harington']
+        assert sorted(self.names('q=game thr')) == ['Emilia Clarke', 'Kit Harington']
+        assert sorted(self.names('q=united sta')) == ['Brad Pitt', 'Jennifer Aniston']
+        assert self.search('q=brad')['actors'][0]['_links']['self']['href'] == 'http://localhost/actors/3'
+
+    def test_should_rank_name_matches_first(self):
+        self.client.patch('/actors/5?name=Morning Star')
+        assert self.names('q=morning') == ['Morning Star', 'Jennifer Aniston']
+
+    def test_should_tolerate_typos(self):
+        results = self.search('q=emilla clrke')['actors']
+        assert [(actor['name'], actor['match']) for actor in results] == [('Emilia Clarke', 'fuzzy')]
+        assert self.names('q=Bard Pitt') == ['Brad Pitt']
+        assert self.names('q=zzzz') == []
+
+    def test_should_paginate(self):
+        first = self.search('q=united&size=2')
+        assert len(first['actors']) == 2
+        second = self.client.get(first['_links']['next']['href']).json
+        assert second['page'] == 2
+        last = self.search('q=united&size=2&page=3')
+        assert len(last['actors']) == 1 and last['_links']['next']['href'] is None
+        ids = [actor['id'] for page in (first, second, last) for actor in page['actors']]
+        assert sorted(ids) == [1, 2, 3, 4, 5]
+
+    def test_should_rank_and_page_every_match(self):
+        # country matches are stored first, the better name matches come after them
+        for i in range(40):
+            db.session.add(Actor(100 + i, 'Islander {}'.format(i), 'Smith Islands', None, None, None))
+        for i in range(20):
+            db.session.add(Actor(200 + i, 'John Smith {}'.format(i), 'Canada', None, None, None))
+        db.session.commit()
+        pages, page = [], self.search('q=smith&size=8')
+        while True:
+            pages.append(page['actors'])
+            if page['_links']['next']['href'] is None:
+                break
+            page = self.client.get(page['_links']['next']['href']).json
+        names = [actor['name'] for actors in pages for actor in actors]
+        assert len(pages) == 8
+        assert all(name.startswith('John Smith') for name in names[:20])
+        assert len({actor['id'] for actors in pages for actor in actors}) == len(names) == 60
+
+    def test_should_follow_writes(self):
+        actor = Actor.find_by_id(3)
+        actor.name = 'William Bradley Pitt'
+        db.session.commit()
+        assert self.names('q=william') == ['William Bradley Pitt']
+        show = Show.find_by_showname('Friends')
+        show.name = 'Friends Reunion'
+        db.session.commit()
+        assert sorted(self.names('q=reunion')) == ['Jennifer Aniston', 'William Bradley Pitt']
+        actor.shows = []
+        db.session.commit()
+        assert self.names('q=reunion') == ['Jennifer Aniston']
+        # deleting an actor also deletes the actor's shows
+        assert self.client.delete('/actors/4').status_code == 200
+        assert self.names('q=reunion') == []
+        assert self.names('q=jennifer') == []
+
+    def test_should_reject_queries_without_words(self):
+        assert self.client.get('/actors/search').status_code == 400
+        assert self.client.get('/actors/search?q=*"()').status_code == 400
+        assert self.client.get('/actors/search?q=emilia&size=0').status_code == 400
+
+
+class TestCostars(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        # Ann - Friends - Bob - Glee - Cat - Lost - Dan, and Eve on her own
+        for i, (name, shows) in enumerate([('Ann', ['Friends']), ('Bob', ['Friends', 'Glee']), ('Cat', ['Glee', 'Lost']),
+                                           ('Dan', ['Lost']), ('Eve', ['Fargo']), ('Fay', ['Friends', 'Glee'])], start=1):
+            actor = Actor(i, name, None, None, None, None)
+            actor.shows = Show.resolve_shownames(shows)
+            db.session.add(actor)
+        db.session.commit()
+
+    def path(self, source, target):
+        response = self.client.get('/actors/{}/path/{}'.format(source, target))
+        return response.status_code, [(step['name'], step['via']) for step in response.json['path']] if response.status_code == 200 else None
+
+    def test_should_list_costars_by_shared_shows(self):
+        body = self.client.get('/actors/2/costars').json
+        assert [(c['name'], c['shared-shows']) for c in body['costars']] == [('Fay', 2), ('Ann', 1), ('Cat', 1)]
+        assert body['total'] == 3
+        page = self.client.get('/actors/2/costars?size=2&page=2').json
+        assert [c['name'] for c in page['costars']] == ['Cat'] and page['_links']['next']['href'] is None
+        assert self.client.get('/actors/5/costars').json['costars'] == []
+        assert self.client.get('/actors/99/costars').status_code == 404
+
+    def test_should_find_shortest_path(self):
+        assert self.path(1, 4) == (200, [('Ann', None), ('Bob', 'Friends'), ('Cat', 'Glee'), ('Dan', 'Lost')])
+        assert self.path(4, 3) == (200, [('Dan', None), ('Cat', 'Lost')])
+        assert self.path(2, 2) == (200, [('Bob', None)])
+        assert self.path(1, 5)[0] == 404
+        assert self.path(1, 99)[0] == 404
+
+    def test_should_follow_writes_without_rebuilding(self):
+        assert self.path(1, 5)[0] == 404
+        builds = costar_graph.builds
+        eve = Actor.find_by_id(5)
+        eve.shows = eve.shows + Show.resolve_shownames(['Lost'])
+        db.session.commit()
+        assert self.path(1, 5) == (200, [('Ann', None), ('Bob', 'Friends'), ('Cat', 'Glee'), ('Eve', 'Lost')])
+        # Cat's shows go with her
+        assert self.client.delete('/actors/3').status_code == 200
+        assert self.path(1, 5)[0] == 404
+        assert [c['name'] for c in self.client.get('/actors/2/costars').json['costars']] == ['Ann', 'Fay']
+        assert costar_graph.builds == builds
+
+    def test_should_replay_writes_from_other_processes(self):
+        assert self.path(1, 5)[0] == 404
+        builds = costar_graph.builds
+        # another worker's commits reach this graph only through the table and the change log
+        with mock.patch.object(costar_graph, 'apply'):
+            eve = Actor.find_by_id(5)
+            eve.shows = eve.shows + Show.resolve_shownames(['Lost'])
+            db.session.commit()
+            # Bob's shows go with him
+            assert self.client.delete('/actors/2').status_code == 200
+        assert self.path(4, 5) == (200, [('Dan', None), ('Eve', 'Lost')])
+        assert self.path(1, 3)[0] == 404
+        assert sorted(c['name'] for c in self.client.get('/actors/3/costars').json['costars']) == ['Dan', 'Eve']
+        assert costar_graph.builds == builds
+
+    def test_should_rebuild_after_writes_from_other_processes(self):
+        assert self.path(1, 5)[0] == 404
+        builds = costar_graph.builds
+        # what another worker's commit looks like from here: new links and a bumped version
+        db.session.execute(show_actor_association_table.insert(), [{'actor_id': 5, 'show_id': Show.find_by_showname('Glee').id}])
+        TableVersion.bump(db.session.connection(), GRAPH_VERSION_NAME)
+        db.session.commit()
+        assert self.path(1, 5) == (200, [('Ann', None), ('Bob', 'Friends'), ('Eve', 'Glee')])
+        assert costar_graph.builds == builds + 1
+
+
+class TestMetrics(EndpointTestCase):
+    def metric(self, text, prefix):
+        return sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(prefix))
+
+    def test_should_expose_request_sql_and_tvmaze_metrics(self):
+        before = self.client.get('/metrics').get_data(as_text=True)
+        self.stub.add_person(1, 'Brad Pitt', ['Friends'])
+        assert self.client.post('/actors/?name=Brad Pitt', follow_redirects=True).status_code == 201
+        assert self.client.get('/actors/1', follow_redirects=True).status_code == 200
+        with mock.patch.object(render_pool, 'render', return_value=b'png'):
+            assert self.client.get('/actors/statistics?format=image&by=gender', follow_redirects=True).status_code == 200
+
+        response = self.client.get('/metrics')
+        assert response.mimetype == 'text/plain'
+        text = response.get_data(as_text=True)
+        detail = 'http_request_duration_seconds_count{method="GET",endpoint="/actors/<int:id>",status="200"}'
+        assert self.metric(text, detail) == self.metric(before, detail) + 1
+        assert self.metric(text, 'http_request_sql_queries_sum{method="POST",endpoint="/actors/"}') > 0
+        assert self.metric(text, 'tvmaze_requests_total{status="200"}') >= self.metric(before, 'tvmaze_requests_total{status="200"}') + 3
+        for stage in ('stats_query', 'stats_aggregate', 'stats_render'):
+            assert self.metric(text, 'span_duration_seconds_count{{span="{}"}}'.format(stage)) > 0
+        assert '# TYPE actor_detail_cache_hits_total counter' in text
+        assert 'stats_image_cache_entries ' in text
+
+    def test_should_count_failed_statements(self):
+        before = self.client.get('/metrics').get_data(as_text=True)
+        with db.engine.connect() as connection:
+            for _ in range(5):
+                with self.assertRaises(OperationalError):
+                    connection.exec_driver_sql('SELECT * FROM no_such_table')
+            assert 'query_start' not in connection.info
+        text = self.client.get('/metrics').get_data(as_text=True)
+        assert self.metric(text, 'sql_query_errors_total') == self.metric(before, 'sql_query_errors_total') + 5
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+import os
+import datetime as dt
+import requests
+import tempfile
+import threading
+import time
+import unittest
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from tv_maze_db_api import app, db
+from tv_maze_db_api.helper import TVMaze_API_Access
+from tv_maze_db_api.http_cache import HTTP_Response_Cache
+from tv_maze_db_api.model import Actor, SyncCheckpoint
+from tv_maze_db_api.sync import CHECKPOINT_NAME, TVMaze_Sync_Worker
+from tv_maze_db_api.rate_limit import Adaptive_Limiter, Token_Bucket
+from tv_maze_db_api.render import Render_Pool, Render_Pool_Saturated, Render_Timeout
+from tests.tvmaze_stub import TVMaze_Stub
+
+
+app_ctxt = app.app_context()
+rate_limiter = TVMaze_API_Access.rate_limiter
+
+
+def setUpModule():
+    app_ctxt.push()
+    db.create_all()
+    # the stub has no upstream limit to respect
+    TVMaze_API_Access.rate_limiter = Token_Bucket(0, 1, 1)
+
+
+def tearDownModule():
+    TVMaze_API_Access.rate_limiter = rate_limiter
+    db.session.remove()
+    db.drop_all()
+    app_ctxt.pop()
+
+
+class TestTVMazeAPIAccess(unittest.TestCase):
+    def test_should_fetch_show_details_concurrently(self):
+        show_names = ['Show {}'.format(i) for i in range(12)]
+        with TVMaze_Stub(latency=0.05) as stub:
+            stub.add_person(1, 'Brad Pitt', show_names)
+
+            start = time.perf_counter()
+            actor = TVMaze_API_Access(stub.url + '/search/people?q=', max_workers=1).get_actor('Brad Pitt')
+            sequential = time.perf_counter() - start
+
+            start = time.perf_counter()
+            actor = TVMaze_API_Access(stub.url + '/search/people?q=', max_workers=12).get_actor('Brad Pitt')
+            concurrent = time.perf_counter() - start
+
+        # results keep the castcredits order
+        assert [show.name for show in actor.shows] == show_names
+        assert concurrent * 3 < sequential
+
+    def test_should_skip_failed_show_details(self):
+        with TVMaze_Stub() as stub:
+            stub.add_person(2, 'Angelina Jolie', ['First', 'Second', 'Third'])
+            stub.route('/shows/2001', b'Internal Server Error', status=500)
+            actor = TVMaze_API_Access(stub.url + '/search/people?q=').get_actor('Angelina Jolie')
+
+        assert actor is not None
+        assert [show.name for show in actor.shows] == ['First', 'Third']
+
+
+class TestRateLimit(unittest.TestCase):
+    def client(self, stub):
+        api_access = TVMaze_API_Access(stub.url + '/search/people?q=')
+        api_access.concurrency = Adaptive_Limiter(1, 8)
+        api_access.backoff_base = 0.01
+        return api_access
+
+    def test_should_pace_calls_with_token_bucket(self):
+        bucket = Token_Bucket(rate=20, period=1, capacity=2)
+        start = time.perf_counter()
+        for _ in range(12):
+            bucket.acquire()
+        # two calls from the burst, the other ten at 20 per second
+        assert time.perf_counter() - start >= 0.45
+
+    def test_should_retry_after_429(self):
+        responses = [(429, b'Too Many Requests', {'Retry-After': '0'}), (200, {'id': 1}, {})]
+        with TVMaze_Stub() as stub:
+            stub.routes['/people/1'] = lambda handler: responses.pop(0)
+            api_access = self.client(stub)
+            assert api_access.get_json(stub.url + '/people/1') == {'id': 1}
+        assert stub.requests == ['/people/1', '/people/1']
+        assert api_access.concurrency.stats()['limit'] == 4
+
+    def test_should_give_up_after_max_retries(self):
+        with TVMaze_Stub() as stub:
+            stub.route('/people/1', b'Too Many Requests', status=429)
+            api_access = self.client(stub)
+            api_access.max_retries = 2
+            with self.assertRaises(requests.HTTPError):
+                api_access.get_json(stub.url + '/people/1')
+        assert len(stub.requests) == 3
+
+    def test_should_time_out_slow_calls(self):
+        with TVMaze_Stub(latency=0.5) as stub:
+            api_access = self.client(stub)
+            api_access.timeout = 0.1
+            api_access.max_retries = 0
+            with self.assertRaises(requests.Timeout):
+                api_access.get_json(stub.url + '/people/1')
+
+    def test_should_shrink_and_grow_concurrency(self):
+        limiter = Adaptive_Limiter(1, 8, cooldown=0)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(throttled=True)
+        assert limiter.stats()['limit'] == 1
+        for _ in range(40):
+            limiter.acquire()
+            limiter.release()
+        assert limiter.stats()['limit'] == 8
+
+
+class TestHTTPResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        TVMaze_API_Access.cache = None
+        self.tmpdir.cleanup()
+
+    def test_should_serve_repeated_imports_from_cache(self):
+        with TVMaze_Stub() as stub:
+            stub.add_person(3, 'Emilia Clarke', ['Game of Thrones', 'Dead Ringers'])
+            TVMaze_API_Access.cache = HTTP_Response_Cache(self.path)
+            TVMaze_API_Access(stub.url + '/search/people?q=').get_actor('Emilia Clarke')
+            fetched = len(stub.requests)
+            # a fresh cache instance on the same file behaves like a restarted server
+            TVMaze_API_Access.cache = HTTP_Response_Cache(self.path)
+            actor = TVMaze_API_Access(stub.url + '/search/people?q=').get_actor('Emilia Clarke')
+
+        assert fetched == 4
+        assert len(stub.requests) == 4
+        assert [show.name for show in actor.shows] == ['Game of Thrones', 'Dead Ringers']
+        assert TVMaze_API_Access.cache_stats()['hits'] == 4
+
+    def test_should_revalidate_expired_entries(self):
+        def show(handler):
+            if handler.headers.get('If-None-Match') == '"v1"':
+                return 304, b'', {'ETag': '"v1"'}
+            return 200, {'id': 1, 'name': 'Friends'}, {'ETag': '"v1"'}
+
+        with TVMaze_Stub() as stub:
+            stub.routes['/shows/1'] = show
+            TVMaze_API_Access.cache = HTTP_Response_Cache(self.path, ttl_rules=[('/shows/', 0)])
+            api_access = TVMaze_API_Access(stub.url + '/search/people?q=')
+            assert api_access.get_json(stub.url + '/shows/1')['name'] == 'Friends'
+            assert api_access.get_json(stub.url + '/shows/1')['name'] == 'Friends'
+
+        stats = TVMaze_API_Access.cache_stats()
+        assert stats['misses'] == 2
+        assert stats['revalidations'] == 1
+
+    def test_should_evict_least_recently_used_entries(self):
+        cache = HTTP_Response_Cache(self.path, max_bytes=20)
+        cache.store('http://x/shows/1', b'0123456789')
+        cache.store('http://x/shows/2', b'0123456789')
+        cache.lookup('http://x/shows/1')
+        cache.store('http://x/shows/3', b'0123456789')
+
+        assert cache.lookup('http://x/shows/2') == (None, False)
+        assert cache.lookup('http://x/shows/1')[1]
+        assert cache.stats()['evictions'] == 1
+
+
+class TestTVMazeSyncWorker(unittest.TestCase):
+    def setUp(self):
+        self.stub = TVMaze_Stub().__enter__()
+        self.api_url = app.config['TVMAZE_API_URL']
+        app.config['TVMAZE_API_URL'] = self.stub.url
+        db.create_all()
+        self.worker = TVMaze_Sync_Worker(app, batch_size=1, batch_interval=0)
+
+    def tearDown(self):
+        app.config['TVMAZE_API_URL'] = self.api_url
+        self.stub.__exit__(None, None, None)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def test_should_refresh_only_changed_stored_actors(self):
+        now = int(time.time())
+        for person_id, name in [(1, 'Brad Pitt'), (2, 'Alan Rickman'), (3, 'Emilia Clarke')]:
+            Actor(person_id, name, 'United States', 'Male', dt.date(1950, 1, 1), None).save_to_db()
+        self.stub.add_person(2, 'Alan Rickman', ['Die Hard'], country='United Kingdom', deathday='2016-01-14')
+        self.stub.add_person(3, 'Emilia Clarke', ['Game of Thrones'], country='United Kingdom', gender='Female')
+        self.stub.route('/updates/people', {'2': now - 10, '3': now - 5, '99': now})
+
+        report = self.worker.run_once()
+        assert report['changed'] == 3
+        assert report['updated'] == 2
+        assert report['checkpoint'] == now
+        assert SyncCheckpoint.get(CHECKPOINT_NAME) == now
+        assert '/people/1' not in self.stub.requests
+        assert '/people/99' not in self.stub.requests
+        rickman = Actor.find_by_actorid(2)
+        assert rickman.deathday == dt.date(2016, 1, 14)
+        assert rickman.country == 'United Kingdom'
+        assert [show.name for show in rickman.shows] == ['Die Hard']
+
+        # the next run asks for the daily feed and finds nothing new
+        self.stub.route('/updates/people?since=day', {'2': now - 10, '3': now - 5, '99': now})
+        fetched = len(self.stub.requests)
+        report = self.worker.run_once()
+        assert report['updated'] == 0
+        assert len(self.stub.requests) == fetched + 1
+
+    def test_should_keep_checkpoint_before_failed_actor(self):
+        now = int(time.time())
+        Actor(2, 'Alan Rickman', None, None, None, None).save_to_db()
+        Actor(3, 'Emilia Clarke', None, None, None, None).save_to_db()
+        self.stub.add_person(2, 'Alan Rickman', [])
+        self.stub.route('/updates/people', {'2': now - 10, '3': now - 5})
+
+        report = self.worker.run_once()
+        assert report['updated'] == 1
+        assert report['failed'] == 1
+        assert SyncCheckpoint.get(CHECKPOINT_NAME) == now - 6
+
+    def test_should_not_skip_actors_sharing_a_timestamp(self):
+        now = int(time.time())
+        for person_id, name in [(2, 'Alan Rickman'), (3, 'Emilia Clarke'), (4, 'Brad Pitt')]:
+            Actor(person_id, name, None, None, None, None).save_to_db()
+            self.stub.add_person(person_id, name, [])
+        self.stub.route('/updates/people', {'2': now - 10, '3': now - 10, '4': now - 5})
+
+        # stopped after the first batch, half way through the actors updated at now - 10
+        self.worker.stop_event.set()
+        report = self.worker.run_once()
+        assert report['updated'] == 1
+        assert SyncCheckpoint.get(CHECKPOINT_NAME) == now - 11
+
+        self.worker.stop_event.clear()
+        self.stub.route('/updates/people?since=day', {'2': now - 10, '3': now - 10, '4': now - 5})
+        report = self.worker.run_once()
+        assert report['updated'] == 3
+        assert SyncCheckpoint.get(CHECKPOINT_NAME) == now - 5
+        # the tied actor fetched before the stop is fetched again, the other one is not lost
+        assert sorted(self.stub.requests.count('/people/{}'.format(i)) for i in (2, 3)) == [1, 2]
+        assert self.stub.requests.count('/people/4') == 1
+
+
+    def test_should_keep_links_when_a_show_cannot_be_fetched(self):
+        now = int(time.time())
+        Actor(2, 'Alan Rickman', None, None, None, None).save_to_db()
+        self.stub.add_person(2, 'Alan Rickman', ['Die Hard', 'Dogma', 'Galaxy Quest'])
+        self.stub.route('/updates/people', {'2': now - 10})
+        assert self.worker.run_once()['updated'] == 1
+        assert sorted(show.name for show in Actor.find_by_actorid(2).shows) == ['Die Hard', 'Dogma', 'Galaxy Quest']
+
+        self.stub.route('/shows/2001', {'name': 'Service Unavailable'}, status=503)
+        self.stub.route('/updates/people?since=day', {'2': now - 5})
+        max_retries = TVMaze_API_Access.max_retries
+        TVMaze_API_Access.max_retries = 0
+        try:
+            report = self.worker.run_once()
+        finally:
+            TVMaze_API_Access.max_retries = max_retries
+        assert (report['updated'], report['failed']) == (0, 1)
+        assert SyncCheckpoint.get(CHECKPOINT_NAME) == now - 6
+        assert sorted(show.name for show in Actor.find_by_actorid(2).shows) == ['Die Hard', 'Dogma', 'Galaxy Quest']
+
+
+class TestRenderPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = Render_Pool(processes=1, timeout=5, max_queue=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_should_render_png_in_worker_process(self):
+        png = self.pool.render({'by-gender': {'Male': 50.0, 'Female': 50.0}})
+        assert png.startswith(b'\x89PNG')
+
+    def test_should_replace_pool_after_timeout(self):
+        self.pool.timeout = 0.5
+        with self.assertRaises(Render_Timeout):
+            self.pool.submit(time.sleep, 5)
+        self.pool.timeout = 5
+        assert self.pool.submit(abs, -3) == 3
+
+    def test_should_only_replace_pool_of_timed_out_job(self):
+        self.pool = Render_Pool(processes=2, timeout=5, max_queue=4)
+        assert self.pool.submit(abs, -1) == 1
+        self.pool.timeout = 1
+        outcomes = {}
+        def run(name, seconds):
+            start = time.perf_counter()
+            try:
+                self.pool.submit(time.sleep, seconds)
+                outcomes[name] = ('done', time.perf_counter() - start)
+            except Render_Timeout:
+                outcomes[name] = ('timeout', time.perf_counter() - start)
+        stuck = threading.Thread(target=run, args=('stuck', 5))
+        stuck.start()
+        time.sleep(0.5)
+        # runs in the pool the stuck job takes down, fails as soon as that happens
+        killed = threading.Thread(target=run, args=('killed', 0.9))
+        killed.start()
+        stuck.join()
+        killed.join()
+        self.pool.timeout = 5
+        run('after', 0.3)
+        assert outcomes['stuck'][0] == 'timeout'
+        assert outcomes['killed'][0] == 'timeout' and outcomes['killed'][1] < 0.9
+        assert outcomes['after'][0] == 'done'
+
+    def test_should_fork_workers(self):
+        assert self.pool.get_pool()._ctx.get_start_method() == 'fork'
+
+    def test_should_refuse_jobs_when_saturated(self):
+        self.pool.max_queue = 0
+        with self.assertRaises(Render_Pool_Saturated):
+            self.pool.render({'by-gender': {'Male': 100.0}})
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_should_not_import_visualisation_stack_at_startup(self):
+        from benchmarks.bench_import import probe
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result = probe('sqlite:///' + os.path.join(tmpdir, 'startup.db'))
+        assert result['heavy_modules'] == []
+
+
+class TestEndpointBenchmark(unittest.TestCase):
+    def test_should_time_every_endpoint(self):
+        from benchmarks.bench_endpoints import compare, measure
+        result = measure(actors=200, requests=3, latency=0)
+        assert len(result['endpoints']) == 17
+        for endpoint in result['endpoints']:
+            assert endpoint['errors'] == 0, endpoint
+            assert endpoint['p50_ms'] <= endpoint['p95_ms'] <= endpoint['p99_ms']
+        assert result['peak_rss_kb'] > 0
+        assert compare(result, result, 0) == []
+        baseline = dict(result, endpoints=result['endpoints'][1:])
+        assert compare(result, baseline, 0) == ['list first page has no baseline entry']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,369 @@
+import os
+import datetime as dt
+import random
+import sqlite3
+import tempfile
+import time
+import unittest
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from sqlalchemy import create_engine, event, inspect
+from tv_maze_db_api import app, db
+from tv_maze_db_api.graph import Costar_Graph
+from tv_maze_db_api.migrations import SCHEMA_VERSION, migrate
+from tv_maze_db_api.model import Actor, ActorJob, ActorStatistic, Show
+
+app_ctxt = app.app_context()
+
+
+def setUpModule():
+    app_ctxt.push()
+
+
+def tearDownModule():
+    app_ctxt.pop()
+
+
+class ModelTestCase(unittest.TestCase):
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        Show.clear_name_ids()
+
+    def count_queries(self, func):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, statements
+
+    def query_plans(self, func):
+        # EXPLAIN QUERY PLAN of every statement func runs, as (statement, [plan details])
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        with db.engine.connect() as connection:
+            return [(statement, [row[3] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)])
+                    for statement, parameters in statements]
+
+
+class TestShowResolution(ModelTestCase):
+    def test_should_resolve_show_names_in_one_lookup(self):
+        db.session.add(Show(name='Friends'))
+        db.session.commit()
+
+        shows, statements = self.count_queries(lambda: Show.resolve_shownames(['Glee', 'Friends', 'Glee']))
+        assert [show.name for show in shows] == ['Glee', 'Friends']
+        # lookup, insert of the missing name, id lookup and entity load
+        assert len(statements) == 4
+        db.session.commit()
+
+        shows, statements = self.count_queries(lambda: Show.resolve_shownames(['Friends', 'Glee']))
+        assert [show.name for show in shows] == ['Friends', 'Glee']
+        # names are cached, only the entities are loaded
+        assert len(statements) == 1
+
+    def test_should_not_duplicate_shows(self):
+        first = Show.resolve_shownames(['Friends'])[0]
+        db.session.commit()
+        Show.clear_name_ids()
+        # an upsert of a name another import already stored keeps a single row
+        db.session.execute(db.text("INSERT INTO tv_shows (name) VALUES ('Glee')"))
+        assert Show.resolve_shownames(['Glee', 'Friends'])[1].id == first.id
+        db.session.commit()
+        assert Show.query.count() == 2
+
+    def test_should_insert_shows_without_unique_index(self):
+        # tv_shows as created before names were unique, until the schema upgrade adds the index
+        db.session.execute(db.text('DROP TABLE tv_shows'))
+        db.session.execute(db.text('CREATE TABLE tv_shows (id INTEGER NOT NULL, name VARCHAR, PRIMARY KEY (id))'))
+        first = Show.resolve_shownames(['Friends', 'Glee'])
+        db.session.commit()
+        Show.clear_name_ids()
+        assert [show.id for show in Show.resolve_shownames(['Glee', 'Friends'])] == [first[1].id, first[0].id]
+        assert Show.query.count() == 2
+
+    def test_should_invalidate_cache_on_rollback(self):
+        Show.resolve_shownames(['Friends'])
+        assert 'Friends' in Show.name_ids
+        db.session.rollback()
+        assert Show.name_ids == {}
+        actor = Actor(1, 'Brad Pitt', None, None, None, None)
+        actor.shows = Show.resolve_shownames(['Friends'])
+        actor.save_to_db()
+        assert [show.name for show in Actor.find_by_actorid(1).shows] == ['Friends']
+
+
+class TestActorStatistics(ModelTestCase):
+    def test_should_maintain_counts_on_every_write(self):
+        Actor(1, 'Brad Pitt', 'United States', 'Male', dt.date(1963, 12, 18), None).save_to_db()
+        Actor.save_all_to_db([
+            Actor(2, 'Emilia Clarke', 'United Kingdom', 'Female', dt.date(1986, 10, 23), None),
+            Actor(3, 'Alan Rickman', 'United Kingdom', 'Male', dt.date(1946, 2, 21), None)])
+        assert ActorStatistic.total() == 3
+        assert ActorStatistic.count_by_group('country') == [('United Kingdom', 2), ('United States', 1)]
+
+        actor = Actor.find_by_actorid(3)
+        actor.deathday = dt.date(2016, 1, 14)
+        actor.birthday = dt.date(1946, 3, 21)
+        actor.save_to_db()
+        assert dict(ActorStatistic.count_by_group('life_status')) == {'Alive': 2, 'Dead': 1}
+        assert 'February' not in dict(ActorStatistic.count_by_group('birth_month'))
+        assert dict(ActorStatistic.count_by_group('birth_month'))['March'] == 1
+
+        Actor.find_by_actorid(1).delete_from_db()
+        assert ActorStatistic.total() == 2
+        assert ActorStatistic.count_by_group('country') == [('United Kingdom', 2)]
+        assert ActorStatistic.check() == []
+
+    def test_should_rebuild_drifted_counts(self):
+        Actor(1, 'Brad Pitt', 'United States', 'Male', None, None).save_to_db()
+        db.session.execute(db.text("UPDATE actor_statistics SET count = 7 WHERE dimension = 'gender'"))
+        db.session.commit()
+        assert ActorStatistic.check() == [('gender', 'Male', 7, 1)]
+        ActorStatistic.rebuild()
+        assert ActorStatistic.check() == []
+
+    def test_should_read_statistics_without_scanning_actors(self):
+        Actor(1, 'Brad Pitt', 'United States', 'Male', None, None).save_to_db()
+        _, statements = self.count_queries(lambda: ActorStatistic.count_by_group('gender'))
+        assert len(statements) == 1
+        assert 'actors ' not in statements[0]
+
+
+class TestQueryPlans(ModelTestCase):
+    # tables that stay a few hundred rows at most, scanning them is cheaper than an index
+    SMALL_TABLES = ('actor_statistics', 'table_versions', 'sync_checkpoints')
+
+    def setUp(self):
+        super().setUp()
+        for i in range(1, 21):
+            actor = Actor(i, 'Actor {}'.format(i), 'United States', 'Male', dt.date(1970, 1, 1), None)
+            actor.shows = Show.resolve_shownames(['Show {}'.format(i % 3)])
+            db.session.add(actor)
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE'))
+
+    def assert_no_table_scan(self, func):
+        plans = self.query_plans(func)
+        assert plans
+        for statement, details in plans:
+            for detail in details:
+                words = detail.split()
+                if words[0] == 'SCAN' and 'USING' not in words and words[1] not in self.SMALL_TABLES + ('CONSTANT',):
+                    raise AssertionError('{} in {}'.format(detail, statement))
+
+    def test_should_seek_actor_lookups(self):
+        self.assert_no_table_scan(lambda: Actor.find_by_actorid(3))
+        self.assert_no_table_scan(lambda: Actor.find_by_actorids([3, 4]))
+        self.assert_no_table_scan(lambda: Actor.find_detail(3))
+        self.assert_no_table_scan(lambda: Actor.find_validators(3))
+        self.assert_no_table_scan(lambda: [show.name for show in Actor.find_by_actorid(5).shows])
+
+    def test_should_seek_show_lookups(self):
+        self.assert_no_table_scan(lambda: Show.find_by_showname('Show 1'))
+        self.assert_no_table_scan(lambda: Show.find_ids_by_shownames(['Show 1', 'Show 2']))
+        self.assert_no_table_scan(lambda: db.session.query(Show.id).join(Actor.shows).filter(Show.id == 1).count())
+
+    def test_should_count_recent_updates_from_index(self):
+        self.assert_no_table_scan(lambda: Actor.count_by_last_updated(dt.datetime.now() - dt.timedelta(days=1)))
+
+    def test_should_page_through_actors_by_index(self):
+        for order in ('+name', '-name', '+country', '-gender', '-last_update', '+id', '-id'):
+            _, cursor = Actor.filter_and_sort_columns_with_pagination(order, 'name', 0, 5)
+            self.assert_no_table_scan(lambda: Actor.filter_and_sort_columns_with_pagination(order, 'name', 0, 5, cursor))
+
+    def test_should_seek_writes(self):
+        ActorJob.enqueue('Brad Pitt')
+        self.assert_no_table_scan(ActorJob.claim_next)
+        self.assert_no_table_scan(lambda: Actor.find_by_actorid(7).delete_from_db())
+
+
+class TestActorListQuery(ModelTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(1, 8):
+            db.session.add(Actor(i, 'Actor {}'.format(i), None if i % 2 else 'Canada', 'Male', dt.date(1970, 1, i), None))
+        db.session.commit()
+
+    def test_should_select_only_requested_columns(self):
+        (rows, cursor), statements = self.count_queries(lambda: Actor.filter_and_sort_columns_with_pagination('-country', 'name,birthday', 0, 3))
+        assert [tuple(row) for row in rows] == [('Actor 2', '1970-01-02', 'Canada', 2), ('Actor 4', '1970-01-04', 'Canada', 4),
+                                                ('Actor 6', '1970-01-06', 'Canada', 6)]
+        assert len(statements) == 1
+        assert 'last_update' not in statements[0] and 'actors.actor_id' not in statements[0]
+        rows, _ = Actor.filter_and_sort_columns_with_pagination('-country', 'name,birthday', 0, 3, cursor)
+        assert [row[0] for row in rows] == ['Actor 1', 'Actor 3', 'Actor 5']
+
+    def test_should_reuse_statement_per_filter_and_order(self):
+        Actor.list_statements.clear()
+        _, cursor = Actor.filter_and_sort_columns_with_pagination('+id', 'id,name', 0, 2)
+        statement = Actor.list_statements[(('id', 'name'), '+id', None)]
+        Actor.filter_and_sort_columns_with_pagination('+id', ' name , id,name', 2, 2)
+        Actor.filter_and_sort_columns_with_pagination('+id', 'id,name', 0, 2, cursor)
+        Actor.filter_and_sort_columns_with_pagination('+id', 'id,name', 0, 2, cursor)
+        assert Actor.list_statements[(('id', 'name'), '+id', None)] is statement
+        assert len(Actor.list_statements) == 3
+
+    def test_should_reject_unknown_columns(self):
+        for select in ('id,password', 'id,shows', 'count(*)'):
+            with self.assertRaises(ValueError):
+                Actor.filter_and_sort_columns_with_pagination('+id', select, 0, 2)
+
+
+class TestSchemaMigration(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'old.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_should_upgrade_original_schema(self):
+        # the tables as the first release created them, with a show stored twice
+        connection = sqlite3.connect(self.path)
+        connection.executescript('''
+            CREATE TABLE tv_shows (id INTEGER NOT NULL, name VARCHAR, PRIMARY KEY (id));
+            CREATE TABLE actors (id INTEGER NOT NULL, actor_id INTEGER, name VARCHAR, country VARCHAR, gender VARCHAR,
+                last_update DATETIME, birthday DATE, deathday DATE, PRIMARY KEY (id), UNIQUE (actor_id));
+            CREATE TABLE show_actor_association (show_id INTEGER, actor_id INTEGER,
+                FOREIGN KEY(show_id) REFERENCES tv_shows (id), FOREIGN KEY(actor_id) REFERENCES actors (id));
+            INSERT INTO tv_shows VALUES (1, 'Friends'), (2, 'Glee'), (3, 'Friends');
+            INSERT INTO actors (id, actor_id, name) VALUES (1, 10, 'Brad Pitt'), (2, 20, 'Jennifer Aniston');
+            INSERT INTO show_actor_association VALUES (1, 1), (2, 1), (3, 2), (3, 1), (1, 1);
+        ''')
+        connection.commit()
+        connection.close()
+
+        engine = create_engine('sqlite:///' + self.path)
+        db.metadata.create_all(engine)
+        assert migrate(engine) == list(range(1, SCHEMA_VERSION + 1))
+        assert migrate(engine) == []
+
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql('SELECT id, name FROM tv_shows ORDER BY id').fetchall() == [(1, 'Friends'), (2, 'Glee')]
+            assert connection.exec_driver_sql(
+                'SELECT actor_id, show_id FROM show_actor_association ORDER BY 1, 2').fetchall() == [(1, 1), (1, 2), (2, 1)]
+            # the search index is filled from the rows that were already there
+            assert connection.exec_driver_sql(
+                "SELECT rowid, shows FROM actor_search WHERE actor_search MATCH 'glee'").fetchall() == [(1, 'Friends | Glee')]
+        schema = inspect(engine)
+        assert schema.get_pk_constraint('show_actor_association')['constrained_columns'] == ['actor_id', 'show_id']
+        indexes = {index['name']: index for index in schema.get_indexes('actors') + schema.get_indexes('tv_shows')}
+        assert {'ix_actors_name', 'ix_actors_country', 'ix_actors_gender', 'ix_actors_last_update'} <= set(indexes)
+        assert indexes['ix_tv_shows_name']['unique']
+        engine.dispose()
+
+
+class TestCostarGraph(unittest.TestCase):
+    def random_graph(self, rng, actors, shows, edges):
+        pairs = {(rng.randint(1, actors), rng.randint(1, shows)) for _ in range(edges)}
+        graph = Costar_Graph(max_depth=50, compact_after=20)
+        Costar_Graph.load_numpy()
+        np = __import__('numpy')
+        graph.reset(np.array([a for a, _ in pairs], dtype=np.int64), np.array([s for _, s in pairs], dtype=np.int64), 0)
+        return graph, pairs
+
+    def distances(self, pairs, source):
+        # plain BFS over co-star links
+        shows_of, actors_of = {}, {}
+        for actor, show in pairs:
+            shows_of.setdefault(actor, set()).add(show)
+            actors_of.setdefault(show, set()).add(actor)
+        distance, frontier = {source: 0}, [source]
+        while frontier:
+            next_frontier = []
+            for actor in frontier:
+                for costar in {c for show in shows_of.get(actor, ()) for c in actors_of[show]}:
+                    if costar not in distance:
+                        distance[costar] = distance[actor] + 1
+                        next_frontier.append(costar)
+            frontier = next_frontier
+        return distance
+
+    def assert_valid_path(self, path, pairs, source, target):
+        assert path[0] == (source, None) and path[-1][0] == target
+        for (previous, _), (actor, show) in zip(path, path[1:]):
+            assert (previous, show) in pairs and (actor, show) in pairs
+
+    def test_should_find_shortest_paths(self):
+        rng = random.Random(7)
+        graph, pairs = self.random_graph(rng, 300, 200, 500)
+        for _ in range(100):
+            source, target = rng.randint(1, 300), rng.randint(1, 300)
+            distance = self.distances(pairs, source)
+            path = graph.path(source, target)
+            if target not in distance:
+                assert path is None
+            else:
+                assert len(path) - 1 == distance[target]
+                self.assert_valid_path(path, pairs, source, target)
+
+    def test_should_apply_changes_and_compact(self):
+        rng = random.Random(8)
+        graph, pairs = self.random_graph(rng, 100, 60, 200)
+        for version in range(120):
+            actor, show = rng.randint(1, 100), rng.randint(1, 60)
+            if version % 10 == 9:
+                # ids of removed actors and shows can come back with new links
+                pairs = {(a, s) for a, s in pairs if a != actor}
+                graph.apply([('remove_actor', actor, None)], version, version + 1)
+            elif version % 10 == 4:
+                pairs = {(a, s) for a, s in pairs if s != show}
+                graph.apply([('remove_show', None, show)], version, version + 1)
+            elif (actor, show) in pairs:
+                pairs.discard((actor, show))
+                graph.apply([('remove', actor, show)], version, version + 1)
+            else:
+                pairs.add((actor, show))
+                graph.apply([('add', actor, show)], version, version + 1)
+            assert graph.stats()['edges'] == len(pairs)
+        graph.apply([('remove_show', None, 1)], 120, 121)
+        pairs = {(a, s) for a, s in pairs if s != 1}
+        assert graph.stats()['edges'] == len(pairs)
+        for actor in range(1, 101):
+            expected = self.distances(pairs, actor)
+            ids, shared, total = graph.costars(actor, 0, 1000)
+            assert sorted(ids) == sorted(a for a, d in expected.items() if d == 1)
+            assert total == len(ids) and shared == sorted(shared, reverse=True)
+        # a version gap means another process wrote, the graph waits for the next query to catch up
+        graph.apply([('add', 1, 1)], 5, 6)
+        assert graph.version == 121
+        assert 1 not in graph.costars(1, 0, 1000)[0]
+
+    def test_should_remove_large_casts_at_once(self):
+        graph = Costar_Graph(max_depth=6, compact_after=10)
+        Costar_Graph.load_numpy()
+        np = __import__('numpy')
+        actors = np.arange(1, 200001, dtype=np.int64)
+        graph.reset(actors, actors % 2 + 1, 0)
+        start = time.perf_counter()
+        graph.apply([('remove_show', None, 1)], 0, 1)
+        assert time.perf_counter() - start < 0.5
+        assert graph.stats() == {'builds': 0, 'edges': 100000, 'overlay': 1}
+        assert graph.costars(2, 0, 10)[2] == 0 and graph.costars(1, 0, 10)[2] == 99999
+
+
+class TestMultiProcessLoad(unittest.TestCase):
+    def test_should_read_while_writing_without_locking_errors(self):
+        from benchmarks.bench_load import measure
+        result = measure([2], duration=1, actors=200)['results'][0]
+        assert result['reads_per_second'] > 0 and result['writes_per_second'] > 0
+        assert result['locked'] == 0 and result['errors'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# local stand-in for api.tvmaze.com so tests and benchmarks do not depend on the network
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+class TVMaze_Stub:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests.append(self.path)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                route = stub.routes.get(unquote(self.path))
+                if callable(route):
+                    route = route(self)
+                if route is None and self.path.startswith('/search/'):
+                    # like TV Maze, searches without a match are an empty list
+                    route = (200, [], {})
+                status, body, headers = (404, {'name': 'Not Found'}, {}) if route is None else route
+                payload = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, path, body, status=200, headers=None):
+        self.routes[path] = (status, body, headers or {})
+
+    def add_person(self, person_id, name, show_names, country='United States', gender='Male',
+                   birthday='1970-01-01', deathday=None, first_show_id=None):
+        person = {
+            'id': person_id,
+            'name': name,
+            'country': None if country is None else {'name': country},
+            'gender': gender,
+            'birthday': birthday,
+            'deathday': deathday,
+            'updated': 0,
+        }
+        self.route('/search/people?q=' + name, [{'score': 1.0, 'person': person}])
+        self.route('/people/{}'.format(person_id), person)
+        credits = []
+        show_id = person_id * 1000 if first_show_id is None else first_show_id
+        for show_name in show_names:
+            self.route('/shows/{}'.format(show_id), {'id': show_id, 'name': show_name})
+            credits.append({'_links': {'show': {'href': self.url + '/shows/{}'.format(show_id)}}})
+            show_id += 1
+        self.route('/people/{}/castcredits'.format(person_id), credits)
+        return person
@@ -1,13 +1,111 @@
 import os
 from flask import Flask
 from flask_restx import Api
-from .db import db
-from .controller import ns_actor
+from .db import db, engine_options_from_env, tune_sqlite
+from .graph import costar_graph
+from .controller import ns_actor, ns_job
+from .helper import Statistics_Helper, TVMaze_API_Access
+from . import metrics
+from .http_cache import HTTP_Response_Cache
+from .jobs import Actor_Job_Pool
+from .migrations import migrate
+from .model import Actor, Actor_Search_Index, ActorStatistic
+from .render import render_pool
+from .sync import TVMaze_Sync_Worker
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+app.config['TVMAZE_API_URL'] = os.environ.get('TVMAZE_API_URL', 'https://api.tvmaze.com')
+app.config['TVMAZE_CACHE_PATH'] = os.environ.get('TVMAZE_CACHE_PATH')
+app.config['ACTORS_ASYNC_CREATE'] = os.environ.get('ACTORS_ASYNC_CREATE', 'false')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options_from_env('DB')
+app.config['DB_READ_SPLIT'] = os.environ.get('DB_READ_SPLIT', 'false').lower() in ('1', 'true')
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:///') and ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+    # a second pool on the same file for GET requests, see DB_READ_SPLIT
+    app.config['SQLALCHEMY_BINDS'] = {
+        'read': dict(engine_options_from_env('DB_READ'), url=app.config['SQLALCHEMY_DATABASE_URI'])}
 db.init_app(app)
+if app.config['TVMAZE_CACHE_PATH']:
+    # relative cache paths live next to the sqlite database in the instance folder
+    TVMaze_API_Access.cache = HTTP_Response_Cache.from_env(
+        os.path.join(app.instance_path, app.config['TVMAZE_CACHE_PATH']))
 with app.app_context():
+    tune_sqlite(db.engine)
+    if 'read' in db.engines:
+        tune_sqlite(db.engines['read'], query_only=True)
+    metrics.init_app(app, db.engines.values())
     api = Api(app)
     api.add_namespace(ns_actor, path='/actors')
+    api.add_namespace(ns_job, path='/jobs')
     db.create_all()
+    migrate()
+    ActorStatistic.ensure_built()
+
+
+metrics.metrics.collector(metrics.stats_collector('tvmaze_cache', 'TV Maze response cache', TVMaze_API_Access.cache_stats))
+metrics.metrics.collector(metrics.stats_collector('actor_detail_cache', 'Actor detail cache', Actor.detail_cache.stats))
+metrics.metrics.collector(metrics.stats_collector('stats_image_cache', 'Statistics image cache', Statistics_Helper.image_cache.stats))
+metrics.metrics.collector(metrics.stats_collector('costar_graph', 'Co-star graph', costar_graph.stats))
+metrics.metrics.collector(metrics.stats_collector('tvmaze_in_flight', 'Concurrent TV Maze calls', TVMaze_API_Access.concurrency.stats))
+
+
+def prewarm():
+    # optional start up hook, e.g. gunicorn post_worker_init, for workers that serve statistics images
+    if render_pool.processes > 0:
+        render_pool.start()
+    else:
+        Statistics_Helper.load_viz_stack()
+
+
+if os.environ.get('PREWARM_STATS', '').lower() in ('1', 'true'):
+    prewarm()
+
+
+sync_worker = TVMaze_Sync_Worker(app)
+if os.environ.get('TVMAZE_SYNC_INTERVAL'):
+    # run the background re-sync in this process, enable it in one process per database only
+    sync_worker.start(float(os.environ['TVMAZE_SYNC_INTERVAL']))
+
+
+# workers start with the first queued job, ACTOR_JOB_WORKERS=0 leaves the queue to `flask run-actor-jobs`
+actor_job_pool = Actor_Job_Pool(app)
+app.extensions['actor_job_pool'] = actor_job_pool
+
+
+@app.cli.command('run-actor-jobs')
+def run_actor_jobs():
+    # drain the actor job queue in the foreground, for a dedicated worker process
+    actor_job_pool.workers = max(1, actor_job_pool.workers)
+    actor_job_pool.ensure_started()
+    for thread in actor_job_pool.threads:
+        thread.join()
+
+
+@app.cli.command('sync-actors')
+def sync_actors():
+    # refresh the stored actors TV Maze changed since the last checkpoint, e.g. from cron
+    print(sync_worker.run_once())
+
+
+@app.cli.command('rebuild-statistics')
+def rebuild_statistics():
+    # recompute the materialised actor statistics from the actors table
+    print('Rebuilt {} statistics buckets.'.format(ActorStatistic.rebuild()))
+
+
+@app.cli.command('check-statistics')
+def check_statistics():
+    drifted = ActorStatistic.check()
+    for dimension, bucket, stored, expected in drifted:
+        print('{} {}: stored {}, expected {}'.format(dimension, bucket, stored, expected))
+    print('Statistics are consistent.' if not drifted else '{} buckets drifted.'.format(len(drifted)))
+    if drifted:
+        raise SystemExit(1)
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    # refill the actor search tables from the actors, shows and their associations
+    with db.engine.begin() as connection:
+        Actor_Search_Index.rebuild(connection)
+    print('Rebuilt the search index for {} actors.'.format(Actor.count()))
@@ -1,15 +1,23 @@
+import csv
 import datetime as dt
-import pandas as pd
-from flask import Response
+import hashlib
+import io
+import json
+from flask import Response, current_app, request, stream_with_context
 from flask_restx import Resource, Namespace
+from .graph import costar_graph
 from .helper import TVMaze_API_Access, Statistics_Helper
-from .model import Actor, Show
+from .metrics import span
+from .model import Actor, Actor_Search_Index, ActorJob, ActorStatistic, Show, TableVersion
+from .render import Render_Pool_Saturated, Render_Timeout, render_pool
 
 ns_actor = Namespace('Actors', description='actor related operations')
+ns_job = Namespace('Jobs', description='queued actor creation jobs')
 
 ### payloads
 actor_create_payload = ns_actor.parser()
 actor_create_payload.add_argument('name', type=str, location='args', help='actor name')
+actor_create_payload.add_argument('async', type=str, location='args', help='true to queue the lookup and return 202')
 
 actor_patch_payload = ns_actor.parser()
 actor_patch_payload.add_argument('name', type=str, location='args', help='actor name')
@@ -22,17 +30,54 @@ actors_get_payload.add_argument('order', type=str, location='args', help='sortin
 actors_get_payload.add_argument('page', type=int, location='args', help='page to display')
 actors_get_payload.add_argument('size', type=int, location='args', help='size of page')
 actors_get_payload.add_argument('filter', type=str, location='args', help='actor attributes to display')
+actors_get_payload.add_argument('cursor', type=str, location='args', help='opaque position returned in the next link')
+actors_get_payload.add_argument('count', type=str, location='args', help='false to skip counting the total')
+
+actors_export_payload = ns_actor.parser()
+actors_export_payload.add_argument('format', type=str, location='args', help='ndjson or csv')
+actors_export_payload.add_argument('order', type=str, location='args', help='sorting method')
+actors_export_payload.add_argument('filter', type=str, location='args', help='actor attributes to export, shows for the show names')
+
+actors_search_payload = ns_actor.parser()
+actors_search_payload.add_argument('q', type=str, location='args', help='words or word prefixes of a name, country or show')
+actors_search_payload.add_argument('page', type=int, location='args', help='page to display')
+actors_search_payload.add_argument('size', type=int, location='args', help='size of page')
+
+actor_costars_payload = ns_actor.parser()
+actor_costars_payload.add_argument('page', type=int, location='args', help='page to display')
+actor_costars_payload.add_argument('size', type=int, location='args', help='size of page')
 
 actors_stats_payload = ns_actor.parser()
 actors_stats_payload.add_argument('format', type=str, location='args', help='json or image return type')
 actors_stats_payload.add_argument('by', type=str, location='args', help='actor attribute')
 ### payloads
 
+def not_modified(etag: str, last_modified: dt.datetime):
+    # 304 response when the request's validators still match, otherwise None
+    headers = {'ETag': '"{}"'.format(etag), 'Cache-Control': 'no-cache'}
+    if last_modified is not None:
+        # HTTP dates have whole seconds, round up so a later write always moves past the date a client holds;
+        # a date still ahead of now could hide writes later in the same second, so none is sent until it passes
+        if last_modified.microsecond:
+            last_modified = last_modified.replace(microsecond=0) + dt.timedelta(seconds=1)
+        if last_modified > dt.datetime.now(dt.timezone.utc):
+            last_modified = None
+    if last_modified is not None:
+        headers['Last-Modified'] = last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    if request.if_none_match:
+        matches = request.if_none_match.contains_weak(etag)
+    else:
+        matches = request.if_modified_since is not None and last_modified is not None \
+            and last_modified <= request.if_modified_since
+    return Response(status=304, headers=headers) if matches else None, headers
+
+
 @ns_actor.route('/')
 class Actors(Resource):
     
     @ns_actor.expect(actors_get_payload)
     @ns_actor.doc("Get list of actors.")
+    @ns_actor.response(304, 'Actors list not modified')
     @ns_actor.response(404, 'No actors in the database')
     @ns_actor.response(400, 'Error retrieving actors from the database')
     def get(self):
@@ -42,21 +87,31 @@ class Actors(Resource):
             size = 10 if args['size'] is None else args['size']
             filter = 'id,name' if args['filter'] is None else args['filter']
             order = '+id' if args['order'] is None else args['order']
+            if page < 1 or size < 1:
+                raise ValueError('page and size start at 1')
             start = size * (page - 1)
-            stop = page * size
-            total_actors = len(Actor.get_all())
-            if total_actors > 0:
-                actors = Actor.filter_and_sort_columns_with_pagination(order, filter, start, stop)
-                return Actor.actor_list_json(
-                    actors, 
-                    page, 
-                    size, 
-                    stop, 
-                    total_actors, 
-                    order, 
-                    filter), 200
-            else:
+            # every page changes only with the actors table version
+            version, updated_at = TableVersion.get(Actor.__tablename__)
+            tag = '{}|{}|{}|{}'.format(request.host, request.query_string.decode(), version, updated_at)
+            last_modified = None if updated_at is None else updated_at.astimezone(dt.timezone.utc)
+            response, headers = not_modified(hashlib.sha1(tag.encode()).hexdigest(), last_modified)
+            if response is not None:
+                return response
+            # counting can be skipped by clients that only follow the next links
+            total_actors = None if str(args['count']).lower() == 'false' else Actor.count()
+            if total_actors == 0:
                 return 'There are no actors in the database.', 404
+            actors, next_cursor = Actor.filter_and_sort_columns_with_pagination(order, filter, start, size, args['cursor'])
+            if total_actors is None and len(actors) == 0 and not args['cursor']:
+                return 'There are no actors in the database.', 404
+            return Actor.actor_list_json(
+                actors, 
+                page, 
+                size, 
+                next_cursor, 
+                total_actors, 
+                order, 
+                filter), 200, headers
         except Exception as msg:
             return 'There was an error in retrieving actors list: {}.'.format(msg), 400
 
@@ -72,7 +127,9 @@ class Actors(Resource):
             # ensure clean input data (convert special characters to space)
             args = actor_create_payload.parse_args()
             arg_name = args['name']
-            api_access = TVMaze_API_Access('https://api.tvmaze.com/search/people?q=')
+            if (args['async'] or str(current_app.config['ACTORS_ASYNC_CREATE'])).lower() in ('1', 'true'):
+                return self.enqueue(arg_name)
+            api_access = TVMaze_API_Access(current_app.config['TVMAZE_API_URL'] + '/search/people?q=')
             actor = api_access.get_actor(arg_name)
         except Exception as msg:
             print('There was an error in processing: {}.'.format(msg))
@@ -81,23 +138,190 @@ class Actors(Resource):
         else:
             actor.save_to_db()
             return actor.created_json(), 201
+
+    @staticmethod
+    def enqueue(name: str):
+        if not name:
+            return 'Actor name is required.', 400
+        job = ActorJob.enqueue(name)
+        pool = current_app.extensions['actor_job_pool']
+        pool.ensure_started()
+        pool.notify()
+        job_json = job.json()
+        return job_json, 202, {'Location': job_json['_links']['self']['href']}
         
 
+@ns_actor.route('/bulk')
+class ActorsBulk(Resource):
+
+    @staticmethod
+    def read_items(key: str):
+        # NDJSON bodies are read line by line so large uploads are never held in memory at once
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            for line in request.stream:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            payload = request.get_json()
+            yield from payload[key] if isinstance(payload, dict) else payload
+
+    @staticmethod
+    def read_names():
+        for item in ActorsBulk.read_items('names'):
+            yield item['name'] if isinstance(item, dict) else item
+
+    @ns_actor.doc("Add many actors to database. Accepts a JSON list of names, {\"names\": [...]} or NDJSON lines.")
+    @ns_actor.response(200, 'Import report')
+    @ns_actor.response(400, 'Actors cannot be added')
+    def post(self):
+        try:
+            api_access = TVMaze_API_Access(current_app.config['TVMAZE_API_URL'] + '/search/people?q=')
+            report = api_access.import_actors(name.strip() for name in ActorsBulk.read_names())
+        except Exception as msg:
+            return 'There was an error in processing: {}.'.format(msg), 400
+        return Actor.bulk_report_json(report), 200
+
+    @ns_actor.doc("Change many actors in one transaction. Accepts a JSON list of {\"id\": ..., field: value} changes, {\"actors\": [...]} or NDJSON lines.")
+    @ns_actor.response(200, 'Outcome per actor')
+    @ns_actor.response(400, 'Actors cannot be updated')
+    def patch(self):
+        try:
+            report = []
+            changes = {}
+            for item in ActorsBulk.read_items('actors'):
+                try:
+                    id, change = Actor.parse_bulk_change(item)
+                    if id in changes:
+                        raise ValueError('actor {} is changed twice'.format(id))
+                    changes[id] = change
+                    report.append({'id': id, 'status': None})
+                except ValueError as msg:
+                    id = item.get('id') if isinstance(item, dict) and type(item.get('id')) is int else None
+                    report.append({'id': id, 'status': 'invalid', 'message': str(msg)})
+            with span('bulk_write'):
+                updated = set(Actor.bulk_update(changes))
+        except Exception as msg:
+            return 'There was an error in processing: {}.'.format(msg), 400
+        for entry in report:
+            if entry['status'] is None:
+                entry['status'] = 'updated' if entry['id'] in updated else 'not-found'
+        return Actor.bulk_changes_json(report), 200
+
+    @ns_actor.doc("Delete many actors in one transaction. Accepts a JSON list of ids, {\"ids\": [...]} or NDJSON lines.")
+    @ns_actor.response(200, 'Outcome per actor')
+    @ns_actor.response(400, 'Actors cannot be deleted')
+    def delete(self):
+        try:
+            report = []
+            ids = {}
+            for item in ActorsBulk.read_items('ids'):
+                id = item.get('id') if isinstance(item, dict) else item
+                if type(id) is not int:
+                    report.append({'id': None, 'status': 'invalid', 'message': 'ids must be integers, not {}'.format(json.dumps(id))})
+                elif id not in ids:
+                    ids[id] = True
+                    report.append({'id': id, 'status': None})
+            with span('bulk_write'):
+                deleted = set(Actor.bulk_delete(list(ids)))
+        except Exception as msg:
+            return 'There was an error in processing: {}.'.format(msg), 400
+        for entry in report:
+            if entry['status'] is None:
+                entry['status'] = 'deleted' if entry['id'] in deleted else 'not-found'
+        return Actor.bulk_changes_json(report), 200
+
+
+@ns_actor.route('/export')
+class ActorsExport(Resource):
+
+    @staticmethod
+    def export_value(value):
+        return value.isoformat() if isinstance(value, (dt.date, dt.datetime)) else value
+
+    @staticmethod
+    def ndjson_lines(chunks):
+        for rows in chunks:
+            yield ''.join(json.dumps({k: ActorsExport.export_value(v) for k, v in row.items()}) + '\n' for row in rows)
+
+    @staticmethod
+    def csv_lines(columns, chunks):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in chunks:
+            for row in rows:
+                writer.writerow(['|'.join(v) if isinstance(v, list) else ActorsExport.export_value(v) for v in row.values()])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    @ns_actor.doc("Stream every actor as NDJSON or CSV.")
+    @ns_actor.expect(actors_export_payload)
+    @ns_actor.response(400, 'Error exporting actors')
+    def get(self):
+        args = actors_export_payload.parse_args()
+        format = 'ndjson' if args['format'] is None else args['format'].lower()
+        filter = 'id,name' if args['filter'] is None else args['filter']
+        order = '+id' if args['order'] is None else args['order']
+        try:
+            # validate before the first byte goes out, errors cannot change the status of a started stream
+            columns = Actor.export_columns(filter)
+            Actor.parse_sort(order)
+        except ValueError as msg:
+            return 'There was an error in exporting actors: {}.'.format(msg), 400
+        chunks = Actor.export_chunks(order, columns)
+        if format == 'ndjson':
+            return Response(stream_with_context(self.ndjson_lines(chunks)), mimetype='application/x-ndjson')
+        elif format == 'csv':
+            return Response(stream_with_context(self.csv_lines(columns, chunks)), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=actors.csv'})
+        return 'Selected format is not accepted.', 400
+
+
+@ns_actor.route('/search')
+class ActorsSearch(Resource):
+
+    @ns_actor.doc("Search actors by name, country or show, best matches first. Misspelt names still match.")
+    @ns_actor.expect(actors_search_payload)
+    @ns_actor.response(400, 'Error searching actors')
+    def get(self):
+        try:
+            args = actors_search_payload.parse_args()
+            query = '' if args['q'] is None else args['q']
+            page = 1 if args['page'] is None else args['page']
+            size = 10 if args['size'] is None else args['size']
+            if page < 1 or size < 1:
+                raise ValueError('page and size start at 1')
+            with span('search_query'):
+                results, has_next = Actor_Search_Index.search(query, size * (page - 1), size)
+            return Actor.search_json(results, query, page, size, has_next), 200
+        except Exception as msg:
+            return 'There was an error in searching actors: {}.'.format(msg), 400
+
+
 @ns_actor.route('/<int:id>')
 class SingleActor(Resource):
 
     @ns_actor.doc("Get a single actor.")
+    @ns_actor.response(304, 'Actor not modified')
     @ns_actor.response(404, 'Actor not found')
     def get(self, id):
-        # get current actor
-        actor = Actor.find_by_id(id)
-        if actor is None:
+        detail = Actor.detail_cache.get(id)
+        if detail is None and (request.if_none_match or request.if_modified_since):
+            # revalidation only needs the timestamp and the neighbour ids, not the shows
+            validators = Actor.find_validators(id)
+        else:
+            # get current actor with its previous and next ids and its shows in one query
+            detail = validators = detail or Actor.load_detail(id)
+        if validators is None:
             return 'Actor {} does not exist.'.format(id), 404
-        # get previous actor
-        prev_actor = Actor.get_prev_id(id)
-        # get next actor
-        next_actor = Actor.get_next_id(id)
-        return actor.get_json(prev_actor=prev_actor, next_actor=next_actor), 200
+        response, headers = not_modified(*Actor.detail_validators(validators))
+        if response is not None:
+            return response
+        if detail is None:
+            detail = Actor.load_detail(id)
+        return Actor.detail_json(detail), 200, headers
     
 
     @ns_actor.response(200, 'Actor deleted')
@@ -148,15 +372,7 @@ class SingleActor(Resource):
             actor.deathday = actor.deathday if deathday is None else dt.datetime.strptime(deathday, "%d-%m-%Y").date()
             actor.birthday = actor.birthday if birthday is None else dt.datetime.strptime(birthday, "%d-%m-%Y").date()
             
-            if not shows is None:
-                show_entities = []
-                for show_name in shows:
-                    existing_show = Show.find_by_showname(show_name)
-                    if existing_show is None:
-                        show_entities.append(Show(name = show_name))
-                    else:
-                        show_entities.append(existing_show)
-            actor.shows = actor.shows if shows is None else show_entities
+            actor.shows = actor.shows if shows is None else Show.resolve_shownames(shows)
             actor.last_update = dt.datetime.now()
             actor.save_to_db()
             return actor.created_json(), 200
@@ -164,55 +380,131 @@ class SingleActor(Resource):
             return 'There was an error in processing. Item was not updated due to: {}.'.format(msg), 304
         
 
+@ns_actor.route('/<int:id>/costars')
+class ActorCostars(Resource):
+
+    @ns_actor.doc("Actors who share a show with this actor, most shared shows first.")
+    @ns_actor.expect(actor_costars_payload)
+    @ns_actor.response(404, 'Actor not found')
+    @ns_actor.response(400, 'Error retrieving co-stars')
+    def get(self, id):
+        try:
+            args = actor_costars_payload.parse_args()
+            page = 1 if args['page'] is None else args['page']
+            size = 10 if args['size'] is None else args['size']
+            if page < 1 or size < 1:
+                raise ValueError('page and size start at 1')
+            if not Actor.find_names_by_ids([id]):
+                return 'Actor {} does not exist.'.format(id), 404
+            with span('costars_query'):
+                costar_graph.ensure_current()
+                ids, shared, total = costar_graph.costars(id, size * (page - 1), size)
+            names = Actor.find_names_by_ids(ids)
+            costars = [(costar_id, names.get(costar_id), count) for costar_id, count in zip(ids, shared)]
+            return Actor.costars_json(id, costars, page, size, total), 200
+        except Exception as msg:
+            return 'There was an error in retrieving co-stars: {}.'.format(msg), 400
+
+
+@ns_actor.route('/<int:id>/path/<int:other_id>')
+class ActorPath(Resource):
+
+    @ns_actor.doc("Shortest chain of co-stars between two actors, with the show linking each pair.")
+    @ns_actor.response(404, 'Actor not found or not connected')
+    def get(self, id, other_id):
+        if len(Actor.find_names_by_ids([id, other_id])) < len({id, other_id}):
+            return 'Actor {} or {} does not exist.'.format(id, other_id), 404
+        with span('path_query'):
+            costar_graph.ensure_current()
+            path = costar_graph.path(id, other_id)
+        if path is None:
+            return 'Actors {} and {} are not connected within {} co-stars.'.format(id, other_id, costar_graph.max_depth), 404
+        shownames = Show.find_names_by_ids([show for _, show in path if show is not None])
+        return Actor.path_json(path, Actor.find_names_by_ids([actor for actor, _ in path]), shownames), 200
+
+
 @ns_actor.route('/statistics')
 class ActorsStats(Resource):
     
+    @staticmethod
+    def group_by(by: str, total_actors: int) -> dict:
+        # start group by processing, read from the materialised per-bucket counts
+        by_param = by.lower().split(',')
+        group_by_dict = {}
+        for attr in by_param:
+            # do group by statistics and compute percentage
+            by_attr = 'by-' + attr
+            groups = [('birth_month', by_attr + '_month'), ('birth_year', by_attr + '_year')] if attr == 'birthday' else [(attr, by_attr)]
+            for dimension, key in groups:
+                with span('stats_query'):
+                    group_counts = ActorStatistic.count_by_group(dimension)
+                with span('stats_aggregate'):
+                    Statistics_Helper.build_group_dict(Statistics_Helper.group_percentage(group_counts, total_actors), group_by_dict, key)
+        return group_by_dict
+
     @ns_actor.expect(actors_stats_payload)
     @ns_actor.doc("Get statistics of existing actors.")
     @ns_actor.response(404, 'No actors in the database')
     @ns_actor.response(400, 'Error retrieving statistics of actors from the database')
+    @ns_actor.response(304, 'Image not modified')
+    @ns_actor.response(503, 'Image rendering is saturated')
+    @ns_actor.response(504, 'Image rendering timed out')
     def get(self):
         try:
             args = actors_stats_payload.parse_args()
             format = args['format']
             by = args['by']
-            total_actors = len(Actor.get_all())
+            if format.lower() == 'image':
+                # images only change with the actors table, revalidate before doing any work
+                version, updated_at = TableVersion.get(Actor.__tablename__)
+                # the timestamp keeps versions distinct across a recreated database
+                version = '{}.{}'.format(version, 0 if updated_at is None else int(updated_at.timestamp() * 1000000))
+                by_key = by.lower().replace(' ', '')
+                response, headers = not_modified('stats-{}-{}'.format(by_key, version), None)
+                if response is not None:
+                    return response
+                output = Statistics_Helper.image_cache.get((by_key, version))
+                if output is None:
+                    total_actors = ActorStatistic.total()
+                    if total_actors == 0:
+                        return 'There are no actors in the database.', 404
+                    group_by_dict = ActorsStats.group_by(by, total_actors)
+                    try:
+                        with span('stats_render'):
+                            output = render_pool.render(group_by_dict)
+                    except Render_Pool_Saturated as msg:
+                        return Response('Too many statistics images are being rendered: {}.'.format(msg), status=503, headers={'Retry-After': '1'})
+                    except Render_Timeout as msg:
+                        return 'Statistics image could not be rendered: {}.'.format(msg), 504
+                    Statistics_Helper.image_cache.put((by_key, version), output)
+                return Response(output, mimetype='image/png', headers=headers)
+
+            total_actors = ActorStatistic.total()
+            if total_actors == 0:
+                return 'There are no actors in the database.', 404
             # get actors updated count for the last 24 hours
             one_day_ago = dt.datetime.now() - dt.timedelta(hours=24)
-            total_updated = Actor.count_by_last_updated(one_day_ago)
-            # get all actors for stats
-            all_actors = Actor.get_all()
-            df = pd.DataFrame.from_records([a.json() for a in all_actors])
-            # add life_status to the df
-            df['life_status'] = df.apply(lambda x: "Alive" if x['deathday'] is None else "Dead", axis=1)
-            # add birthday month to the df
-            df['birth_month'] = pd.DatetimeIndex(df['birthday']).month_name()
-            # add birthday year to the df
-            df['birth_year'] = pd.DatetimeIndex(df['birthday']).year.astype('Int32').astype(str)
-            # start group by processing
-            by_param = by.lower().split(',')
-            group_by_dict = {}
-            for attr in by_param:
-                # do group by statistics and compute percentage
-                by_attr = 'by-' + attr
-                if attr == 'birthday':
-                    month_percentage = round(df['birth_month'].value_counts() / total_actors * 100, 1)
-                    Statistics_Helper.build_group_dict(month_percentage, group_by_dict, by_attr + '_month')
-                    year_percentage = round(df['birth_year'].value_counts() / total_actors * 100, 1)
-                    Statistics_Helper.build_group_dict(year_percentage, group_by_dict, by_attr + '_year')
-                else:
-                    attr_percentage = round(df[attr].value_counts() / total_actors * 100, 1)
-                    Statistics_Helper.build_group_dict(attr_percentage, group_by_dict, by_attr)
+            with span('stats_query'):
+                total_updated = Actor.count_by_last_updated(one_day_ago)
+            group_by_dict = ActorsStats.group_by(by, total_actors)
 
             # generate return info based on selected format
             if format.lower() == 'json':
-                output = Statistics_Helper.generate_stats_json(total_actors=total_actors, total_updated=total_updated, group_by_dict=group_by_dict)
+                with span('stats_serialize'):
+                    output = Statistics_Helper.generate_stats_json(total_actors=total_actors, total_updated=total_updated, group_by_dict=group_by_dict)
                 return output, 200
-            elif format.lower() == 'image':
-                output = Statistics_Helper.generate_viz_image(group_by_dict=group_by_dict)
-                return Response(output.getvalue(), mimetype='image/png')
             else:
                 return 'Selected format is not accepted.', 400        
 
         except Exception as msg:
-            return 'There was an error in processing: {}.'.format(msg), 400
\ No newline at end of file
+            return 'There was an error in processing: {}.'.format(msg), 400
+
+
+@ns_job.route('/<int:id>')
+class SingleJob(Resource):
+
+    def get(self, id):
+        job = ActorJob.find_by_id(id)
+        if job is None:
+            return 'Job {} cannot be found.'.format(id), 404
+        return job.json(), 200
@@ -1,4 +1,60 @@
+import os
+from flask import current_app, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import asc, desc
+from flask_sqlalchemy.session import Session
+from sqlalchemy import asc, desc, event
 
-db = SQLAlchemy()
\ No newline at end of file
+
+class Routing_Session(Session):
+    # with DB_READ_SPLIT on, GET and HEAD requests read through the query_only 'read' engine
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and request.method in ('GET', 'HEAD') \
+                and current_app.config.get('DB_READ_SPLIT') and 'read' in self._db.engines:
+            return self._db.engines['read']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': Routing_Session})
+
+
+def engine_options_from_env(prefix: str) -> dict:
+    # only the pool settings that are set, the pool classes for in-memory SQLite reject some of them
+    options = {}
+    for name, option, cast in (('POOL_SIZE', 'pool_size', int), ('MAX_OVERFLOW', 'max_overflow', int),
+                               ('POOL_TIMEOUT', 'pool_timeout', float), ('POOL_RECYCLE', 'pool_recycle', int)):
+        if os.environ.get(prefix + '_' + name):
+            options[option] = cast(os.environ[prefix + '_' + name])
+    return options
+
+
+def sqlite_pragmas(query_only=False) -> list:
+    pragmas = [
+        # readers never wait for the writer and the writer never waits for readers
+        'PRAGMA journal_mode=' + os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        # in WAL mode NORMAL only risks the last commits on power loss, never corruption
+        'PRAGMA synchronous=' + os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        # writers from other workers queue for the lock instead of failing with "database is locked"
+        'PRAGMA busy_timeout={}'.format(int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))),
+        'PRAGMA mmap_size={}'.format(int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))),
+        # negative sizes are KiB, per connection
+        'PRAGMA cache_size={}'.format(int(os.environ.get('SQLITE_CACHE_SIZE', -65536))),
+    ]
+    if query_only:
+        pragmas.append('PRAGMA query_only=ON')
+    return pragmas
+
+
+def tune_sqlite(engine, query_only=False) -> None:
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(query_only)
+    if engine.url.database in (None, '', ':memory:'):
+        # an in-memory database has no journal to switch
+        pragmas = pragmas[1:]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
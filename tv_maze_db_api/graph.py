@@ -0,0 +1,389 @@
+import itertools
+import os
+import threading
+from sqlalchemy import event, inspect
+from .db import db
+from .model import Actor, GraphChange, Show, TableVersion, show_actor_association_table
+
+# numpy is only needed for co-star queries, Costar_Graph.load_numpy imports it the first time the graph is built
+np = None
+
+# bumped with every flush that links or unlinks actors and shows, tells each process when its graph is behind
+GRAPH_VERSION_NAME = show_actor_association_table.name
+EDGES_QUERY = ('SELECT show_actor_association.actor_id, show_actor_association.show_id FROM show_actor_association'
+               ' JOIN tv_shows ON tv_shows.id = show_actor_association.show_id')
+BUILD_CHUNK_SIZE = 100000
+
+
+class Costar_Graph:
+    # the actor - show graph of show_actor_association as two CSR adjacency arrays, actors -> shows and
+    # shows -> actors, so a lookup is a slice and a BFS level is a few vectorised gathers.
+    # Commits land in a small overlay of added and removed edges and of removed actors and shows, folded into
+    # the arrays once it grows past compact_after. Writes from other processes show up as a version change,
+    # the next query replays them from graph_changes, or rebuilds the arrays when the log no longer has them
+    numpy_lock = threading.Lock()
+
+    def __init__(self, max_depth, compact_after):
+        self.max_depth = max_depth
+        self.compact_after = compact_after
+        self.lock = threading.RLock()
+        self.version = None
+        self.builds = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_depth=int(os.environ.get('COSTAR_MAX_DEPTH', 6)),
+            compact_after=int(os.environ.get('COSTAR_COMPACT_AFTER', 10000)))
+
+    @classmethod
+    def load_numpy(cls) -> None:
+        global np
+        if np is not None:
+            return
+        with cls.numpy_lock:
+            if np is None:
+                import numpy
+                np = numpy
+
+    @staticmethod
+    def csr(keys, values) -> tuple:
+        # (sorted unique keys, offsets, values grouped by key)
+        order = np.lexsort((values, keys))
+        keys, values = keys[order], values[order]
+        unique, counts = np.unique(keys, return_counts=True)
+        offsets = np.zeros(len(unique) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return unique, offsets, values.astype(np.int32)
+
+    @staticmethod
+    def gather(csr: tuple, frontier) -> tuple:
+        # (source, neighbour) pairs for every frontier key found in the arrays
+        keys, offsets, values = csr
+        positions = np.searchsorted(keys, frontier).clip(0, max(0, len(keys) - 1))
+        found = (keys[positions] == frontier) if len(keys) else np.zeros(len(frontier), dtype=bool)
+        positions, sources = positions[found], frontier[found]
+        starts = offsets[positions]
+        counts = offsets[positions + 1] - starts
+        # concatenated ranges [start, start + count) without a python loop
+        shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return np.repeat(sources, counts), values[shifts + np.arange(counts.sum())].astype(np.int64)
+
+    def reset(self, actor_ids, show_ids, version) -> None:
+        self.by_actor = self.csr(actor_ids, show_ids)
+        self.by_show = self.csr(show_ids, actor_ids)
+        self.added_shows = {}
+        self.added_actors = {}
+        self.removed = set()
+        self.removed_keys = None
+        # removed actors and shows hide all their base edges, edges added to them later live in the overlay
+        self.dead_actors = set()
+        self.dead_shows = set()
+        self.dead_ids = None
+        self.dead_edges = 0
+        self.version = version
+
+    def build(self) -> None:
+        # the version is read first, a write landing before the edges are read only causes one more rebuild
+        self.load_numpy()
+        version = TableVersion.get(GRAPH_VERSION_NAME)[0]
+        # plain DB-API tuples, building a Row per edge costs more than the query on millions of edges.
+        # Links to deleted shows can outlive them, the join leaves them out like the detail endpoint does
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute(EDGES_QUERY)
+        chunks = []
+        rows = cursor.fetchmany(BUILD_CHUNK_SIZE)
+        while rows:
+            chunks.append(np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)))
+            rows = cursor.fetchmany(BUILD_CHUNK_SIZE)
+        cursor.close()
+        edges = np.concatenate(chunks).reshape(-1, 2) if chunks else np.zeros((0, 2), dtype=np.int64)
+        self.reset(edges[:, 0], edges[:, 1], version)
+        self.builds += 1
+
+    def ensure_current(self) -> None:
+        # call before costars and path, they answer from the arrays as they are
+        with self.lock:
+            version = TableVersion.get(GRAPH_VERSION_NAME)[0]
+            if self.version is not None and self.version < version:
+                self.replay(version)
+            if self.version is None or self.version != version:
+                self.build()
+
+    def replay(self, version: int) -> None:
+        # commits of other processes, when the log still holds every version in between
+        rows = GraphChange.between(self.version, version)
+        if {row.version for row in rows} != set(range(self.version + 1, version + 1)):
+            return
+        self.update([(row.change, row.actor_id, row.show_id) for row in rows], version)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.version = None
+
+    @staticmethod
+    def edge_key(actor_id: int, show_id: int) -> int:
+        return actor_id << 32 | show_id
+
+    def has_base_edge(self, actor_id: int, show_id: int) -> bool:
+        if actor_id in self.dead_actors or show_id in self.dead_shows:
+            return False
+        _, shows = self.gather(self.by_actor, np.array([actor_id], dtype=np.int64))
+        return bool((shows == show_id).any())
+
+    def add_edge(self, actor_id: int, show_id: int) -> None:
+        key = self.edge_key(actor_id, show_id)
+        if key in self.removed:
+            self.removed.discard(key)
+            self.removed_keys = None
+        elif not self.has_base_edge(actor_id, show_id):
+            self.added_shows.setdefault(actor_id, set()).add(show_id)
+            self.added_actors.setdefault(show_id, set()).add(actor_id)
+
+    def remove_edge(self, actor_id: int, show_id: int) -> None:
+        if show_id in self.added_shows.get(actor_id, ()):
+            self.added_shows[actor_id].discard(show_id)
+            self.added_actors[show_id].discard(actor_id)
+        elif self.has_base_edge(actor_id, show_id):
+            self.removed.add(self.edge_key(actor_id, show_id))
+            self.removed_keys = None
+
+    def remove_actor(self, actor_id: int) -> None:
+        for show_id in self.added_shows.pop(actor_id, ()):
+            self.added_actors[show_id].discard(actor_id)
+        if actor_id not in self.dead_actors:
+            self.remove_node(actor_id, True)
+            self.dead_actors.add(actor_id)
+
+    def remove_show(self, show_id: int) -> None:
+        for actor_id in self.added_actors.pop(show_id, ()):
+            self.added_shows[actor_id].discard(show_id)
+        if show_id not in self.dead_shows:
+            self.remove_node(show_id, False)
+            self.dead_shows.add(show_id)
+
+    def remove_node(self, node_id: int, is_actor: bool) -> None:
+        # one gather and a count instead of an overlay entry per edge, a show can have a cast of thousands
+        self.removed = {key for key in self.removed if (key >> 32 if is_actor else key & 0xffffffff) != node_id}
+        self.removed_keys = None
+        _, neighbours = self.gather(self.by_actor if is_actor else self.by_show, np.array([node_id], dtype=np.int64))
+        dead = self.dead_shows if is_actor else self.dead_actors
+        if dead:
+            neighbours = neighbours[~np.isin(neighbours, np.fromiter(dead, dtype=np.int64, count=len(dead)))]
+        self.dead_edges += len(neighbours)
+        self.dead_ids = None
+
+    def expand(self, frontier, by_actor: bool) -> tuple:
+        # (source, neighbour) pairs of the frontier, base arrays plus overlay
+        sources, neighbours = self.gather(self.by_actor if by_actor else self.by_show, frontier)
+        if self.dead_actors or self.dead_shows:
+            if self.dead_ids is None:
+                self.dead_ids = (np.fromiter(self.dead_actors, dtype=np.int64, count=len(self.dead_actors)),
+                                 np.fromiter(self.dead_shows, dtype=np.int64, count=len(self.dead_shows)))
+            actors, shows = (sources, neighbours) if by_actor else (neighbours, sources)
+            keep = ~(np.isin(actors, self.dead_ids[0]) | np.isin(shows, self.dead_ids[1]))
+            sources, neighbours = sources[keep], neighbours[keep]
+        if self.removed:
+            if self.removed_keys is None:
+                self.removed_keys = np.fromiter(self.removed, dtype=np.int64, count=len(self.removed))
+            keys = sources << 32 | neighbours if by_actor else neighbours << 32 | sources
+            keep = ~np.isin(keys, self.removed_keys)
+            sources, neighbours = sources[keep], neighbours[keep]
+        added = self.added_shows if by_actor else self.added_actors
+        if added:
+            extra = [(key, value) for key in np.intersect1d(np.fromiter(added, dtype=np.int64), frontier).tolist()
+                     for value in added[key]]
+            if extra:
+                extra = np.array(extra, dtype=np.int64)
+                sources, neighbours = np.concatenate([sources, extra[:, 0]]), np.concatenate([neighbours, extra[:, 1]])
+        return sources, neighbours
+
+    def compact(self) -> None:
+        everyone = self.by_actor[0].astype(np.int64)
+        actor_ids, show_ids = self.expand(np.union1d(everyone, np.fromiter(self.added_shows, dtype=np.int64)), True)
+        self.reset(actor_ids, show_ids, self.version)
+
+    def apply(self, changes: list, start: int, end: int) -> None:
+        # changes of one committed transaction that moved the graph version from start to end
+        with self.lock:
+            # another process wrote in between when the version is not start, the next query replays the log
+            if self.version is not None and self.version == start:
+                self.update(changes, end)
+
+    def update(self, changes: list, version: int) -> None:
+        for change, actor_id, show_id in changes:
+            if change == 'add':
+                self.add_edge(actor_id, show_id)
+            elif change == 'remove':
+                self.remove_edge(actor_id, show_id)
+            elif change == 'remove_actor':
+                self.remove_actor(actor_id)
+            elif change == 'remove_show':
+                self.remove_show(show_id)
+        self.version = version
+        if self.overlay_size() > self.compact_after:
+            self.compact()
+
+    def overlay_size(self) -> int:
+        return len(self.removed) + len(self.dead_actors) + len(self.dead_shows) + sum(len(shows) for shows in self.added_shows.values())
+
+    def costars(self, actor_id: int, start: int, size: int) -> tuple:
+        # (actor ids, shared show counts) of one page, most shared shows first, and the number of co-stars
+        with self.lock:
+            _, shows = self.expand(np.array([actor_id], dtype=np.int64), True)
+            _, actors = self.expand(np.unique(shows), False)
+        counts = np.bincount(actors, minlength=actor_id + 1)
+        counts[actor_id] = 0
+        # a handful of distinct counts, ids come out sorted within each without sorting the whole cast
+        ids, shared = [], []
+        for count in np.unique(counts[counts > 0])[::-1].tolist():
+            if len(ids) >= start + size:
+                break
+            matches = np.flatnonzero(counts == count)[:start + size - len(ids)].tolist()
+            ids += matches
+            shared += [count] * len(matches)
+        return ids[start:], shared[start:], int(np.count_nonzero(counts))
+
+    def degree(self, frontier, by_actor: bool) -> int:
+        # edges a frontier expands to in the base arrays, to pick the cheaper side of the search
+        keys, offsets, _ = self.by_actor if by_actor else self.by_show
+        positions = np.searchsorted(keys, frontier).clip(0, max(0, len(keys) - 1))
+        return int((offsets[positions + 1] - offsets[positions]).sum()) if len(keys) else 0
+
+    def path(self, source: int, target: int) -> list:
+        # [(actor id, id of the show shared with the previous actor)] along a shortest co-star chain,
+        # None when the two are more than max_depth co-stars apart.
+        # Each side alternates actor -> show and show -> actor steps, and the side whose next step touches
+        # fewer edges goes next, so two actors of a show with a huge cast meet on the show without listing it
+        if source == target:
+            return [(source, None)]
+        with self.lock:
+            sides = [Search_Side(source), Search_Side(target)]
+            while sides[0].steps + sides[1].steps < 2 * self.max_depth:
+                costs = [self.degree(side.frontier, side.on_actors) for side in sides]
+                this, other = (sides[0], sides[1]) if costs[0] <= costs[1] else (sides[1], sides[0])
+                if this.on_actors:
+                    via_actors, shows = self.expand(this.frontier, True)
+                    shows, first = np.unique(shows, return_index=True)
+                    fresh = ~np.isin(shows, this.seen_shows)
+                    shows, via_actors = shows[fresh], via_actors[first][fresh]
+                    this.show_parents.update(zip(shows.tolist(), via_actors.tolist()))
+                    this.seen_shows = np.concatenate([this.seen_shows, shows])
+                    this.frontier, this.frontier_via = shows, via_actors
+                    meets = shows[np.isin(shows, other.seen_shows)].tolist()
+                    if meets:
+                        # the two actors who reached the show from either side worked on it together
+                        show = min(meets, key=lambda show: other.actor_parents[other.show_parents[show]][2])
+                        return self.join_path(sides, sides[0].show_parents[show], sides[1].show_parents[show], show)
+                else:
+                    via_shows, actors = self.expand(this.frontier, False)
+                    actors, first = np.unique(actors, return_index=True)
+                    fresh = ~np.isin(actors, this.seen_actors)
+                    actors, via_shows = actors[fresh], via_shows[first][fresh]
+                    previous = this.frontier_via[np.searchsorted(this.frontier, via_shows)]
+                    this.depth += 1
+                    this.actor_parents.update(zip(actors.tolist(), zip(previous.tolist(), via_shows.tolist(), [this.depth] * len(actors))))
+                    this.seen_actors = np.concatenate([this.seen_actors, actors])
+                    this.frontier = actors
+                    meets = actors[np.isin(actors, other.seen_actors)].tolist()
+                    if meets:
+                        actor = min(meets, key=lambda actor: other.actor_parents[actor][2])
+                        return self.join_path(sides, actor, actor, None)
+                this.on_actors = not this.on_actors
+                this.steps += 1
+                if len(this.frontier) == 0:
+                    return None
+        return None
+
+    @staticmethod
+    def join_path(sides: list, left: int, right: int, show: int) -> list:
+        # source ... left, then right ... target; left and right are the same actor or co-stars of show
+        path = []
+        actor = left
+        while actor is not None:
+            previous, via, _ = sides[0].actor_parents[actor]
+            path.append((actor, via))
+            actor = previous
+        path.reverse()
+        if show is not None:
+            path.append((right, show))
+        actor = right
+        while sides[1].actor_parents[actor][0] is not None:
+            previous, via, _ = sides[1].actor_parents[actor]
+            path.append((previous, via))
+            actor = previous
+        return path
+
+    def stats(self) -> dict:
+        with self.lock:
+            if self.version is None:
+                return {'builds': self.builds, 'edges': 0, 'overlay': 0}
+            added = sum(len(shows) for shows in self.added_shows.values())
+            return {'builds': self.builds, 'edges': len(self.by_actor[2]) - len(self.removed) - self.dead_edges + added,
+                    'overlay': self.overlay_size()}
+
+
+class Search_Side:
+    # one end of a bidirectional search, parents map back towards its root actor
+    def __init__(self, root: int):
+        self.frontier = np.array([root], dtype=np.int64)
+        self.frontier_via = None
+        self.on_actors = True
+        self.steps = 0
+        self.depth = 0
+        # actor -> (previous actor, show shared with it, depth) and show -> actor that reached it
+        self.actor_parents = {root: (None, None, 0)}
+        self.show_parents = {}
+        self.seen_actors = self.frontier
+        self.seen_shows = np.zeros(0, dtype=np.int64)
+
+
+costar_graph = Costar_Graph.from_env()
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_graph_changes(session, flush_context):
+    changes = []
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Actor) and obj not in session.deleted:
+            history = inspect(obj).attrs.shows.history
+            changes += [('add', obj.id, show.id) for show in history.added]
+            changes += [('remove', obj.id, show.id) for show in history.deleted]
+    for obj in session.deleted:
+        if isinstance(obj, Actor):
+            changes.append(('remove_actor', obj.id, None))
+        elif isinstance(obj, Show):
+            changes.append(('remove_show', None, obj.id))
+    record_graph_changes(session, changes)
+
+
+@event.listens_for(db.session, 'before_commit')
+def collect_bulk_graph_changes(session):
+    # link changes made by set-based statements, see Actor.record_bulk_changes
+    record_graph_changes(session, session.info.pop('association_changes', []))
+
+
+def record_graph_changes(session, changes: list) -> None:
+    if not changes:
+        return
+    # the bump takes the write lock, no other process can bump the version again before this transaction ends
+    connection = session.connection()
+    version = TableVersion.bump(connection, GRAPH_VERSION_NAME)
+    GraphChange.record(connection, version, changes)
+    session.info.setdefault('graph_versions', [version - 1, None])[1] = version
+    session.info.setdefault('graph_changes', []).extend(changes)
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_graph_changes(session):
+    versions = session.info.pop('graph_versions', None)
+    changes = session.info.pop('graph_changes', [])
+    if versions is not None:
+        costar_graph.apply(changes, *versions)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_graph_changes(session, previous_transaction):
+    session.info.pop('graph_versions', None)
+    session.info.pop('graph_changes', None)
+    session.info.pop('association_changes', None)
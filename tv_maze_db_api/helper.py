@@ -1,54 +1,320 @@
+import os
+import random
 import requests
-import numpy as np
-import pandas as pd
 import io
+import json
+import threading
+import time
+from collections import OrderedDict
 from .model import Actor, Show
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from .metrics import observe_tvmaze_call
+from .rate_limit import Adaptive_Limiter, Token_Bucket
+
+# numpy, pandas and matplotlib are only needed to draw statistics images,
+# Statistics_Helper.load_viz_stack imports them the first time a chart is drawn
+np = pd = plt = FigureCanvas = None
 
 class TVMaze_API_Access:
-    def __init__(self, url):
+    # one keep-alive session shared by every client in the process
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+    # optional HTTP_Response_Cache shared by every client, configured at app start up
+    cache = None
+    # TV Maze allows about 20 calls per 10 seconds per IP, shared by every thread in the process
+    rate_limiter = Token_Bucket.from_env()
+    concurrency = Adaptive_Limiter.from_env()
+    timeout = float(os.environ.get('TVMAZE_TIMEOUT', 10))
+    max_retries = int(os.environ.get('TVMAZE_MAX_RETRIES', 4))
+    backoff_base = float(os.environ.get('TVMAZE_BACKOFF_BASE', 0.5))
+    backoff_max = float(os.environ.get('TVMAZE_BACKOFF_MAX', 30))
+    retry_statuses = (429, 502, 503, 504)
+
+    def __init__(self, url, max_workers=None):
         self.url = url
+        # derive the api root from the search url so castcredits hit the same host
+        parts = urlsplit(url)
+        self.base_url = '{}://{}'.format(parts.scheme, parts.netloc)
+        self.max_workers = int(os.environ.get('TVMAZE_MAX_WORKERS', 8)) if max_workers is None else max_workers
+
+    @staticmethod
+    def retry_after(resp) -> float:
+        # Retry-After is either seconds or an HTTP date
+        value = resp.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter keeps retrying threads from arriving together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def fetch(self, url, headers=None):
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            self.concurrency.acquire()
+            throttled = False
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(url=url, headers=headers, timeout=self.timeout)
+                observe_tvmaze_call(resp.status_code, time.perf_counter() - start)
+                throttled = resp.status_code == 429
+            except (requests.ConnectionError, requests.Timeout) as msg:
+                observe_tvmaze_call('error', time.perf_counter() - start)
+                if attempt >= self.max_retries:
+                    raise
+                print('Retrying {} after error: {}'.format(url, msg))
+                resp = None
+            finally:
+                self.concurrency.release(throttled)
+            if resp is not None and (resp.status_code not in self.retry_statuses or attempt >= self.max_retries):
+                return resp
+            wait = self.backoff(attempt)
+            if resp is not None:
+                retry_after = self.retry_after(resp)
+                if retry_after is not None:
+                    wait = min(self.backoff_max, retry_after) + wait / 10
+                if throttled:
+                    self.rate_limiter.pause(wait)
+            time.sleep(wait)
+            attempt += 1
 
     def get_json(self, url):
-        resp = requests.get(url=url)
+        if self.cache is None:
+            resp = self.fetch(url)
+            resp.raise_for_status()
+            data = resp.json()
+            return data
+        entry, is_fresh = self.cache.lookup(url)
+        if is_fresh:
+            return json.loads(entry['body'])
+        # stale or unknown url, ask upstream and revalidate what we already have
+        resp = self.fetch(url, headers=self.cache.revalidation_headers(entry))
+        if resp.status_code == 304 and entry is not None:
+            self.cache.refresh(url)
+            return json.loads(entry['body'])
+        resp.raise_for_status()
         data = resp.json()
+        self.cache.store(url, resp.content, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
         return data
 
-    def get_actor(self, name) -> Actor:
+    @classmethod
+    def cache_stats(cls) -> dict:
+        return {} if cls.cache is None else cls.cache.stats()
+
+    def try_get_json(self, url):
+        # a single failed show lookup should not fail the whole actor import
+        try:
+            return self.get_json(url)
+        except Exception as msg:
+            print('ERROR fetching {}: {}'.format(url, msg))
+            return None
+
+    def get_show_details(self, show_urls) -> list:
+        # fetch concurrently but keep results in the same order as show_urls
+        show_urls = list(show_urls)
+        if self.max_workers <= 1 or len(show_urls) <= 1:
+            return [self.try_get_json(url) for url in show_urls]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(show_urls))) as executor:
+            return list(executor.map(self.try_get_json, show_urls))
+
+    def find_person(self, name):
+        # returns the matching person json and its show urls, or None when TV Maze has no exact match
         query_url = self.url + name
         print(query_url)
         # Fetch the query result to a json object
         json_obj = self.get_json(query_url)
         # Ensure the highest scored actor response exactly matches the queried actor name
-        if str(json_obj[0]['person']['name']).lower() == name.lower():
+        if len(json_obj) > 0 and str(json_obj[0]['person']['name']).lower() == name.lower():
             # Retrieve shows for the current actor
-            shows_query_url = 'https://api.tvmaze.com/people/{}/castcredits'.format(json_obj[0]['person']['id'])
-            shows_json_obj = self.get_json(shows_query_url)
-            show_urls = map(lambda n: n['_links']['show']['href'], shows_json_obj)
-            show_details = map(lambda n: self.get_json(n), show_urls)
-            show_names = map(lambda n: n['name'], show_details)
-            show_entities = []
-            for show_name in show_names:
-                existing_show = Show.find_by_showname(show_name)
-                if existing_show is None:
-                    show_entities.append(Show(name = show_name))
-                else:
-                    show_entities.append(existing_show)
-            actor = Actor.from_json(json_obj[0]['person'])
-            actor.shows = show_entities
-            return actor
-        else: 
+            return json_obj[0]['person'], self.get_show_urls(json_obj[0]['person']['id'])
+        else:
+            return None
+
+    def get_show_urls(self, actor_id) -> list:
+        shows_query_url = self.base_url + '/people/{}/castcredits'.format(actor_id)
+        shows_json_obj = self.get_json(shows_query_url)
+        return [n['_links']['show']['href'] for n in shows_json_obj]
+
+    def get_person(self, actor_id):
+        # person json and show names of an actor already known by its TV Maze id
+        person_json = self.get_json(self.base_url + '/people/{}'.format(actor_id))
+        show_details = self.get_show_details(self.get_show_urls(actor_id))
+        # storing only the shows that could be fetched would drop the actor's links to the others
+        missing = len([n for n in show_details if n is None])
+        if missing:
+            raise Exception('could not fetch {} of {} shows of person {}'.format(missing, len(show_details), actor_id))
+        return person_json, [n['name'] for n in show_details]
+
+    def try_get_person(self, actor_id):
+        try:
+            return self.get_person(actor_id)
+        except Exception as msg:
+            return msg
+
+    def get_updated_people(self, since=None) -> dict:
+        # {TV Maze person id: last update unix timestamp}, since is one of day, week or month
+        url = self.base_url + '/updates/people' + ('' if since is None else '?since=' + since)
+        return {int(actor_id): timestamp for actor_id, timestamp in self.get_json(url).items()}
+
+    def try_find_person(self, name):
+        try:
+            return self.find_person(name)
+        except Exception as msg:
+            return msg
+
+    def get_actor(self, name) -> Actor:
+        person = self.find_person(name)
+        if person is None:
             return None
+        person_json, show_urls = person
+        show_details = self.get_show_details(show_urls)
+        show_names = [n['name'] for n in show_details if n is not None]
+        actor = Actor.from_json(person_json)
+        actor.shows = Show.resolve_shownames(show_names)
+        return actor
+
+    def import_actors(self, names, batch_size=500) -> list:
+        # resolve and store many actors, one transaction per batch of names
+        names = iter(names)
+        report = []
+        batch = list(islice(names, batch_size))
+        while batch:
+            report += self.import_actor_batch(batch)
+            batch = list(islice(names, batch_size))
+        return report
+
+    def import_actor_batch(self, names) -> list:
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(names)))) as executor:
+            people = list(executor.map(self.try_find_person, names))
+
+        # fetch every show shared across the batch only once
+        show_urls = list(dict.fromkeys(url for p in people if isinstance(p, tuple) for url in p[1]))
+        show_details = dict(zip(show_urls, self.get_show_details(show_urls)))
+        show_names = list(dict.fromkeys(
+            show_details[url]['name'] for url in show_urls if show_details[url] is not None))
+        shows = dict(zip(show_names, Show.resolve_shownames(show_names)))
+
+        actor_ids = [p[0]['id'] for p in people if isinstance(p, tuple)]
+        existing_actors = Actor.find_by_actorids(actor_ids)
+        report = []
+        new_actors = {}
+        for name, person in zip(names, people):
+            if person is None:
+                report.append({'name': name, 'status': 'not-found'})
+            elif isinstance(person, Exception):
+                report.append({'name': name, 'status': 'error', 'message': str(person)})
+            elif person[0]['id'] in existing_actors:
+                report.append({'name': name, 'status': 'exists', 'id': existing_actors[person[0]['id']].id})
+            elif person[0]['id'] in new_actors:
+                report.append({'name': name, 'status': 'duplicate', 'actor_id': person[0]['id']})
+            else:
+                actor = Actor.from_json(person[0])
+                actor.shows = list({
+                    show_details[url]['name']: shows[show_details[url]['name']]
+                    for url in person[1] if show_details[url] is not None}.values())
+                new_actors[actor.actor_id] = actor
+                report.append({'name': name, 'status': 'created', 'actor_id': actor.actor_id})
+
+        try:
+            ids = dict(zip(new_actors.keys(), Actor.save_all_to_db(list(new_actors.values()))))
+        except Exception as msg:
+            ids = {}
+            for entry in report:
+                if entry['status'] == 'created':
+                    entry['status'] = 'error'
+                    entry['message'] = str(msg)
+        for entry in report:
+            if 'actor_id' in entry:
+                entry['id'] = ids.get(entry.pop('actor_id'))
+        return report
+
+
+class Image_Cache:
+    # least recently used rendered images, bounded by their total size in bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key) -> bytes:
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return image
+
+    def put(self, key, image: bytes) -> None:
+        if len(image) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.images.pop(key, None)
+            self.total_bytes += len(image) - (0 if old is None else len(old))
+            self.images[key] = image
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.images.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.images), 'bytes': self.total_bytes}
 
 
 class Statistics_Helper:
+    image_cache = Image_Cache(int(os.environ.get('STATS_IMAGE_CACHE_BYTES', 16 * 1024 * 1024)))
+    viz_stack_lock = threading.Lock()
+
+    @classmethod
+    def load_viz_stack(cls) -> None:
+        global np, pd, plt, FigureCanvas
+        if FigureCanvas is not None:
+            return
+        with cls.viz_stack_lock:
+            if FigureCanvas is not None:
+                return
+            import numpy
+            import pandas
+            import matplotlib
+            matplotlib.use('agg') # charts are only ever rendered off-screen, select the backend once
+            import matplotlib.pyplot
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            np, pd, plt = numpy, pandas, matplotlib.pyplot
+            FigureCanvas = FigureCanvasAgg
+
+    @staticmethod
+    def group_percentage(group_counts, total_actors: int) -> dict:
+        # [(bucket, count)] -> {bucket: percentage of all actors}
+        return {key: round(count / total_actors * 100, 1) for key, count in group_counts}
 
     @staticmethod
     def build_group_dict(df_aggregate, group_by_dict, by_attr):
-        for key in df_aggregate.index:
+        for key, value in df_aggregate.items():
             group_by_attr = {} if group_by_dict.get(by_attr) is None else group_by_dict.get(by_attr)
-            group_by_attr[key] = df_aggregate[key]
+            group_by_attr[key] = value
             group_by_dict[by_attr] = group_by_attr
         return group_by_dict
 
@@ -80,6 +346,7 @@ class Statistics_Helper:
     # Circular bar chart customisation copied  from: https://python-graph-gallery.com/circular-barplot-with-groups
     @classmethod
     def get_label_rotation(cls, angle, offset):
+        cls.load_viz_stack()
         # Rotation must be specified in degrees :(
         rotation = np.rad2deg(angle + offset)
         if angle <= np.pi:
@@ -92,6 +359,7 @@ class Statistics_Helper:
     # Circular bar chart customisation based from: https://python-graph-gallery.com/circular-barplot-with-groups
     @classmethod
     def generate_viz(cls, group_by_dict):
+        cls.load_viz_stack()
         categories = list(group_by_dict.keys())
         names = []
         values = []
@@ -132,7 +400,6 @@ class Statistics_Helper:
             IDXS += list(range(offset + PAD, offset + size + PAD))
             offset += size + PAD
 
-        plt.switch_backend('agg') # fix for issue caused by generating plot from REST call
         fig, ax = plt.subplots(figsize=(20, 10), subplot_kw={"projection": "polar"})
         ax.set_theta_offset(OFFSET)
         ax.set_ylim(-100, 100)
@@ -181,9 +448,13 @@ class Statistics_Helper:
     def generate_viz_image(group_by_dict: dict) -> io.BytesIO: 
         # generate visualisation (stacked charts)
         chart_fig = Statistics_Helper.generate_viz(group_by_dict)
-        output = io.BytesIO()
-        FigureCanvas(chart_fig).print_png(output)
-        return output
+        try:
+            output = io.BytesIO()
+            FigureCanvas(chart_fig).print_png(output)
+            return output
+        finally:
+            # pyplot keeps every figure alive until it is closed
+            plt.close(chart_fig)
     
     @staticmethod
     def generate_stats_json(total_actors: int, total_updated: int, group_by_dict: dict) -> dict:
@@ -0,0 +1,140 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# seconds a response stays fresh, first matching url pattern wins
+DEFAULT_TTL_RULES = [
+    (r'/shows/\d+$', 7 * 24 * 3600),
+    (r'/people/\d+/castcredits', 24 * 3600),
+    (r'/people/\d+$', 24 * 3600),
+    (r'/search/people', 3600),
+    (r'/updates/', 0),
+]
+
+
+class HTTP_Response_Cache:
+    def __init__(self, path, ttl_rules=None, default_ttl=3600, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.ttl_rules = [(re.compile(p), ttl) for p, ttl in (DEFAULT_TTL_RULES if ttl_rules is None else ttl_rules)]
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.revalidations = self.evictions = 0
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            expires REAL NOT NULL,
+            accessed REAL NOT NULL,
+            size INTEGER NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed)')
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @classmethod
+    def from_env(cls, path):
+        # TVMAZE_CACHE_TTLS overrides the ttl rules, e.g. "/shows/=604800,/search/=3600"
+        ttl_rules = None
+        if os.environ.get('TVMAZE_CACHE_TTLS'):
+            ttl_rules = []
+            for rule in os.environ['TVMAZE_CACHE_TTLS'].split(','):
+                pattern, ttl = rule.rsplit('=', 1)
+                ttl_rules.append((re.escape(pattern), int(ttl)))
+        return cls(
+            path,
+            ttl_rules=ttl_rules,
+            default_ttl=int(os.environ.get('TVMAZE_CACHE_DEFAULT_TTL', 3600)),
+            max_bytes=int(os.environ.get('TVMAZE_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+    def ttl_for(self, url) -> int:
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, url):
+        # returns (entry, is_fresh); entry is None when the url was never stored
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT body, etag, last_modified, expires FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False
+            now = time.time()
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, url))
+            entry = {'body': row[0], 'etag': row[1], 'last_modified': row[2]}
+            if row[3] > now:
+                self.hits += 1
+                return entry, True
+            self.misses += 1
+            return entry, False
+
+    def revalidation_headers(self, entry) -> dict:
+        headers = {}
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def refresh(self, url):
+        # upstream answered 304, the stored body is good for another ttl
+        with self.lock:
+            self.revalidations += 1
+            now = time.time()
+            self.conn.execute('UPDATE responses SET expires = ?, accessed = ? WHERE url = ?',
+                (now + self.ttl_for(url), now, url))
+
+    def store(self, url, body: bytes, etag=None, last_modified=None):
+        ttl = self.ttl_for(url)
+        if ttl <= 0 and not (etag or last_modified):
+            return
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            now = time.time()
+            old = self.conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, body, etag, last_modified, now + ttl, now, size))
+            self.total_bytes += size - (0 if old is None else old[0])
+            self.evict()
+
+    def evict(self):
+        # drop least recently used responses until the store fits max_bytes again
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                'SELECT url, size FROM responses ORDER BY accessed ASC LIMIT 64').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for url, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM responses')
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': self.total_bytes,
+            }
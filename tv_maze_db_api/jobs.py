@@ -0,0 +1,77 @@
+import datetime as dt
+import os
+import threading
+from .db import db
+from .helper import TVMaze_API_Access
+from .model import ActorJob
+
+
+class Actor_Job_Pool:
+    # worker threads draining the actor_jobs queue
+    def __init__(self, app, workers=None, poll_interval=None, stale_after=None):
+        self.app = app
+        self.workers = int(os.environ.get('ACTOR_JOB_WORKERS', 2)) if workers is None else workers
+        # other processes can enqueue too, so idle workers look at the table every poll_interval
+        self.poll_interval = float(os.environ.get('ACTOR_JOB_POLL_INTERVAL', 2)) if poll_interval is None else poll_interval
+        self.stale_after = float(os.environ.get('ACTOR_JOB_STALE_AFTER', 300)) if stale_after is None else stale_after
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def ensure_started(self) -> None:
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            if self.threads or self.workers <= 0:
+                return
+            self.stop_event.clear()
+            with self.app.app_context():
+                ActorJob.requeue_stale(dt.datetime.now() - dt.timedelta(seconds=self.stale_after))
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.run, name='actor-job-{}'.format(i), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            with self.app.app_context():
+                try:
+                    job = ActorJob.claim_next()
+                    if job is not None:
+                        self.process(*job)
+                except Exception as msg:
+                    db.session.rollback()
+                    print('ERROR in actor job worker: {}'.format(msg))
+                    job = None
+                finally:
+                    db.session.remove()
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+    def process(self, _id: int, name: str) -> None:
+        try:
+            api_access = TVMaze_API_Access(self.app.config['TVMAZE_API_URL'] + '/search/people?q=')
+            actor = api_access.get_actor(name)
+        except Exception as msg:
+            db.session.rollback()
+            ActorJob.finish(_id, 'failed', _message='There was an error in processing: {}.'.format(msg))
+            return
+        if actor is None:
+            ActorJob.finish(_id, 'not-found', _message='Actor {} cannot be found.'.format(name))
+            return
+        actor.save_to_db()
+        if actor.id is None:
+            ActorJob.finish(_id, 'failed', _message='Actor {} cannot be added.'.format(name))
+        else:
+            ActorJob.finish(_id, 'done', _actor_id=actor.id)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
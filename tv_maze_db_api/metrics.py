@@ -0,0 +1,187 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+
+# seconds, from a cached detail read to a TV Maze import
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Metrics_Registry:
+    # in-process counters and histograms rendered in the Prometheus text format, one registry per worker process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def describe(self, name: str, kind: str, text: str, buckets=None) -> None:
+        self.help[name] = (kind, text, buckets)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        buckets = self.help[name][2]
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                # one count per bucket plus +Inf, then sum
+                histogram = self.histograms[name, labels] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def collector(self, func) -> None:
+        # func returns [(name, kind, help, labels, value)], read on every scrape
+        self.collectors.append(func)
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                              for key, value in labels) + '}'
+
+    def render(self) -> str:
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        lines = []
+        for name, (kind, text, buckets) in sorted(self.help.items()):
+            series = sorted((labels, value) for (metric, labels), value in (counters if kind == 'counter' else histograms).items()
+                            if metric == name)
+            if not series:
+                continue
+            lines += ['# HELP {} {}'.format(name, text), '# TYPE {} {}'.format(name, kind)]
+            for labels, value in series:
+                if kind == 'counter':
+                    lines.append('{}{} {}'.format(name, self.format_labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, self.format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, self.format_labels(labels), value[-1]))
+                lines.append('{}_count{} {}'.format(name, self.format_labels(labels), cumulative))
+        described = set()
+        for func in self.collectors:
+            for name, kind, text, labels, value in func():
+                if name not in described:
+                    lines += ['# HELP {} {}'.format(name, text), '# TYPE {} {}'.format(name, kind)]
+                    described.add(name)
+                lines.append('{}{} {}'.format(name, self.format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics_Registry()
+metrics.describe('http_request_duration_seconds', 'histogram', 'Request latency by endpoint.', LATENCY_BUCKETS)
+metrics.describe('http_request_sql_queries', 'histogram', 'SQL statements run per request.', QUERY_COUNT_BUCKETS)
+metrics.describe('http_request_sql_seconds', 'histogram', 'Time spent in SQL per request.', LATENCY_BUCKETS)
+metrics.describe('sql_queries_total', 'counter', 'SQL statements run, inside and outside requests.')
+metrics.describe('sql_query_seconds_total', 'counter', 'Time spent running SQL statements.')
+metrics.describe('sql_query_errors_total', 'counter', 'SQL statements that raised, also counted in sql_queries_total.')
+metrics.describe('tvmaze_request_duration_seconds', 'histogram', 'TV Maze call latency by status code.', LATENCY_BUCKETS)
+metrics.describe('tvmaze_requests_total', 'counter', 'TV Maze calls by status code, error when no response came back.')
+metrics.describe('span_duration_seconds', 'histogram', 'Time spent in named stages of a request.', LATENCY_BUCKETS)
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('span_duration_seconds', (('span', name),), time.perf_counter() - start)
+
+
+def observe_tvmaze_call(status, seconds: float) -> None:
+    labels = (('status', str(status)),)
+    metrics.inc('tvmaze_requests_total', labels)
+    metrics.observe('tvmaze_request_duration_seconds', labels, seconds)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # statements on one connection never nest, a single start time is enough
+    conn.info['query_start'] = time.perf_counter()
+
+
+def record_query(conn, failed: bool) -> None:
+    start = conn.info.pop('query_start', None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    metrics.inc('sql_queries_total')
+    metrics.inc('sql_query_seconds_total', value=seconds)
+    if failed:
+        metrics.inc('sql_query_errors_total')
+    if has_app_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += seconds
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record_query(conn, False)
+
+
+def handle_error(exception_context):
+    # after_cursor_execute never runs for a statement that raised
+    if exception_context.connection is not None:
+        record_query(exception_context.connection, True)
+
+
+def instrument_engine(engine) -> None:
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
+
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+
+def record_request(response):
+    if 'request_start' not in g:
+        return response
+    # the route pattern, not the path, keeps the number of series bounded
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = (('method', request.method), ('endpoint', endpoint))
+    metrics.observe('http_request_duration_seconds', labels + (('status', str(response.status_code)),),
+                    time.perf_counter() - g.request_start)
+    metrics.observe('http_request_sql_queries', labels, g.sql_queries)
+    metrics.observe('http_request_sql_seconds', labels, g.sql_seconds)
+    return response
+
+
+def stats_collector(prefix: str, text: str, stats):
+    # exposes a cache's stats() dict, running totals as counters and sizes as gauges
+    def collect():
+        samples = []
+        for key, value in sorted(stats().items()):
+            if key in ('hits', 'misses', 'revalidations', 'evictions', 'invalidations', 'builds'):
+                samples.append(('{}_{}_total'.format(prefix, key), 'counter', '{} {}.'.format(text, key), (), value))
+            else:
+                samples.append(('{}_{}'.format(prefix, key), 'gauge', '{} {}.'.format(text, key), (), value))
+        return samples
+    return collect
+
+
+def metrics_response():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app, engines) -> None:
+    if os.environ.get('METRICS_ENABLED', 'true').lower() in ('0', 'false'):
+        return
+    for engine in engines:
+        instrument_engine(engine)
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_response)
@@ -0,0 +1,75 @@
+from sqlalchemy import text
+from .db import db
+from .model import Actor, Actor_Search_Index, Show, show_actor_association_table
+
+# databases created before a change to the model are brought up to date in order,
+# PRAGMA user_version records the last step applied
+SCHEMA_VERSION = 2
+
+
+def dedupe_show_names(connection) -> None:
+    # imports before the unique index could store a show name more than once, keep the lowest id
+    keep = 'SELECT MIN(id) FROM tv_shows WHERE name IS NOT NULL GROUP BY name'
+    connection.execute(text(
+        'UPDATE show_actor_association SET show_id = ('
+        ' SELECT MIN(kept.id) FROM tv_shows AS kept JOIN tv_shows AS dup ON kept.name = dup.name'
+        ' WHERE dup.id = show_actor_association.show_id)'
+        ' WHERE show_id IN (SELECT id FROM tv_shows WHERE name IS NOT NULL AND id NOT IN ({}))'.format(keep)))
+    connection.execute(text('DELETE FROM tv_shows WHERE name IS NOT NULL AND id NOT IN ({})'.format(keep)))
+    unique = {row[1]: row[2] for row in connection.execute(text('PRAGMA index_list(tv_shows)'))}
+    if not unique.get('ix_tv_shows_name'):
+        connection.execute(text('DROP INDEX IF EXISTS ix_tv_shows_name'))
+        for index in Show.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def add_association_primary_key(connection) -> None:
+    if any(row[5] for row in connection.execute(text('PRAGMA table_info(show_actor_association)'))):
+        return
+    # SQLite cannot add a primary key in place, copy the distinct pairs into a new table
+    connection.execute(text('ALTER TABLE show_actor_association RENAME TO show_actor_association_old'))
+    show_actor_association_table.create(connection)
+    connection.execute(text(
+        'INSERT OR IGNORE INTO show_actor_association (show_id, actor_id)'
+        ' SELECT show_id, actor_id FROM show_actor_association_old'
+        ' WHERE show_id IS NOT NULL AND actor_id IS NOT NULL'))
+    connection.execute(text('DROP TABLE show_actor_association_old'))
+
+
+def add_actor_indexes(connection) -> None:
+    for index in Actor.__table__.indexes | show_actor_association_table.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def upgrade_to_1(connection) -> None:
+    dedupe_show_names(connection)
+    add_association_primary_key(connection)
+    add_actor_indexes(connection)
+
+
+def upgrade_to_2(connection) -> None:
+    # new databases get the search tables from create_all, older ones get them here, filled from the actors
+    Actor_Search_Index.create(connection)
+    Actor_Search_Index.rebuild(connection)
+
+
+MIGRATIONS = [upgrade_to_1, upgrade_to_2]
+
+
+def schema_version(connection) -> int:
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def migrate(engine=None) -> list:
+    # run after db.create_all(), returns the versions applied
+    engine = db.engine if engine is None else engine
+    if engine.dialect.name != 'sqlite':
+        return []
+    applied = []
+    with engine.begin() as connection:
+        version = schema_version(connection)
+        for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            step(connection)
+            connection.execute(text('PRAGMA user_version = {}'.format(target)))
+            applied.append(target)
+    return applied
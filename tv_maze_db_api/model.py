@@ -1,17 +1,44 @@
+import base64
+import bisect
+import calendar
 import datetime as dt
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 from flask import request
+from sqlalchemy import and_, case, event, func, inspect, or_, text, type_coerce
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .db import db
-from typing import List
+from typing import Dict, List
+from urllib.parse import urlencode
 
+# stay below SQLite's limit on bound parameters per statement
+IN_CLAUSE_CHUNK_SIZE = 500
+# rows per server-side fetch when streaming an export, the shows of each chunk are loaded in one IN query
+EXPORT_CHUNK_SIZE = IN_CLAUSE_CHUNK_SIZE
+# distinct (filter, order) list statements kept ready to execute
+LIST_STATEMENT_CACHE_SIZE = 256
+
+# keyed by actor first for loading and deleting an actor's shows, the show_id index serves the reverse lookup
 show_actor_association_table = db.Table('show_actor_association', db.Model.metadata,
-        db.Column('show_id', db.ForeignKey('tv_shows.id')),
-        db.Column('actor_id', db.ForeignKey('actors.id'))
+        db.Column('show_id', db.ForeignKey('tv_shows.id'), nullable=False),
+        db.Column('actor_id', db.ForeignKey('actors.id'), nullable=False),
+        db.PrimaryKeyConstraint('actor_id', 'show_id'),
+        db.Index('ix_show_actor_association_show_id', 'show_id')
     )
 
 class Show(db.Model):
     __tablename__ = 'tv_shows'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String)
+    name = db.Column(db.String, index=True, unique=True)
+
+    # in-process show name -> id cache, cleared whenever shows are changed or a transaction rolls back
+    name_ids: Dict[str, int] = {}
+    name_ids_lock = threading.Lock()
 
     def __init__(self, name):
         self.name = name
@@ -26,18 +53,164 @@ class Show(db.Model):
     def find_by_showname(cls, _show_name: str) -> "Show":
         return cls.query.filter_by(name = _show_name).first()
 
+    @classmethod
+    def find_ids_by_shownames(cls, _show_names: List[str]) -> Dict[str, int]:
+        ids = {}
+        for start in range(0, len(_show_names), IN_CLAUSE_CHUNK_SIZE):
+            chunk = _show_names[start:start + IN_CLAUSE_CHUNK_SIZE]
+            ids.update(db.session.query(cls.name, cls.id).filter(cls.name.in_(chunk)).all())
+        return ids
+
+    @classmethod
+    def find_names_by_ids(cls, _ids: List[int]) -> Dict[int, str]:
+        names = {}
+        for start in range(0, len(_ids), IN_CLAUSE_CHUNK_SIZE):
+            names.update(db.session.query(cls.id, cls.name).filter(cls.id.in_(_ids[start:start + IN_CLAUSE_CHUNK_SIZE])).all())
+        return names
+
+    @classmethod
+    def resolve_shownames(cls, _show_names: List[str]) -> List["Show"]:
+        # returns one Show per distinct name, in order, inserting the names that are not stored yet
+        names = list(dict.fromkeys(_show_names))
+        with cls.name_ids_lock:
+            ids = {name: cls.name_ids[name] for name in names if name in cls.name_ids}
+        missing = [name for name in names if name not in ids]
+        if missing:
+            ids.update(cls.find_ids_by_shownames(missing))
+            missing = [name for name in names if name not in ids]
+        if missing:
+            # a concurrent import may insert the same names, the unique index keeps one row each; OR IGNORE
+            # rather than ON CONFLICT (name), which is an error on tables created before the index existed
+            for start in range(0, len(missing), IN_CLAUSE_CHUNK_SIZE):
+                chunk = missing[start:start + IN_CLAUSE_CHUNK_SIZE]
+                db.session.execute(
+                    sqlite_insert(cls).prefix_with('OR IGNORE').values([{'name': name} for name in chunk]))
+            ids.update(cls.find_ids_by_shownames(missing))
+        with cls.name_ids_lock:
+            cls.name_ids.update(ids)
+
+        shows = {}
+        id_list = list(ids.values())
+        for start in range(0, len(id_list), IN_CLAUSE_CHUNK_SIZE):
+            for show in cls.query.filter(cls.id.in_(id_list[start:start + IN_CLAUSE_CHUNK_SIZE])).all():
+                shows[show.id] = show
+        if any(ids[name] not in shows or shows[ids[name]].name != name for name in names):
+            # another process deleted or renamed cached shows, resolve again from the table
+            cls.clear_name_ids()
+            return cls.resolve_shownames(names)
+        return [shows[ids[name]] for name in names]
+
+    @classmethod
+    def clear_name_ids(cls) -> None:
+        with cls.name_ids_lock:
+            cls.name_ids.clear()
+
+
+@event.listens_for(Show, 'after_update')
+@event.listens_for(Show, 'after_delete')
+def invalidate_show_name_ids(mapper, connection, target):
+    Show.clear_name_ids()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def invalidate_show_name_ids_on_rollback(session):
+    Show.clear_name_ids()
+
+
+class Actor_Detail_Cache:
+    # in-process LRU of Actor.find_detail results, keyed by actor id
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped by every invalidation, a row read before one may already be stale
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.environ.get('ACTOR_CACHE_SIZE', 1024)),
+            ttl=float(os.environ.get('ACTOR_CACHE_TTL', 60)))
+
+    def get(self, _id: int) -> dict:
+        with self.lock:
+            entry = self.entries.get(_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[_id]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, _id: int, detail: dict, generation: int) -> None:
+        # generation is self.generation from before the row was read
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[_id] = (time.monotonic() + self.ttl, detail)
+            self.entries.move_to_end(_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, changed_ids: set, moved_ids: set) -> None:
+        # changed_ids were updated in place; moved_ids were inserted or deleted,
+        # which also changes the previous/next links of the entries around them
+        if not changed_ids and not moved_ids:
+            return
+        moved = sorted(moved_ids)
+        with self.lock:
+            self.generation += 1
+            stale = [_id for _id in changed_ids | moved_ids if _id in self.entries]
+            if moved:
+                for _id, (_, detail) in self.entries.items():
+                    low = -1 if detail['prev_id'] is None else detail['prev_id']
+                    high = float('inf') if detail['next_id'] is None else detail['next_id']
+                    i = bisect.bisect_left(moved, low)
+                    if i < len(moved) and moved[i] <= high:
+                        stale.append(_id)
+            for _id in set(stale):
+                del self.entries[_id]
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+            }
+
 
 class Actor(db.Model):
     __tablename__ = 'actors'
     id = db.Column(db.Integer, primary_key=True)
     actor_id = db.Column(db.Integer, unique=True)
-    name = db.Column(db.String)
-    country = db.Column(db.String)
-    gender = db.Column(db.String)
-    last_update = db.Column(db.DateTime, default=dt.datetime.now())
+    name = db.Column(db.String, index=True)
+    country = db.Column(db.String, index=True)
+    gender = db.Column(db.String, index=True)
+    last_update = db.Column(db.DateTime, default=dt.datetime.now(), index=True)
     birthday = db.Column(db.Date)
     deathday = db.Column(db.Date)
     shows = db.relationship("Show", secondary=show_actor_association_table, cascade="all, delete")
+
+    detail_cache = Actor_Detail_Cache.from_env()
+    list_statements = OrderedDict()
+    list_statements_lock = threading.Lock()
     
     def __init__(self, actor_id, name, country, gender, birthday, deathday):
         self.actor_id = actor_id
@@ -71,26 +244,41 @@ class Actor(db.Model):
         }
     
     def get_json(self, prev_actor, next_actor):
-        return {
-            'id': self.id, 
-            'last-update':self.last_update.strftime('%Y-%m-%d %H:%M:%S'), 
+        return Actor.detail_json({
+            'id': self.id,
+            'last_update': self.last_update,
             'name': self.name,
-            'country': None if not self.country else self.country,
-            'gender': None if not self.gender else self.gender,
-            'birthday': None if not self.birthday else self.birthday.strftime('%d-%m-%Y'),
-            'deathday': None if not self.deathday else self.deathday.strftime('%d-%m-%Y'),
+            'country': self.country,
+            'gender': self.gender,
+            'birthday': self.birthday,
+            'deathday': self.deathday,
+            'prev_id': None if not prev_actor else prev_actor.id,
+            'next_id': None if not next_actor else next_actor.id,
+            'shows': list(map(lambda n: n.name, self.shows))
+        })
+
+    @staticmethod
+    def detail_json(detail: dict):
+        return {
+            'id': detail['id'], 
+            'last-update': detail['last_update'].strftime('%Y-%m-%d %H:%M:%S'), 
+            'name': detail['name'],
+            'country': None if not detail['country'] else detail['country'],
+            'gender': None if not detail['gender'] else detail['gender'],
+            'birthday': None if not detail['birthday'] else detail['birthday'].strftime('%d-%m-%Y'),
+            'deathday': None if not detail['deathday'] else detail['deathday'].strftime('%d-%m-%Y'),
             '_links': { 
                 'self': { 
-                    'href': 'http://' + request.host + '/actors/' + str(self.id)
+                    'href': 'http://' + request.host + '/actors/' + str(detail['id'])
                 }, 
                 'previous': { 
-                    'href': None if not prev_actor else 'http://' + request.host + '/actors/' + str(prev_actor.id)
+                    'href': None if not detail['prev_id'] else 'http://' + request.host + '/actors/' + str(detail['prev_id'])
                 },
                 'next': { 
-                    'href': None if not next_actor else 'http://' + request.host + '/actors/' + str(next_actor.id)
+                    'href': None if not detail['next_id'] else 'http://' + request.host + '/actors/' + str(detail['next_id'])
                 } 
             }, 
-            'shows': list(map(lambda n: n.name, self.shows))
+            'shows': detail['shows']
         }
 
     def deleted_json(self, id):
@@ -111,44 +299,241 @@ class Actor(db.Model):
             deathday = None if not json_dict['deathday'] else dt.datetime.strptime(json_dict['deathday'], "%Y-%m-%d").date()
         )
     
+    def update_from_json(self, json_dict) -> None:
+        fresh = Actor.from_json(json_dict)
+        self.name = fresh.name
+        self.country = fresh.country
+        self.gender = fresh.gender
+        self.birthday = fresh.birthday
+        self.deathday = fresh.deathday
+        self.last_update = dt.datetime.now()
+
     @staticmethod
     def actor_list_json(actors: List,
                     page: int, 
                     size: int, 
-                    stop: int, 
+                    next_cursor: str, 
                     total_actors: int, 
                     order: str, 
                     filter: str,
         ):
-        actors_list = [] 
-        for actor in actors:
-            actor_dict = actor._asdict()
-            #for some reason the Actor object is being passed, so have to remove it for JSON to deserialise
-            del actor_dict['Actor'] 
-            actors_list.append(actor_dict)
-        print(actors_list)
+        # rows lead with the filter columns, any sort columns after them are only there for the cursor
+        columns = Actor.list_columns(filter)
+        actors_list = [dict(zip(columns, actor)) for actor in actors]
+        count = '' if total_actors is not None else '&count=false'
         return {
             'page': page,
             'page-size': size,
+            'total': total_actors,
             'actors': actors_list,
             '_links': {
                 'self': {
-                    'href': 'http://' + request.host + '/actors?order={}&page={}&size={}&filter={}'.format(order,page,size,filter)
+                    'href': 'http://' + request.host + '/actors?order={}&page={}&size={}&filter={}'.format(order,page,size,filter) + count
                 },
                 'next': {
-                    'href': None if not stop < total_actors else 'http://' + request.host + '/actors?order={}&page={}&size={}&filter={}'.format(order,page+1,size,filter)
+                    'href': None if next_cursor is None else 'http://' + request.host + '/actors?order={}&page={}&size={}&filter={}&cursor={}'.format(order,page+1,size,filter,next_cursor) + count
                 }
             }
         }
     
+    @staticmethod
+    def bulk_report_json(report: List[dict]):
+        actors_list = []
+        summary = {}
+        for entry in report:
+            summary[entry['status']] = summary.get(entry['status'], 0) + 1
+            id = entry.get('id')
+            actors_list.append({
+                'name': entry['name'],
+                'status': entry['status'],
+                'id': id,
+                'message': entry.get('message'),
+                '_links': {
+                    'self': {
+                        'href': None if id is None else 'http://' + request.host + '/actors/' + str(id)
+                    }
+                }
+            })
+        return {
+            'total': len(report),
+            'summary': summary,
+            'actors': actors_list
+        }
+
+    @staticmethod
+    def bulk_changes_json(report: List[dict]):
+        actors_list = []
+        summary = {}
+        for entry in report:
+            summary[entry['status']] = summary.get(entry['status'], 0) + 1
+            id = entry.get('id')
+            actors_list.append({
+                'id': id,
+                'status': entry['status'],
+                'message': entry.get('message'),
+                '_links': {
+                    'self': {
+                        'href': 'http://' + request.host + '/actors/' + str(id) if entry['status'] == 'updated' else None
+                    }
+                }
+            })
+        return {
+            'total': len(report),
+            'summary': summary,
+            'actors': actors_list
+        }
+
+    @staticmethod
+    def search_json(results: List[dict], query: str, page: int, size: int, has_next: bool):
+        actors_list = []
+        for result in results:
+            actors_list.append(dict(result, _links={
+                'self': {
+                    'href': 'http://' + request.host + '/actors/' + str(result['id'])
+                }
+            }))
+        return {
+            'query': query,
+            'page': page,
+            'page-size': size,
+            'actors': actors_list,
+            '_links': {
+                'self': {
+                    'href': 'http://' + request.host + '/actors/search?' + urlencode({'q': query, 'page': page, 'size': size})
+                },
+                'next': {
+                    'href': None if not has_next else 'http://' + request.host + '/actors/search?' + urlencode({'q': query, 'page': page + 1, 'size': size})
+                }
+            }
+        }
+
+    @staticmethod
+    def costars_json(id: int, costars: List[tuple], page: int, size: int, total: int):
+        # costars holds (id, name, shared show count) for this page
+        return {
+            'id': id,
+            'page': page,
+            'page-size': size,
+            'total': total,
+            'costars': [{
+                'id': costar_id,
+                'name': name,
+                'shared-shows': shared,
+                '_links': {
+                    'self': {
+                        'href': 'http://' + request.host + '/actors/' + str(costar_id)
+                    }
+                }
+            } for costar_id, name, shared in costars],
+            '_links': {
+                'self': {
+                    'href': 'http://' + request.host + '/actors/{}/costars?page={}&size={}'.format(id, page, size)
+                },
+                'next': {
+                    'href': None if page * size >= total else 'http://' + request.host + '/actors/{}/costars?page={}&size={}'.format(id, page + 1, size)
+                }
+            }
+        }
+
+    @staticmethod
+    def path_json(path: List[tuple], names: Dict[int, str], shownames: Dict[int, str]):
+        # path holds (actor id, id of the show shared with the previous actor)
+        return {
+            'from': path[0][0],
+            'to': path[-1][0],
+            'degrees': len(path) - 1,
+            'path': [{
+                'id': actor_id,
+                'name': names.get(actor_id),
+                'via': None if show_id is None else shownames.get(show_id),
+                '_links': {
+                    'self': {
+                        'href': 'http://' + request.host + '/actors/' + str(actor_id)
+                    }
+                }
+            } for actor_id, show_id in path]
+        }
+
     @classmethod
     def find_by_actorid(cls, _userid: int) -> "Actor":
         return cls.query.filter_by(actor_id=_userid).first()
     
+    @classmethod
+    def find_by_actorids(cls, _userids: List[int]) -> Dict[int, "Actor"]:
+        actors = {}
+        for start in range(0, len(_userids), IN_CLAUSE_CHUNK_SIZE):
+            chunk = _userids[start:start + IN_CLAUSE_CHUNK_SIZE]
+            for actor in cls.query.filter(cls.actor_id.in_(chunk)).all():
+                actors[actor.actor_id] = actor
+        return actors
+
     @classmethod
     def find_by_id(cls, _id: int) -> "Actor":
         return cls.query.filter_by(id=_id).first()
     
+    @classmethod
+    def find_names_by_ids(cls, _ids: List[int]) -> Dict[int, str]:
+        names = {}
+        for start in range(0, len(_ids), IN_CLAUSE_CHUNK_SIZE):
+            names.update(db.session.query(cls.id, cls.name).filter(cls.id.in_(_ids[start:start + IN_CLAUSE_CHUNK_SIZE])).all())
+        return names
+
+    @classmethod
+    def find_detail(cls, _id: int) -> dict:
+        # actor columns, neighbour ids and show names in a single round trip
+        # (MAX/MIN over the primary key seek the index, a LAG/LEAD window would scan the whole table)
+        shows = db.select(func.json_group_array(Show.name)) \
+            .select_from(show_actor_association_table.join(Show, Show.id == show_actor_association_table.c.show_id)) \
+            .where(show_actor_association_table.c.actor_id == cls.id) \
+            .scalar_subquery()
+        row = db.session.query(
+                cls.id, cls.last_update, cls.name, cls.country, cls.gender, cls.birthday, cls.deathday,
+                *cls.neighbour_columns(_id), shows.label('shows')) \
+            .filter(cls.id == _id) \
+            .first()
+        if row is None:
+            return None
+        detail = row._asdict()
+        detail['shows'] = json.loads(detail['shows'])
+        return detail
+
+    @classmethod
+    def find_validators(cls, _id: int) -> dict:
+        # just enough of find_detail to answer a conditional GET, shows are not read
+        row = db.session.query(cls.id, cls.last_update, *cls.neighbour_columns(_id)) \
+            .filter(cls.id == _id) \
+            .first()
+        return None if row is None else row._asdict()
+
+    @classmethod
+    def neighbour_columns(cls, _id: int) -> list:
+        prev_id = db.select(func.max(cls.id)).where(cls.id < _id).scalar_subquery()
+        next_id = db.select(func.min(cls.id)).where(cls.id > _id).scalar_subquery()
+        # shows only lose rows through cascaded deletes, which bump this version
+        shows_version = db.select(TableVersion.version).where(TableVersion.name == Show.__tablename__).scalar_subquery()
+        # the neighbour ids and show names change with these tables, so Last-Modified follows them too
+        actors_updated_at = db.select(TableVersion.updated_at).where(TableVersion.name == cls.__tablename__).scalar_subquery()
+        shows_updated_at = db.select(TableVersion.updated_at).where(TableVersion.name == Show.__tablename__).scalar_subquery()
+        return [prev_id.label('prev_id'), next_id.label('next_id'), shows_version.label('shows_version'),
+                actors_updated_at.label('actors_updated_at'), shows_updated_at.label('shows_updated_at')]
+
+    @staticmethod
+    def detail_validators(detail: dict) -> tuple:
+        # (strong etag, last modified) of a detail payload, from find_detail or find_validators
+        tag = '{}|{}|{}|{}|{}|{}'.format(
+            request.host, detail['id'], detail['last_update'].isoformat(), detail['prev_id'], detail['next_id'], detail['shows_version'])
+        last_modified = max(value for value in (detail['last_update'], detail['actors_updated_at'], detail['shows_updated_at']) if value is not None)
+        return hashlib.sha1(tag.encode()).hexdigest(), last_modified.astimezone(dt.timezone.utc)
+
+    @classmethod
+    def load_detail(cls, _id: int) -> dict:
+        # find_detail, remembered in the detail cache unless a write was invalidated while it was read
+        generation = cls.detail_cache.generation
+        detail = cls.find_detail(_id)
+        if detail is not None:
+            cls.detail_cache.put(_id, detail, generation)
+        return detail
+
     @classmethod
     def get_prev_id(cls, _id: int) -> "Actor":
         return cls.query.order_by(cls.id.desc()).filter(cls.id < _id).first()
@@ -162,23 +547,207 @@ class Actor(db.Model):
         return cls.query.all()
     
     @classmethod
-    def filter_and_sort_columns_with_pagination(cls, _sort: str, _select: str, _start: int, _stop: int) -> List["Actor"]:
-        query = db.session.query(Actor)
-        select_columns = _select.split(',')
-        for column in select_columns:
-            query = query.add_columns(db.Column(column))
-        sort_columns = _sort.split(',')
-        for clause in sort_columns:
+    def count(cls) -> int:
+        return db.session.query(func.count(cls.id)).scalar()
+
+    @classmethod
+    def parse_sort(cls, _sort: str) -> List[tuple]:
+        # "+name,-id" -> [(name column, False), (id column, True)], always ending on the unique id
+        sort_columns = []
+        for clause in _sort.split(','):
             isDescending = clause[0] == '-' # ascending by default is nothing was specified
-            column = clause[1:]
-            sort = db.desc(column) if isDescending else db.asc(column)
-            query = query.order_by(sort)
-        query = query.slice(_start, _stop) # apply pagination, stop is exclusive
-        return query.all()
-    
+            column = clause[1:] if clause[0] in '+- ' else clause
+            if column not in cls.__table__.c:
+                raise ValueError('cannot sort by {}'.format(column))
+            sort_columns.append((cls.__table__.c[column], isDescending))
+        if not any(column.name == 'id' for column, _ in sort_columns):
+            sort_columns.append((cls.__table__.c['id'], False))
+        return sort_columns
+
+    @staticmethod
+    def sort_key(sort_columns: List[tuple]) -> str:
+        # canonical order string, a '+' sent unescaped in a query string arrives as a space
+        return ','.join(('-' if isDescending else '+') + column.name for column, isDescending in sort_columns)
+
+    @classmethod
+    def encode_cursor(cls, sort_columns: List[tuple], values: list) -> str:
+        values = [v.isoformat() if isinstance(v, (dt.date, dt.datetime)) else v for v in values]
+        token = json.dumps({'order': cls.sort_key(sort_columns), 'after': values}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(token.encode()).decode()
+
+    @classmethod
+    def decode_cursor(cls, sort_columns: List[tuple], _cursor: str) -> list:
+        try:
+            token = json.loads(base64.urlsafe_b64decode(_cursor.encode()))
+        except Exception:
+            raise ValueError('invalid cursor')
+        if token.get('order') != cls.sort_key(sort_columns) or len(token.get('after', [])) != len(sort_columns):
+            raise ValueError('cursor does not belong to order {}'.format(cls.sort_key(sort_columns)))
+        values = []
+        for (column, _), value in zip(sort_columns, token['after']):
+            if value is not None and column.type.python_type is dt.datetime:
+                value = dt.datetime.fromisoformat(value)
+            elif value is not None and column.type.python_type is dt.date:
+                value = dt.date.fromisoformat(value)
+            values.append(value)
+        return values
+
+    @staticmethod
+    def keyset_condition(sort_columns: List[tuple], values: list):
+        # rows strictly after the cursor in (sort columns) order, SQLite sorts NULL first ascending and last descending
+        conditions = []
+        for i, ((column, isDescending), value) in enumerate(zip(sort_columns, values)):
+            equal_before = [c.is_(None) if v is None else c == v for (c, _), v in zip(sort_columns[:i], values[:i])]
+            if value is None:
+                after = None if isDescending else column.isnot(None)
+            else:
+                after = (or_(column < value, column.is_(None)) if column.nullable else column < value) if isDescending else column > value
+            if after is not None:
+                conditions.append(and_(*equal_before, after))
+        column, isDescending = sort_columns[0]
+        if values[0] is None:
+            return or_(*conditions)
+        # a redundant bound on the leading column lets SQLite seek its index instead of scanning from the start
+        if not isDescending:
+            bound = column >= values[0]
+        elif column.nullable:
+            bound = or_(column <= values[0], column.is_(None))
+        else:
+            bound = column <= values[0]
+        return and_(bound, or_(*conditions))
+
+    @classmethod
+    def list_columns(cls, _select: str, _extra: tuple = ()) -> tuple:
+        # the list endpoint's filter, actor columns (or one of _extra) only and each one once
+        columns = []
+        for column in _select.split(','):
+            column = column.strip()
+            if column not in cls.__table__.c and column not in _extra:
+                raise ValueError('cannot display {}'.format(column))
+            if column not in columns:
+                columns.append(column)
+        return tuple(columns)
+
+    @classmethod
+    def list_statement(cls, columns: tuple, sort_columns: List[tuple], nulls: tuple):
+        # one select per filter, order and pattern of NULLs in the cursor; the cursor values, limit and offset
+        # are bound parameters, so a cached select reuses its cache key and SQLAlchemy's compiled SQL
+        key = (columns, cls.sort_key(sort_columns), nulls)
+        with cls.list_statements_lock:
+            statement = cls.list_statements.get(key)
+            if statement is not None:
+                cls.list_statements.move_to_end(key)
+                return statement
+        names = list(columns) + [column.name for column, _ in sort_columns if column.name not in columns]
+        selected = []
+        for name in names:
+            column = cls.__table__.c[name]
+            # dates go out as SQLite stores them, without a round trip through date objects
+            if column.type.python_type in (dt.date, dt.datetime):
+                column = type_coerce(column, db.String).label(name)
+            selected.append(column)
+        statement = db.select(*selected)
+        for column, isDescending in sort_columns:
+            statement = statement.order_by(db.desc(column) if isDescending else db.asc(column))
+        if nulls is None:
+            statement = statement.offset(db.bindparam('offset', type_=db.Integer))
+        else:
+            after = [None if null else db.bindparam('after_{}'.format(i), type_=column.type)
+                     for i, ((column, _), null) in enumerate(zip(sort_columns, nulls))]
+            statement = statement.where(cls.keyset_condition(sort_columns, after))
+        statement = statement.limit(db.bindparam('limit', type_=db.Integer))
+        with cls.list_statements_lock:
+            cls.list_statements[key] = statement
+            while len(cls.list_statements) > LIST_STATEMENT_CACHE_SIZE:
+                cls.list_statements.popitem(last=False)
+        return statement
+
+    @classmethod
+    def filter_and_sort_columns_with_pagination(cls, _sort: str, _select: str, _start: int, _size: int, _cursor: str = None) -> tuple:
+        # returns the page rows as plain tuples, filter columns first, and the cursor of the following page,
+        # None on the last page
+        columns = cls.list_columns(_select)
+        sort_columns = cls.parse_sort(_sort)
+        params = {'limit': _size + 1}
+        if _cursor:
+            # keyset pagination, seek past the last row of the previous page instead of counting OFFSET rows
+            values = cls.decode_cursor(sort_columns, _cursor)
+            nulls = tuple(value is None for value in values)
+            params.update(('after_{}'.format(i), value) for i, value in enumerate(values) if value is not None)
+        else:
+            nulls = None
+            params['offset'] = _start
+        statement = cls.list_statement(columns, sort_columns, nulls)
+        rows = db.session.execute(statement, params).all()
+        if len(rows) <= _size:
+            return rows, None
+        rows = rows[:_size]
+        last = dict(zip([column.name for column in statement.selected_columns], rows[-1]))
+        return rows, cls.encode_cursor(sort_columns, [last[column.name] for column, _ in sort_columns])
+
+    @classmethod
+    def group_expression(cls, _attr: str):
+        # SQL bucket expression for each statistics dimension
+        if _attr in ('country', 'gender'):
+            return getattr(cls, _attr)
+        elif _attr == 'life_status':
+            return case((cls.deathday.is_(None), 'Alive'), else_='Dead')
+        elif _attr == 'birth_month':
+            return func.strftime('%m', cls.birthday)
+        elif _attr == 'birth_year':
+            return func.strftime('%Y', cls.birthday)
+        raise ValueError('cannot group actors by {}'.format(_attr))
+
+    @classmethod
+    def count_by_group(cls, _attr: str) -> List[tuple]:
+        # (bucket, count) pairs, largest first; actors without a value are left out
+        bucket = cls.group_expression(_attr)
+        rows = db.session.query(bucket, func.count(cls.id)) \
+            .filter(bucket.isnot(None)) \
+            .group_by(bucket) \
+            .order_by(func.count(cls.id).desc()) \
+            .all()
+        if _attr == 'birth_month':
+            rows = [(calendar.month_name[int(month)], count) for month, count in rows]
+        return rows
+
+    @classmethod
+    def export_columns(cls, _select: str) -> List[str]:
+        # the list endpoint's filter, plus shows for the actor's show names
+        return list(cls.list_columns(_select, ('shows',)))
+
+    @classmethod
+    def find_shownames_by_ids(cls, _ids: List[int]) -> Dict[int, List[str]]:
+        shownames = {_id: [] for _id in _ids}
+        rows = db.session.query(show_actor_association_table.c.actor_id, Show.name) \
+            .join(Show, Show.id == show_actor_association_table.c.show_id) \
+            .filter(show_actor_association_table.c.actor_id.in_(_ids)) \
+            .order_by(show_actor_association_table.c.actor_id, show_actor_association_table.c.show_id)
+        for actor_id, name in rows:
+            shownames[actor_id].append(name)
+        return shownames
+
+    @classmethod
+    def export_chunks(cls, _sort: str, _columns: List[str]):
+        # yields lists of row dicts in _sort order, the rows are fetched EXPORT_CHUNK_SIZE at a time
+        # as plain tuples, so memory stays flat however large the table is
+        names = ['id'] + [column for column in _columns if column not in ('id', 'shows')]
+        statement = db.select(*[cls.__table__.c[name] for name in names])
+        for column, isDescending in cls.parse_sort(_sort):
+            statement = statement.order_by(db.desc(column) if isDescending else db.asc(column))
+        result = db.session.execute(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        for partition in result.partitions():
+            rows = [dict(zip(names, row)) for row in partition]
+            if 'shows' in _columns:
+                shownames = cls.find_shownames_by_ids([row['id'] for row in rows])
+                for row in rows:
+                    row['shows'] = shownames[row['id']]
+            yield [{column: row[column] for column in _columns} for row in rows]
+
     @classmethod
     def count_by_last_updated(cls, _timedelta:int) -> int:
-        return cls.query.filter(cls.last_update > _timedelta).count()
+        # counted from the last_update index alone, the actor rows are never read
+        return db.session.query(func.count(cls.id)).filter(cls.last_update > _timedelta).scalar()
     
     def save_to_db(self) -> None:
         # prevent duplicate entries
@@ -190,6 +759,20 @@ class Actor(db.Model):
             db.session.rollback()
             print("ERROR saving actor entity: " + str(msg))
 
+    @staticmethod
+    def save_all_to_db(actors: List["Actor"]) -> List[int]:
+        # one commit for the whole batch, returns the new ids in the same order
+        try:
+            db.session.add_all(actors)
+            db.session.flush()
+            ids = [actor.id for actor in actors]
+            db.session.commit()
+            return ids
+        except Exception as msg:
+            db.session.rollback()
+            print("ERROR saving actor entities: " + str(msg))
+            raise Exception(str(msg))
+
     def delete_from_db(self) -> None:
         try:
             db.session.delete(self)
@@ -200,4 +783,632 @@ class Actor(db.Model):
             print("ERROR deleting actor entity: " + str(msg))
             raise Exception(str(msg))
 
-    
\ No newline at end of file
+    @staticmethod
+    def parse_bulk_change(item) -> tuple:
+        # one PATCH /actors/bulk entry -> (id, {column: value}), dates as in PATCH /actors/<id>, null clears a value
+        if not isinstance(item, dict) or type(item.get('id')) is not int:
+            raise ValueError('every change needs an integer id')
+        changes = {}
+        for key, value in item.items():
+            if key == 'id':
+                continue
+            elif key == 'name':
+                if not isinstance(value, str) or not value.strip():
+                    raise ValueError('name cannot be empty')
+                changes[key] = value
+            elif key in ('country', 'gender'):
+                if value is not None and not isinstance(value, str):
+                    raise ValueError('{} must be a string'.format(key))
+                changes[key] = value
+            elif key in ('birthday', 'deathday'):
+                try:
+                    changes[key] = None if value is None else dt.datetime.strptime(value, "%d-%m-%Y").date()
+                except (TypeError, ValueError):
+                    raise ValueError('{} must be a DD-MM-YYYY date'.format(key))
+            elif key == 'shows':
+                if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+                    raise ValueError('shows must be a list of show names')
+                changes[key] = value
+            else:
+                raise ValueError('cannot change {}'.format(key))
+        if not changes:
+            raise ValueError('nothing to change')
+        return item['id'], changes
+
+    @classmethod
+    def find_tracked_values(cls, _ids: List[int]) -> Dict[int, dict]:
+        # the attributes actor statistics count, for the ids that are stored
+        columns = [cls.__table__.c[attr] for attr in ActorStatistic.TRACKED_ATTRIBUTES]
+        values = {}
+        for start in range(0, len(_ids), IN_CLAUSE_CHUNK_SIZE):
+            rows = db.session.execute(db.select(cls.__table__.c['id'], *columns)
+                                      .where(cls.__table__.c['id'].in_(_ids[start:start + IN_CLAUSE_CHUNK_SIZE])))
+            for row in rows:
+                values[row[0]] = dict(zip(ActorStatistic.TRACKED_ATTRIBUTES, row[1:]))
+        return values
+
+    @staticmethod
+    def find_show_ids_by_actor_ids(_ids: List[int]) -> Dict[int, set]:
+        association = show_actor_association_table.c
+        show_ids = {_id: set() for _id in _ids}
+        for start in range(0, len(_ids), IN_CLAUSE_CHUNK_SIZE):
+            rows = db.session.execute(db.select(association.actor_id, association.show_id)
+                                      .where(association.actor_id.in_(_ids[start:start + IN_CLAUSE_CHUNK_SIZE])))
+            for actor_id, show_id in rows:
+                show_ids[actor_id].add(show_id)
+        return show_ids
+
+    @staticmethod
+    def record_bulk_changes(changed: set, moved: set, graph_changes: list, shows_deleted: bool) -> None:
+        # set-based writes never reach the flush listeners, hand them what they would have collected
+        session = db.session()
+        session.info.setdefault('changed_actor_ids', set()).update(changed)
+        session.info.setdefault('moved_actor_ids', set()).update(moved)
+        session.info.setdefault('association_changes', []).extend(graph_changes)
+        if shows_deleted:
+            session.info['clear_actor_cache'] = True
+        Actor.detail_cache.invalidate(changed, moved)
+
+    @classmethod
+    def bulk_update(cls, _changes: Dict[int, dict]) -> List[int]:
+        # applies {id: {column: value}} in one transaction, returns the ids that were stored and updated
+        table = cls.__table__
+        association = show_actor_association_table
+        try:
+            before = cls.find_tracked_values(list(_changes))
+            ids = [_id for _id in _changes if _id in before]
+            connection = db.session.connection()
+            now = dt.datetime.now()
+            # one executemany per set of changed columns
+            updates = {}
+            for _id in ids:
+                columns = tuple(sorted(column for column in _changes[_id] if column != 'shows'))
+                params = {'b_' + column: _changes[_id][column] for column in columns}
+                updates.setdefault(columns, []).append(dict(params, b_id=_id, b_last_update=now))
+            for columns, params in updates.items():
+                values = {column: db.bindparam('b_' + column, type_=table.c[column].type) for column in columns}
+                connection.execute(table.update().where(table.c['id'] == db.bindparam('b_id'))
+                                   .values(last_update=db.bindparam('b_last_update', type_=table.c['last_update'].type), **values), params)
+
+            # only the links that differ are deleted or inserted, the graph and search triggers see just those
+            shows = {_id: _changes[_id]['shows'] for _id in ids if 'shows' in _changes[_id]}
+            graph_changes = []
+            if shows:
+                show_ids = {show.name: show.id for show in Show.resolve_shownames([name for names in shows.values() for name in names])}
+                stored = cls.find_show_ids_by_actor_ids(list(shows))
+                for _id, names in shows.items():
+                    wanted = {show_ids[name] for name in names}
+                    graph_changes += [('remove', _id, show_id) for show_id in sorted(stored[_id] - wanted)]
+                    graph_changes += [('add', _id, show_id) for show_id in sorted(wanted - stored[_id])]
+                removed = [{'b_actor_id': actor_id, 'b_show_id': show_id} for change, actor_id, show_id in graph_changes if change == 'remove']
+                added = [{'actor_id': actor_id, 'show_id': show_id} for change, actor_id, show_id in graph_changes if change == 'add']
+                if removed:
+                    connection.execute(association.delete().where(and_(
+                        association.c.actor_id == db.bindparam('b_actor_id'), association.c.show_id == db.bindparam('b_show_id'))), removed)
+                if added:
+                    connection.execute(association.insert(), added)
+
+            ActorStatistic.apply_changes(connection, [before[_id] for _id in ids],
+                [dict(before[_id], **{attr: _changes[_id][attr] for attr in ActorStatistic.TRACKED_ATTRIBUTES if attr in _changes[_id]}) for _id in ids])
+            if ids:
+                TableVersion.bump(connection, cls.__tablename__)
+            cls.record_bulk_changes(set(ids), set(), graph_changes, False)
+            db.session.commit()
+            return ids
+        except Exception as msg:
+            db.session.rollback()
+            print("ERROR updating actor entities: " + str(msg))
+            raise Exception(str(msg))
+
+    @classmethod
+    def bulk_delete(cls, _ids: List[int]) -> List[int]:
+        # deletes the actors in one transaction, their shows go with them as with DELETE /actors/<id>;
+        # returns the ids that were stored and deleted
+        association = show_actor_association_table
+        try:
+            before = cls.find_tracked_values(_ids)
+            ids = [_id for _id in _ids if _id in before]
+            connection = db.session.connection()
+            show_ids = sorted({show_id for shows in cls.find_show_ids_by_actor_ids(ids).values() for show_id in shows})
+            for start in range(0, len(ids), IN_CLAUSE_CHUNK_SIZE):
+                connection.execute(association.delete().where(association.c.actor_id.in_(ids[start:start + IN_CLAUSE_CHUNK_SIZE])))
+            for start in range(0, len(show_ids), IN_CLAUSE_CHUNK_SIZE):
+                chunk = show_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+                # other actors of a deleted show lose the link too
+                connection.execute(association.delete().where(association.c.show_id.in_(chunk)))
+                connection.execute(Show.__table__.delete().where(Show.__table__.c['id'].in_(chunk)))
+            for start in range(0, len(ids), IN_CLAUSE_CHUNK_SIZE):
+                connection.execute(cls.__table__.delete().where(cls.__table__.c['id'].in_(ids[start:start + IN_CLAUSE_CHUNK_SIZE])))
+
+            ActorStatistic.apply_changes(connection, [before[_id] for _id in ids], [])
+            if ids:
+                TableVersion.bump(connection, cls.__tablename__)
+            if show_ids:
+                TableVersion.bump(connection, Show.__tablename__)
+                Show.clear_name_ids()
+            graph_changes = [('remove_actor', _id, None) for _id in ids] + [('remove_show', None, show_id) for show_id in show_ids]
+            cls.record_bulk_changes(set(), set(ids), graph_changes, bool(show_ids))
+            db.session.commit()
+            return ids
+        except Exception as msg:
+            db.session.rollback()
+            print("ERROR deleting actor entities: " + str(msg))
+            raise Exception(str(msg))
+
+
+class Actor_Search_Index:
+    # FTS5 tables over actor names, countries and show names, kept in step by triggers so ORM saves,
+    # core inserts and set-based updates all reach them. actor_search answers word prefix queries,
+    # actor_search_trigram (an index over actors.name, no copy of the names) catches typos
+    SHOWNAMES = ("coalesce((SELECT group_concat(tv_shows.name, ' | ') FROM show_actor_association"
+                 " JOIN tv_shows ON tv_shows.id = show_actor_association.show_id"
+                 " WHERE show_actor_association.actor_id = {}), '')")
+    TABLES = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS actor_search USING fts5("
+        "name, country, shows, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS actor_search_trigram USING fts5("
+        "name, content = 'actors', content_rowid = 'id', tokenize = 'trigram')",
+    ]
+    TRIGGERS = [
+        "CREATE TRIGGER IF NOT EXISTS actor_search_insert AFTER INSERT ON actors BEGIN"
+        " INSERT INTO actor_search (rowid, name, country, shows) VALUES (new.id, new.name, new.country, " + SHOWNAMES.format('new.id') + ");"
+        " INSERT INTO actor_search_trigram (rowid, name) VALUES (new.id, new.name);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS actor_search_update AFTER UPDATE OF name, country ON actors BEGIN"
+        " UPDATE actor_search SET name = new.name, country = new.country WHERE rowid = new.id;"
+        " INSERT INTO actor_search_trigram (actor_search_trigram, rowid, name) VALUES ('delete', old.id, old.name);"
+        " INSERT INTO actor_search_trigram (rowid, name) VALUES (new.id, new.name);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS actor_search_delete AFTER DELETE ON actors BEGIN"
+        " DELETE FROM actor_search WHERE rowid = old.id;"
+        " INSERT INTO actor_search_trigram (actor_search_trigram, rowid, name) VALUES ('delete', old.id, old.name);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS actor_search_add_show AFTER INSERT ON show_actor_association BEGIN"
+        " UPDATE actor_search SET shows = " + SHOWNAMES.format('new.actor_id') + " WHERE rowid = new.actor_id;"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS actor_search_remove_show AFTER DELETE ON show_actor_association BEGIN"
+        " UPDATE actor_search SET shows = " + SHOWNAMES.format('old.actor_id') + " WHERE rowid = old.actor_id;"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS actor_search_rename_show AFTER UPDATE OF name ON tv_shows BEGIN"
+        " UPDATE actor_search SET shows = " + SHOWNAMES.format('actor_search.rowid') +
+        " WHERE rowid IN (SELECT actor_id FROM show_actor_association WHERE show_id = new.id);"
+        " END",
+        # a show deleted with one actor can still be linked to others
+        "CREATE TRIGGER IF NOT EXISTS actor_search_delete_show AFTER DELETE ON tv_shows BEGIN"
+        " UPDATE actor_search SET shows = " + SHOWNAMES.format('actor_search.rowid') +
+        " WHERE rowid IN (SELECT actor_id FROM show_actor_association WHERE show_id = old.id);"
+        " END",
+    ]
+    # name matches count ten times a country match and country matches twice a show match
+    RANK = 'bm25(actor_search, 10.0, 2.0, 1.0)'
+    # share of the query's trigrams a name needs to count as a misspelling of it
+    MIN_TRIGRAM_SIMILARITY = 0.4
+
+    @classmethod
+    def create(cls, connection) -> None:
+        for statement in cls.TABLES + cls.TRIGGERS:
+            connection.execute(text(statement))
+
+    @classmethod
+    def drop(cls, connection) -> None:
+        connection.execute(text('DROP TABLE IF EXISTS actor_search'))
+        connection.execute(text('DROP TABLE IF EXISTS actor_search_trigram'))
+
+    @classmethod
+    def rebuild(cls, connection) -> None:
+        connection.execute(text('DELETE FROM actor_search'))
+        connection.execute(text(
+            'INSERT INTO actor_search (rowid, name, country, shows)'
+            ' SELECT id, name, country, ' + cls.SHOWNAMES.format('actors.id') + ' FROM actors'))
+        connection.execute(text("INSERT INTO actor_search_trigram (actor_search_trigram) VALUES ('rebuild')"))
+        # merge the index segments written by the bulk insert, queries then read one b-tree per term
+        connection.execute(text("INSERT INTO actor_search (actor_search) VALUES ('optimize')"))
+        connection.execute(text("INSERT INTO actor_search_trigram (actor_search_trigram) VALUES ('optimize')"))
+
+    @staticmethod
+    def words(_query: str) -> List[str]:
+        # quoting every word keeps FTS5 operators and punctuation in the query from being parsed
+        return re.findall(r'\w+', _query.lower())
+
+    @staticmethod
+    def prefix_query(_words: List[str]) -> str:
+        # the words before the last were typed in full, the last one is still being typed. A prefix longer than
+        # the ones indexed reads the whole list of every matching word, one letter is only matched as a word
+        last = _words[-1]
+        return ' '.join(['"{}"'.format(word) for word in _words[:-1]] + ['"{}"{}'.format(last, '*' if len(last) > 1 else '')])
+
+    @staticmethod
+    def trigrams(_words: List[str]) -> set:
+        return {word[i:i + 3] for word in _words for i in range(len(word) - 2)}
+
+    @classmethod
+    def search(cls, _query: str, _start: int, _size: int) -> tuple:
+        # returns the page rows, best first, and whether another page follows.
+        # word and prefix matches come first, trigram matches on the name only top up a short result
+        words = cls.words(_query)
+        if not words:
+            raise ValueError('search query has no words')
+        wanted = _start + _size + 1
+        # every match is ranked, rowid breaks ties so consecutive pages neither overlap nor skip rows
+        rows = db.session.execute(text(
+            'SELECT rowid FROM actor_search WHERE actor_search MATCH :match ORDER BY {}, rowid LIMIT :limit'.format(cls.RANK)),
+            {'match': cls.prefix_query(words), 'limit': wanted})
+        matches = [(row[0], 'prefix') for row in rows]
+        trigrams = cls.trigrams(words)
+        groups = ['(' + ' OR '.join('"{}"'.format(trigram) for trigram in sorted(cls.trigrams([word]))) + ')'
+                  for word in words if len(word) >= 3]
+        # first names sharing a trigram with every word, then with any word, rows sharing more of them rank first.
+        # Names too far from the query are skipped while reading, so the rows are read until the page is full
+        for join in (' AND ', ' OR ')[:min(2, len(groups))]:
+            if len(matches) >= wanted:
+                break
+            found = {_id for _id, _ in matches}
+            rows = db.session.execute(text(
+                'SELECT rowid, name FROM actor_search_trigram WHERE actor_search_trigram MATCH :match ORDER BY rank, rowid'),
+                {'match': join.join(groups)})
+            for _id, name in rows:
+                shared = len(trigrams & cls.trigrams(cls.words(name or '')))
+                if _id not in found and shared >= len(trigrams) * cls.MIN_TRIGRAM_SIMILARITY:
+                    matches.append((_id, 'fuzzy'))
+                    if len(matches) >= wanted:
+                        break
+            rows.close()
+        page = matches[_start:_start + _size]
+        actors = {row.id: row for row in db.session.query(Actor.id, Actor.name, Actor.country)
+                  .filter(Actor.id.in_([_id for _id, _ in page]))}
+        results = [{'id': _id, 'name': actors[_id].name, 'country': actors[_id].country, 'match': match}
+                   for _id, match in page if _id in actors]
+        return results, len(matches) > _start + _size
+
+
+@event.listens_for(show_actor_association_table, 'after_create')
+def create_actor_search_index(target, connection, **kw):
+    # the association table is created after actors and tv_shows, the triggers need all three
+    if connection.dialect.name == 'sqlite':
+        Actor_Search_Index.create(connection)
+
+
+@event.listens_for(Actor.__table__, 'after_drop')
+def drop_actor_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        Actor_Search_Index.drop(connection)
+
+
+class ActorStatistic(db.Model):
+    # materialised actor counts per (dimension, bucket), kept in step with every actor write
+    __tablename__ = 'actor_statistics'
+    dimension = db.Column(db.String, primary_key=True)
+    bucket = db.Column(db.String, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    DIMENSIONS = ['total', 'country', 'gender', 'life_status', 'birth_month', 'birth_year']
+    TRACKED_ATTRIBUTES = ['country', 'gender', 'birthday', 'deathday']
+
+    @classmethod
+    def buckets(cls, values: dict) -> List[tuple]:
+        # python twin of Actor.group_expression for one actor's attribute values
+        buckets = [('total', 'all'), ('life_status', 'Alive' if values['deathday'] is None else 'Dead')]
+        if values['country'] is not None:
+            buckets.append(('country', values['country']))
+        if values['gender'] is not None:
+            buckets.append(('gender', values['gender']))
+        if values['birthday'] is not None:
+            buckets.append(('birth_month', calendar.month_name[values['birthday'].month]))
+            buckets.append(('birth_year', '{:04d}'.format(values['birthday'].year)))
+        return buckets
+
+    @classmethod
+    def current_values(cls, actor: Actor) -> dict:
+        return {attr: getattr(actor, attr) for attr in cls.TRACKED_ATTRIBUTES}
+
+    @classmethod
+    def committed_values(cls, actor: Actor) -> dict:
+        # attribute values as they were before the pending changes
+        state = inspect(actor)
+        values = {}
+        for attr in cls.TRACKED_ATTRIBUTES:
+            history = state.attrs[attr].history
+            if history.deleted:
+                values[attr] = history.deleted[0]
+            elif history.unchanged:
+                values[attr] = history.unchanged[0]
+            else:
+                values[attr] = getattr(actor, attr)
+        return values
+
+    @classmethod
+    def apply_changes(cls, connection, removed: List[dict], added: List[dict]) -> None:
+        deltas = {}
+        for values in removed:
+            for key in cls.buckets(values):
+                deltas[key] = deltas.get(key, 0) - 1
+        for values in added:
+            for key in cls.buckets(values):
+                deltas[key] = deltas.get(key, 0) + 1
+        deltas = {key: delta for key, delta in deltas.items() if delta != 0}
+        if not deltas:
+            return
+        statement = sqlite_insert(cls.__table__)
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=['dimension', 'bucket'],
+                set_={'count': cls.__table__.c['count'] + statement.excluded['count']}),
+            [{'dimension': d, 'bucket': b, 'count': delta} for (d, b), delta in deltas.items()])
+        if any(delta < 0 for delta in deltas.values()):
+            connection.execute(cls.__table__.delete().where(cls.__table__.c['count'] <= 0))
+
+    @classmethod
+    def total(cls) -> int:
+        row = db.session.get(cls, ('total', 'all'))
+        return 0 if row is None else row.count
+
+    @classmethod
+    def count_by_group(cls, _attr: str) -> List[tuple]:
+        # same (bucket, count) pairs as Actor.count_by_group, read from the materialised table
+        if _attr not in cls.DIMENSIONS or _attr == 'total':
+            raise ValueError('cannot group actors by {}'.format(_attr))
+        return db.session.query(cls.bucket, cls.count) \
+            .filter(cls.dimension == _attr, cls.count > 0) \
+            .order_by(cls.count.desc()) \
+            .all()
+
+    @classmethod
+    def expected_counts(cls) -> Dict[tuple, int]:
+        # what the table should hold, computed from the actors table
+        expected = {}
+        total = Actor.count()
+        if total > 0:
+            expected[('total', 'all')] = total
+        for dimension in cls.DIMENSIONS[1:]:
+            for bucket, count in Actor.count_by_group(dimension):
+                expected[(dimension, bucket)] = count
+        return expected
+
+    @classmethod
+    def rebuild(cls) -> int:
+        expected = cls.expected_counts()
+        try:
+            db.session.query(cls).delete()
+            if expected:
+                db.session.execute(cls.__table__.insert(),
+                    [{'dimension': d, 'bucket': b, 'count': count} for (d, b), count in expected.items()])
+            db.session.commit()
+        except Exception as msg:
+            db.session.rollback()
+            print("ERROR rebuilding actor statistics: " + str(msg))
+            raise Exception(str(msg))
+        return len(expected)
+
+    @classmethod
+    def check(cls) -> List[tuple]:
+        # (dimension, bucket, stored, expected) for every bucket that drifted
+        expected = cls.expected_counts()
+        stored = {(row.dimension, row.bucket): row.count for row in cls.query.filter(cls.count > 0).all()}
+        return [
+            (key[0], key[1], stored.get(key, 0), expected.get(key, 0))
+            for key in sorted(set(expected) | set(stored))
+            if stored.get(key, 0) != expected.get(key, 0)
+        ]
+
+    @classmethod
+    def ensure_built(cls) -> None:
+        # databases created before the table existed start with an empty one
+        if db.session.query(cls.dimension).first() is None and Actor.count() > 0:
+            cls.rebuild()
+
+
+@event.listens_for(db.session, 'after_flush')
+def maintain_actor_statistics(session, flush_context):
+    removed = []
+    added = []
+    for obj in session.new:
+        if isinstance(obj, Actor):
+            added.append(ActorStatistic.current_values(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Actor):
+            removed.append(ActorStatistic.committed_values(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Actor) and session.is_modified(obj):
+            removed.append(ActorStatistic.committed_values(obj))
+            added.append(ActorStatistic.current_values(obj))
+    if removed or added:
+        ActorStatistic.apply_changes(session.connection(), removed, added)
+
+
+class TableVersion(db.Model):
+    # version counter per table, bumped in the same transaction as every write to it
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    @classmethod
+    def get(cls, _name: str) -> tuple:
+        row = db.session.query(cls.version, cls.updated_at).filter(cls.name == _name).first()
+        return (0, None) if row is None else (row.version, row.updated_at)
+
+    @classmethod
+    def bump(cls, connection, _name: str) -> int:
+        # returns the new version
+        statement = sqlite_insert(cls.__table__).values(name=_name, version=1, updated_at=dt.datetime.now())
+        return connection.execute(statement.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'version': cls.__table__.c['version'] + 1, 'updated_at': statement.excluded['updated_at']})
+            .returning(cls.__table__.c['version'])).scalar()
+
+
+class GraphChange(db.Model):
+    # link changes per version of the co-star graph, other processes replay them instead of rebuilding
+    __tablename__ = 'graph_changes'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, index=True)
+    change = db.Column(db.String, nullable=False)
+    actor_id = db.Column(db.Integer)
+    show_id = db.Column(db.Integer)
+
+    # versions kept at least, a process further behind rebuilds its graph from the table
+    KEEP_VERSIONS = int(os.environ.get('COSTAR_LOG_VERSIONS', 1000))
+    PRUNE_EVERY = 100
+
+    @classmethod
+    def record(cls, connection, _version: int, _changes: list) -> None:
+        connection.execute(cls.__table__.insert(), [{'version': _version, 'change': change, 'actor_id': actor_id, 'show_id': show_id}
+                                                    for change, actor_id, show_id in _changes])
+        if _version % cls.PRUNE_EVERY == 0:
+            connection.execute(cls.__table__.delete().where(cls.__table__.c['version'] <= _version - cls.KEEP_VERSIONS))
+
+    @classmethod
+    def between(cls, _start: int, _end: int) -> List[tuple]:
+        # (version, change, actor id, show id) of the versions after _start up to _end, in commit order
+        return db.session.execute(db.select(cls.version, cls.change, cls.actor_id, cls.show_id)
+                                  .where(cls.version > _start, cls.version <= _end)
+                                  .order_by(cls.version, cls.id)).all()
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_table_versions(session, flush_context):
+    for model in (Actor, Show):
+        if any(isinstance(obj, model) for obj in session.deleted) \
+                or any(isinstance(obj, model) and session.is_modified(obj) for obj in session.dirty) \
+                or (model is Actor and any(isinstance(obj, model) for obj in session.new)):
+            TableVersion.bump(session.connection(), model.__tablename__)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_actor_ids(session, flush_context):
+    changed = session.info.setdefault('changed_actor_ids', set())
+    moved = session.info.setdefault('moved_actor_ids', set())
+    for obj in session.new:
+        if isinstance(obj, Actor):
+            moved.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Actor):
+            moved.add(obj.id)
+        elif isinstance(obj, Show):
+            # cascaded show deletes change the show lists of other actors too
+            session.info['clear_actor_cache'] = True
+    for obj in session.dirty:
+        if isinstance(obj, Actor):
+            changed.add(obj.id)
+    Actor.detail_cache.invalidate(changed, moved)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_actor_detail_cache(session):
+    # invalidate again once committed, readers may have cached the old rows in between
+    changed = session.info.pop('changed_actor_ids', set())
+    moved = session.info.pop('moved_actor_ids', set())
+    if session.info.pop('clear_actor_cache', False):
+        Actor.detail_cache.clear()
+    else:
+        Actor.detail_cache.invalidate(changed, moved)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_changed_actor_ids(session, previous_transaction):
+    session.info.pop('changed_actor_ids', None)
+    session.info.pop('moved_actor_ids', None)
+    session.info.pop('clear_actor_cache', None)
+
+
+class SyncCheckpoint(db.Model):
+    # how far a background sync got through an upstream feed
+    __tablename__ = 'sync_checkpoints'
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    @classmethod
+    def get(cls, _name: str) -> int:
+        row = db.session.get(cls, _name)
+        return 0 if row is None else row.value
+
+    @classmethod
+    def set(cls, _name: str, _value: int) -> None:
+        row = db.session.get(cls, _name)
+        if row is None:
+            row = cls(name=_name)
+            db.session.add(row)
+        row.value = _value
+        row.updated_at = dt.datetime.now()
+
+
+class ActorJob(db.Model):
+    # queued POST /actors/ requests, processed by the actor job pool
+    __tablename__ = 'actor_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+    status = db.Column(db.String, nullable=False, default='queued', index=True)
+    actor_id = db.Column(db.Integer)
+    message = db.Column(db.String)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'queued'
+        self.created_at = self.updated_at = dt.datetime.now()
+
+    def json(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'message': self.message,
+            'created': str(self.created_at),
+            'last-update': str(self.updated_at),
+            '_links': {
+                'self': {
+                    'href': 'http://' + request.host + '/jobs/' + str(self.id)
+                },
+                'actor': {
+                    'href': None if self.actor_id is None else 'http://' + request.host + '/actors/' + str(self.actor_id)
+                }
+            }
+        }
+
+    @classmethod
+    def find_by_id(cls, _id: int) -> "ActorJob":
+        return cls.query.filter_by(id=_id).first()
+
+    @classmethod
+    def enqueue(cls, _name: str) -> "ActorJob":
+        job = cls(_name)
+        try:
+            db.session.add(job)
+            db.session.commit()
+        except Exception as msg:
+            db.session.rollback()
+            print("ERROR queueing actor job: " + str(msg))
+            raise Exception(str(msg))
+        return job
+
+    @classmethod
+    def claim_next(cls) -> tuple:
+        # atomically move the oldest queued job to running, safe across threads and processes
+        next_id = db.select(cls.id).where(cls.status == 'queued').order_by(cls.id).limit(1).scalar_subquery()
+        row = db.session.execute(
+            db.update(cls.__table__)
+                .where(cls.__table__.c.id == next_id, cls.__table__.c.status == 'queued')
+                .values(status='running', updated_at=dt.datetime.now())
+                .returning(cls.__table__.c.id, cls.__table__.c.name)).first()
+        db.session.commit()
+        return None if row is None else (row.id, row.name)
+
+    @classmethod
+    def finish(cls, _id: int, _status: str, _actor_id: int = None, _message: str = None) -> None:
+        db.session.execute(
+            db.update(cls.__table__)
+                .where(cls.__table__.c.id == _id)
+                .values(status=_status, actor_id=_actor_id, message=_message, updated_at=dt.datetime.now()))
+        db.session.commit()
+
+    @classmethod
+    def requeue_stale(cls, _older_than: dt.datetime) -> int:
+        # jobs left running by a worker process that died
+        result = db.session.execute(
+            db.update(cls.__table__)
+                .where(cls.__table__.c.status == 'running', cls.__table__.c.updated_at < _older_than)
+                .values(status='queued', updated_at=dt.datetime.now()))
+        db.session.commit()
+        return result.rowcount
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+
+
+class Token_Bucket:
+    # process wide limit on calls to TV Maze, rate calls per period with bursts of up to capacity
+    def __init__(self, rate, period, capacity):
+        self.rate = rate
+        self.period = period
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rate=int(os.environ.get('TVMAZE_RATE_LIMIT', 20)),
+            period=float(os.environ.get('TVMAZE_RATE_PERIOD', 10)),
+            capacity=int(os.environ.get('TVMAZE_RATE_BURST', 10)))
+
+    def reserve(self) -> float:
+        # takes a token now or returns how long to wait before asking again
+        with self.lock:
+            now = time.monotonic()
+            if now < self.resume_at:
+                return self.resume_at - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / self.period)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) * self.period / self.rate
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        wait = self.reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    def pause(self, seconds: float) -> None:
+        # upstream said back off, hold every thread and drop the burst we had saved up
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated = self.resume_at
+
+
+class Adaptive_Limiter:
+    # in-flight TV Maze calls, halved on every 429 and grown back by one per limit successes
+    def __init__(self, min_limit, max_limit, cooldown=1.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(self.max_limit)
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            min_limit=int(os.environ.get('TVMAZE_MIN_IN_FLIGHT', 1)),
+            max_limit=int(os.environ.get('TVMAZE_MAX_IN_FLIGHT', 16)))
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                # the 429s of one burst arrive together, count them as a single signal
+                if now - self.decreased_at >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.decreased_at = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight}
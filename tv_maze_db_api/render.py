@@ -0,0 +1,105 @@
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+
+# workers are forked from the web worker, a spawned one would import tv_maze_db_api again and rerun its
+# start up (create_all, migrate, the sync thread)
+POOL_CONTEXT = multiprocessing.get_context('fork')
+# how often a waiting job checks that its pool was not replaced under it
+POOL_CHECK_INTERVAL = 0.05
+
+
+class Render_Pool_Saturated(Exception):
+    pass
+
+
+class Render_Timeout(Exception):
+    pass
+
+
+def warm_worker():
+    # pay for the matplotlib import once per worker process, not once per chart
+    from .helper import Statistics_Helper
+    Statistics_Helper.load_viz_stack()
+
+
+def render_png(group_by_dict: dict) -> bytes:
+    from .helper import Statistics_Helper
+    return Statistics_Helper.generate_viz_image(group_by_dict).getvalue()
+
+
+class Render_Pool:
+    # pre-warmed worker processes that turn statistics into PNG bytes away from the web worker's GIL
+    def __init__(self, processes, timeout, max_queue):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.pending = 0
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            processes=int(os.environ.get('STATS_RENDER_POOL_SIZE', 2)),
+            timeout=float(os.environ.get('STATS_RENDER_TIMEOUT', 10)),
+            max_queue=int(os.environ.get('STATS_RENDER_MAX_QUEUE', 8)))
+
+    def get_pool(self):
+        # created lazily and per process, a pool inherited through fork belongs to the parent
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = POOL_CONTEXT.Pool(self.processes, initializer=warm_worker)
+                self.pid = os.getpid()
+            return self.pool
+
+    def start(self) -> None:
+        self.get_pool()
+
+    def submit(self, func, *args):
+        with self.lock:
+            if self.pending >= self.max_queue:
+                raise Render_Pool_Saturated('{} render jobs already queued'.format(self.pending))
+            self.pending += 1
+        try:
+            pool = self.get_pool()
+            result = pool.apply_async(func, args)
+            deadline = time.monotonic() + self.timeout
+            while not result.ready():
+                if pool is not self.pool and not result.ready():
+                    # another job's timeout terminated this pool, the result will never arrive
+                    raise Render_Timeout('render pool was restarted while the job was running')
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # a stuck worker cannot be cancelled, replace the pool it runs in
+                    self.restart(pool)
+                    raise Render_Timeout('render job took longer than {} seconds'.format(self.timeout))
+                result.wait(min(remaining, POOL_CHECK_INTERVAL))
+            return result.get()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def render(self, group_by_dict: dict) -> bytes:
+        if self.processes <= 0:
+            return render_png(group_by_dict)
+        return self.submit(render_png, group_by_dict)
+
+    def restart(self, pool=None) -> None:
+        # pool is the one a timed out job ran in, already replaced pools are left alone
+        with self.lock:
+            if pool is not None and pool is not self.pool:
+                return
+            pool, self.pool = self.pool, None
+        if pool is not None and self.pid == os.getpid():
+            pool.terminate()
+
+    def close(self) -> None:
+        self.restart()
+
+
+render_pool = Render_Pool.from_env()
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .db import db
+from .helper import TVMaze_API_Access
+from .model import Actor, Show, SyncCheckpoint
+
+CHECKPOINT_NAME = 'tvmaze-people-updates'
+
+
+class TVMaze_Sync_Worker:
+    # refreshes stored actors that TV Maze reports as changed since the last checkpoint
+    def __init__(self, app, batch_size=None, batch_interval=None):
+        self.app = app
+        self.batch_size = int(os.environ.get('TVMAZE_SYNC_BATCH_SIZE', 10)) if batch_size is None else batch_size
+        self.batch_interval = float(os.environ.get('TVMAZE_SYNC_BATCH_INTERVAL', 10)) if batch_interval is None else batch_interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def since_window(checkpoint: int) -> str:
+        # the smallest updates feed window that still covers the checkpoint
+        age = time.time() - checkpoint
+        if age < 24 * 3600:
+            return 'day'
+        elif age < 7 * 24 * 3600:
+            return 'week'
+        elif age < 30 * 24 * 3600:
+            return 'month'
+        return None
+
+    def run_once(self) -> dict:
+        api_access = TVMaze_API_Access(self.app.config['TVMAZE_API_URL'] + '/search/people?q=')
+        checkpoint = SyncCheckpoint.get(CHECKPOINT_NAME)
+        updates = api_access.get_updated_people(self.since_window(checkpoint))
+        changed = {actor_id: timestamp for actor_id, timestamp in updates.items() if timestamp > checkpoint}
+        stored = Actor.find_by_actorids(list(changed))
+        # oldest changes first so the checkpoint can advance batch by batch
+        pending = sorted(stored, key=lambda actor_id: changed[actor_id])
+        report = {'changed': len(changed), 'stored': len(stored), 'updated': 0, 'failed': 0}
+
+        for start in range(0, len(pending), self.batch_size):
+            if start > 0:
+                # pace the batches to stay well inside the TV Maze rate limit
+                if self.stop_event.wait(self.batch_interval):
+                    break
+            batch = pending[start:start + self.batch_size]
+            with ThreadPoolExecutor(max_workers=max(1, min(api_access.max_workers, len(batch)))) as executor:
+                people = list(executor.map(api_access.try_get_person, batch))
+            failed_at = None
+            for actor_id, person in zip(batch, people):
+                if isinstance(person, Exception):
+                    print('ERROR refreshing actor {}: {}'.format(actor_id, person))
+                    report['failed'] += 1
+                    failed_at = changed[actor_id] if failed_at is None else min(failed_at, changed[actor_id])
+                    continue
+                person_json, show_names = person
+                actor = stored[actor_id]
+                actor.update_from_json(person_json)
+                actor.shows = Show.resolve_shownames(show_names)
+                report['updated'] += 1
+            if failed_at is not None:
+                # retry from the first failure on the next run
+                checkpoint = failed_at - 1
+                SyncCheckpoint.set(CHECKPOINT_NAME, checkpoint)
+                self.commit()
+                report['checkpoint'] = checkpoint
+                return report
+            checkpoint = changed[batch[-1]]
+            rest = pending[start + self.batch_size:]
+            if rest and changed[rest[0]] == checkpoint:
+                # TV Maze timestamps are whole seconds, actors left with the same one must not be skipped
+                # if the run stops before their batch
+                checkpoint -= 1
+            SyncCheckpoint.set(CHECKPOINT_NAME, checkpoint)
+            self.commit()
+        else:
+            # actors we do not store never need fetching, skip straight past them
+            checkpoint = max([checkpoint] + list(updates.values()))
+            SyncCheckpoint.set(CHECKPOINT_NAME, checkpoint)
+            self.commit()
+        report['checkpoint'] = checkpoint
+        return report
+
+    @staticmethod
+    def commit() -> None:
+        try:
+            db.session.commit()
+        except Exception as msg:
+            db.session.rollback()
+            print('ERROR saving synced actors: ' + str(msg))
+            raise Exception(str(msg))
+
+    def run_forever(self, interval: float) -> None:
+        while not self.stop_event.is_set():
+            with self.app.app_context():
+                try:
+                    print('TV Maze sync: {}'.format(self.run_once()))
+                except Exception as msg:
+                    print('ERROR in TV Maze sync: {}'.format(msg))
+                finally:
+                    db.session.remove()
+            self.stop_event.wait(interval)
+
+    def start(self, interval: float) -> None:
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run_forever, args=(interval,), name='tvmaze-sync', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()